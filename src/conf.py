@@ -12,6 +12,15 @@ Conf = {
         'fileLevel': logging.WARNING
     },
     'data': {
+        # storage backend of the collections: 'mongoDB' for a MongoDB server (see `mongoDB`)
+        # or 'sqlite' for an embedded SQLite database file (see `sqlite`)
+        'backend': 'mongoDB',
+        # number of threads running the database queries of the request handlers
+        # (see `model.getAsyncService`), whatever the backend
+        'workers': 8,
+        'sqlite': {
+            'path': '%s\\data\\vice.sqlite' % os.getcwd()
+        },
         'mongoDB': {
             # allow to force starting mongoDB server if an instance is not listening on the
             # defined host:por.
@@ -27,8 +36,26 @@ Conf = {
             'rootFolder': "%s\\_internal\\bin\\MongoDB\\bin\\" % os.getcwd(),  # trailing '\' is required
             'dataFolder': "%s\\data\\db" % os.getcwd(), #"%s\\data\\db\\" % os.getcwd(),
             'dbName': 'vice',
-            'dumpFolder': "%s\\dumps\\" % os.getcwd(),
-            'dumpDelay': 60 * 60 * 24  # a day
+        },
+        # statistics of the database queries run by the services, see `server.services.instrumentation`
+        # and the route `/api/db/stats`
+        'instrumentation': {
+            'enabled': True,
+            # queries taking more than this number of seconds are logged, with their explanation by the
+            # database the first time a query of the same shape is slow
+            'slowQueryThreshold': 0.5
+        },
+        # number of operations written at once by the bulks of the services (see `Service.bulk`)
+        'bulkChunkSize': 1000,
+        # backups of the collections, made on a background thread once the server is started
+        # (see `server.backup`). Dumps can be restored with `restoreDB.py`.
+        'backup': {
+            'folder': "%s\\dumps\\" % os.getcwd(),
+            'delay': 60 * 60 * 24,  # a day
+            # number of dumps kept, older dumps are deleted
+            'retention': 7,
+            # delay (in seconds) after the server start before the first dump can start
+            'startDelay': 60
         },
         'ffmpeg': {
             'exePath': '%s\\_internal\\bin\\ffmpeg\\ffmpeg.exe' % os.getcwd(),
@@ -46,12 +73,36 @@ Conf = {
             'rootFolder': '%s\\data\\videos\\' % os.getcwd(),
             'allowedTypes': ['avi', 'mkv', 'flv', 'mpg', 'mp4', 'wmv', 'mov', 'm4v', 'm4a', '3gp'],
             'displayPerPage': 9,
-            'annotator': 'dfl-dlib'
+            'annotator': 'dfl-dlib',
+            # maximum hamming distance (over 64 bits) between the perceptual hashes of two
+            # consecutive minivid frames for the second one to re-use the annotation of the first.
+            # Set to None to disable frames deduplication.
+            'dedupThreshold': 4,
+            # maximum delay (in seconds) before the display and seen counters of the videos
+            # are written to the database. Counted views are lost if the server crashes meanwhile.
+            'counterFlushInterval': 5,
+            # maximum number of seconds the number of videos matching a search is kept in memory
+            # (it is counted again as soon as videos are inserted or deleted)
+            'countCacheDelay': 60
         },
         'albums': {
             'rootFolder': '%s\\data\\photos\\' % os.getcwd(),
             'allowedTypes': ['png', 'jpg', 'jpeg'],
-            'annotator': 'dfl-dlib'
+            'annotator': 'dfl-dlib',
+            # sqlite database holding the face annotations of all pictures, indexed by picture path
+            'faceStorePath': '%s\\data\\faces.sqlite' % os.getcwd(),
+            # number of pictures in each page of the random and starred albums
+            'virtualAlbumSize': 500,
+            # number of albums in each page of the albums list
+            'listPageSize': 30,
+            # resized pictures served for `?w=<width>` requests
+            'variants': {
+                'path': '%s\\workspace\\variants' % os.getcwd(),
+                # requested widths are rounded up to the closest of these widths
+                'widths': [320, 640, 1280, 1920],
+                'maxSize': 2048,  # in MB
+                'quality': 85
+            }
         },
         # where temporary files are gonna be stored - to facilitate mass clean up
         'workspace': {
@@ -74,6 +125,11 @@ Conf = {
         'playVideosMPC': True,
         'mpcPath': "C:\\Program Files\\MPC-BE x64\\mpc-be64.exe",
         'templatePath': 'src/http/templates/',
-        'assetsPath': 'src/http/assets/'
+        'assetsPath': 'src/http/assets/',
+        # number of seconds the tags (and their usage) the videos of the home page are selected from
+        # are kept in memory
+        'homeCacheDelay': 30,
+        # size (in MB) of the most recently downloaded snapshots and minivid frames kept in memory
+        'imageCacheSize': 64
     }
 }
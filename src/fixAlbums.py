@@ -26,21 +26,31 @@ def genAlbums():
 
 def main():
     log.init(2, False, filename="fixAlbums.log", colored=False)
-    for album in genAlbums():
-        if album['_id'] in ['random', 'starred']:
-            model.getService('album')._collection.remove({'fullPath': album['_id']})
-            continue
+    pictures = model.getService('picture')
+    # albums are updated in batches, the pictures of an album are written in a single bulk write
+    with model.getService('album').bulk() as bulk:
+        for album in genAlbums():
+            if album['_id'] in ['random', 'starred']:
+                bulk.delete({'fullPath': album['_id']}, multi=True)
+                continue
 
-        data = []
-        for idx, pic in enumerate(album['pictures']):
-            obj = {
-                'filename': pic,
-                'display': 0,
-                'starred': idx in album['starred'],
-                'faces': []
-            }
-            data.append(obj)
-        model.getService('album').set(album['_id'], 'picturesDetails', data)
+            data = []
+            for idx, pic in enumerate(album['pictures']):
+                obj = {
+                    'filename': pic,
+                    'display': 0,
+                    'starred': idx in album['starred'],
+                    'faces': []
+                }
+                data.append(obj)
+            pictures.deleteAlbum(album['_id'])
+            pictures.insertMany(album['_id'], data)
+            bulk.update(album['_id'], {'$set': {
+                'picsNumber': len(data),
+                'starredNumber': len([pic for pic in data if pic['starred']])
+            }})
+    for error in bulk.errors:
+        logging.error("Unable to fix album: %s: %s" % (error['op'], error['errmsg']))
 
 if __name__ == '__main__':
     main()
@@ -14,7 +14,8 @@ $(function () {
     <i class="fa fa-spinner fa-spin"></i>\
 </div>';
 
-        self.onRcvAlbums = function (albums) {
+        self.onRcvAlbums = function (res) {
+            var albums = res.albums;
             if (albums.length == 0)
                 return spinLoading('stop');
             var i = 0;
@@ -22,15 +23,18 @@ $(function () {
                 var album = albums[i];
                 $('#albums-list #loading-info').remove();
                 $('#albums-list').append(render(self.albumTemplate, {
-                    cover: album['picturesDetails'][album['cover']]['url'],
+                    cover: album['coverUrl'] + '?w=320',
                     title: album['name'],
                     _id: album['_id'],
-                    picNb: album['picturesDetails'].length,
-                    starNb: album['picturesDetails'].filter(p => !!p.starred).length
+                    picNb: album['picsNumber'],
+                    starNb: album['starredNumber']
                 }));
                 i += 1;
                 if (i < albums.length)
-                    preloadPictures([album['picturesDetails'][album['cover']]['url']], onPicLoaded);
+                    preloadPictures([albums[i]['coverUrl'] + '?w=320'], onPicLoaded);
+                else if (res.next !== null)
+                    // load the next page once this one is displayed
+                    self.load(res.next);
                 else
                     $('#albums-list #loading-info').remove();
                 $('#albums-list .album-item').off().click(function (e) {
@@ -38,18 +42,21 @@ $(function () {
                         window.open('/slideshow/albumId=' + $(this).attr('data-album-id'), '_self', false);
                 });
             };
-            preloadPictures([albums[i]['picturesDetails'][albums[i]['cover']]['url']], function () {
+            preloadPictures([albums[i]['coverUrl'] + '?w=320'], function () {
                 spinLoading('stop');
                 onPicLoaded();
             });
         }
 
-        self.load = function () {
-            spinLoading();
+        self.load = function (page) {
+            page = page || 0;
+            if (page == 0)
+                spinLoading();
             $.ajax({
                 url: '/api/album/display',
                 type: 'get',
                 dataType: 'json',
+                data: {page: page},
                 error: function (e) {
                     console.error(e);
                     $.UIkit.notify("An error occured while loading albums, see logs for details.", {status:'danger'});
@@ -835,6 +835,10 @@ $(function () {
                         annotation: data.data
                     });
             }
+            else if (data.data_type === 'aggregation_partial') {
+                self._scheduler.scheduleNextStep(
+                    'display-result-partial', 'displayResult', data.data);
+            }
             if (data.data_type === 'aggregation') {
                 self._scheduler.scheduleNextStep(
                     'display-result', 'displayResult', data.data);
@@ -134,6 +134,8 @@ $(function () {
                     spinLoading('stop');
                 },
                 success: function (album) {
+                    // request pictures resized for the strip instead of the full size originals
+                    album.picturesDetails.forEach(pic => pic.url += '?w=640');
                     preloadPictures(album.picturesDetails.slice(1, 4).map(pic => pic.url), function () {
                         for (var i = 1; i < Math.min(album.picturesDetails.length, 20); i++) {
                             $('#pic-container ul').append(
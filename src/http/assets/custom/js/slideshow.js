@@ -1,5 +1,16 @@
 $(function () {
     var CURSOR_DISAPPEAR_TIMEOUT = 5000;
+    // number of pictures left to show before the next page of a paged album (random and starred albums) is loaded
+    var NEXT_PAGE_MARGIN = 50;
+
+    // returns the album id and the index to refer to the given picture of the album in the requests:
+    // the pictures of the next pages of a paged album are referred to by their index in their own page
+    function pictureRef(album, pic) {
+        var picture = album.picturesDetails[pic];
+        if (picture.pageAlbumId)
+            return {albumId: picture.pageAlbumId, pictureIdx: picture.pagePictureIdx};
+        return {albumId: album['_id'], pictureIdx: pic};
+    }
 
     function Controls(album, deleteModal, currentPic=0) {
         var self = this;
@@ -43,7 +54,7 @@ $(function () {
                     url: '/api/album/star',
                     type: 'post',
                     dataType: 'json',
-                    data: {albumId: self.album['_id'], pictureIdx: pic},
+                    data: pictureRef(self.album, pic),
                     error: function (e) {
                         console.error(e);
                         $.UIkit.notify("An error occured while starring this picture, see logs for details.", {status:'danger'});
@@ -60,7 +71,7 @@ $(function () {
                     url: '/api/album/star',
                     type: 'post',
                     dataType: 'json',
-                    data: {albumId: self.album['_id'], pictureIdx: pic, remove: true},
+                    data: $.extend(pictureRef(self.album, pic), {remove: true}),
                     error: function (e) {
                         console.error(e);
                         $.UIkit.notify("An error occured while unstarring this picture, see logs for details.", {status:'danger'});
@@ -164,7 +175,7 @@ $(function () {
 
         self.onEditTag = function (name, newValue, oldId) {
             console.log("On edit tag name=" + name + ", newValue=" + newValue + ", oldId=" + oldId);
-            if (self.album['_id'] == 'random' || self.album['_id'] == 'starred')
+            if (self.album.fullPath == 'random' || self.album.fullPath == 'starred')
                 return
             // value is an id if the item does already exist, otherwise it is the value of the new tag that should be
             // created
@@ -217,7 +228,7 @@ $(function () {
         }
 
         self.onDeleteTag = function () {
-            if (self.album['_id'] == 'random' || self.album['_id'] == 'starred')
+            if (self.album.fullPath == 'random' || self.album.fullPath == 'starred')
                 return
             var $this = $(this);
             var tagId = $this.parent().attr('data-tag-id');
@@ -239,7 +250,7 @@ $(function () {
         }
 
         self.renderTag = function (name, value, id) {
-            if (self.album['_id'] == 'random' || self.album['_id'] == 'starred')
+            if (self.album.fullPath == 'random' || self.album.fullPath == 'starred')
                 return
             self.$view.find('#tags-list').append(render(self.tagTemplate, {
                 name: name,
@@ -260,7 +271,7 @@ $(function () {
         }
 
         self.onAddTag = function (type, tid, value) {
-            if (self.album['_id'] == 'random' || self.album['_id'] == 'starred')
+            if (self.album.fullPath == 'random' || self.album.fullPath == 'starred')
                 return
             // 'type' should always be 'tag' here.
             // 'tid' is the index in the name array
@@ -329,7 +340,7 @@ $(function () {
             };
         }
         self.loadTags = function () {
-            if (self.album['_id'] == 'random' || self.album['_id'] == 'starred')
+            if (self.album.fullPath == 'random' || self.album.fullPath == 'starred')
                 return
 
             $.ajax({
@@ -358,6 +369,9 @@ $(function () {
         self.slideSetSize = 0;
         self.realCurrentSlide = firstPic;
         self.pause = true;
+        // pictures are requested resized to the screen width instead of the full size originals
+        self.screenWidth = Math.round(window.screen.width * (window.devicePixelRatio || 1));
+        self.loadingNextPage = false;
 
         self.controls = null;
 
@@ -462,6 +476,8 @@ $(function () {
             if (self.realCurrentSlide >= self.album.picturesDetails.length)
                 self.realCurrentSlide -= self.album.picturesDetails.length;
             self.controls.updateCurrentPicture(self.realCurrentSlide)
+            if (self.realCurrentSlide + NEXT_PAGE_MARGIN >= self.album.picturesDetails.length)
+                self.loadNextPage();
             // TODO: update the zoom pointer, to point to the center of one of the faces, if there is one
 
             // don't do anything more if the size of the slideset IS total number of slides.
@@ -496,6 +512,35 @@ $(function () {
             });
         }
 
+        // load the next page of a paged album, its pictures are appended to the album
+        self.loadNextPage = function () {
+            if (!self.album.next || self.loadingNextPage)
+                return;
+            self.loadingNextPage = true;
+            $.ajax({
+                url: '/api/album/display',
+                type: 'get',
+                dataType: 'json',
+                data: {albumId: self.album.next},
+                error: function (e) {
+                    console.error(e);
+                    self.loadingNextPage = false;
+                },
+                success: function (page) {
+                    // the first picture of each page is the icon of the album
+                    page.picturesDetails.slice(1).forEach(function (pic, idx) {
+                        pic.url += '?w=' + self.screenWidth;
+                        pic.pageAlbumId = page['_id'];
+                        pic.pagePictureIdx = idx + 1;
+                        self.album.picturesDetails.push(pic);
+                    });
+                    console.log("Loaded " + (page.picturesDetails.length - 1) + " pictures of " + page['_id']);
+                    self.album.next = page.next;
+                    self.loadingNextPage = false;
+                }
+            });
+        }
+
         self.loadPictures = function () {
             spinLoading();
             $.ajax({
@@ -509,6 +554,7 @@ $(function () {
                     spinLoading('stop');
                 },
                 success: function (album) {
+                    album.picturesDetails.forEach(pic => pic.url += '?w=' + self.screenWidth);
                     self.album = album;
                     self.controls = new Controls(album, self.deleteModal);
                     if (self.realCurrentSlide < 0)
@@ -562,7 +608,7 @@ $(function () {
                 url: '/api/album/picture',
                 type: 'delete',
                 dataType: 'json',
-                data: {albumId: self.albumId, pictureIdx: self.realCurrentSlide},
+                data: pictureRef(self.album, self.realCurrentSlide),
                 error: function (e) {
                     spinLoading('stop');
                     console.error(e);
@@ -574,14 +620,15 @@ $(function () {
                     // not working because of the cache of the browser
                     // $('#slideshow ul').html('');
                     // new Slideshow(self.albumId, self.realCurrentSlide);
+                    var ref = pictureRef(self.album, self.realCurrentSlide);
                     window.location.href = '/slideshow/albumId=' +
-                        self.albumId + '/pictureIdx=' + self.realCurrentSlide;
+                        ref.albumId + '/pictureIdx=' + ref.pictureIdx;
                 }
             });
         }
 
         self.onDeleteAlbum = function () {
-            if (self.albumId == 'random' || self.albumId == 'starred')
+            if (self.album.fullPath == 'random' || self.album.fullPath == 'starred')
                 return
             self.deleteModal.hide();
             spinLoading();
@@ -148,27 +148,39 @@ $(function () {
                 }
             }
 
-            fillInDataset(displayData, video.displayHistory);
-            fillInDataset(seenData, video.seenHistory);
-            fillInDataset(starredData, video.favoriteHistory);
-            fillInDataset(taggedData, video.taggedHistory);
-
-            var finalDataset = [];
-            for (var i = 0; i < displayData.length; i++) {
-                finalDataset.push([
-                    displayData[i],
-                    seenData[i],
-                    starredData[i],
-                    taggedData[i]
-                ]);
-            }
-
-            $('#tags-displayer #activity-history').sparkline(finalDataset, {
-                type: 'bar',
-                stackedBarColor: [displayColor, seenColor, starredColor, taggedColor],
-                zeroColor: '#D5D5D5',
-                barWidth: ((420 - finalDataset.length) / finalDataset.length),
-                barSpacing: 1
+            // histories are not part of the video object, load them only when the sparkline is drawn
+            $.ajax({
+                'type': 'get',
+                'dataType': 'json',
+                'url': '/api/video/history',
+                'data': {videoId: video._id, since: beginning},
+                error: function (e) {
+                    console.error(e);
+                },
+                success: function (history) {
+                    fillInDataset(displayData, history.display);
+                    fillInDataset(seenData, history.seen);
+                    fillInDataset(starredData, history.favorite);
+                    fillInDataset(taggedData, history.tagged);
+
+                    var finalDataset = [];
+                    for (var i = 0; i < displayData.length; i++) {
+                        finalDataset.push([
+                            displayData[i],
+                            seenData[i],
+                            starredData[i],
+                            taggedData[i]
+                        ]);
+                    }
+
+                    $('#tags-displayer #activity-history').sparkline(finalDataset, {
+                        type: 'bar',
+                        stackedBarColor: [displayColor, seenColor, starredColor, taggedColor],
+                        zeroColor: '#D5D5D5',
+                        barWidth: ((420 - finalDataset.length) / finalDataset.length),
+                        barSpacing: 1
+                    });
+                }
             });
         }
 
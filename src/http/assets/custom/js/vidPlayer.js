@@ -747,7 +747,7 @@ $(function () {
             */
             var snapshots = [];
             for (var i in video.snapshots) {
-                snapshots.push(video.snapshots[i] + '?' + new Date().getTime());
+                snapshots.push(video.snapshots[i]);
             };
             preloadPictures(snapshots, function () {
                 self.$view.find('#vid-details #thumbnail').html(render(self.snapshotTemplate, {
@@ -187,11 +187,15 @@ data-uk-tooltip="{pos:\'left\'}" title="Quit Full-Screen" style="top: 15px; z-in
                 crit.video.push(self.criteria.video[vf])
             for (var tf in self.criteria.tag)
                 crit.tags.push(self.criteria.tag[tf])
+            var data = {'page': page || 0, criteria: JSON.stringify(crit)};
+            // the continuation token allows the server to fetch the next page without skipping the previous ones
+            if (self.lastLoadResult && self.lastLoadResult.next && self.lastLoadResult.page + 1 == data.page)
+                data.token = self.lastLoadResult.next;
             $.ajax({
                 'type': 'get',
                 'dataType': 'json',
                 'url': '/api/video/filter',
-                'data': {'page': page || 0, criteria: JSON.stringify(crit)},
+                'data': data,
                 success: function (results) {
                     self.lastLoadResult = results;
                     var videos = results.videos;
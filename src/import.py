@@ -39,10 +39,15 @@ cur = db.cursor()
 # import labels
 cur.execute("SELECT * FROM labels")
 model.getService('tag').deleteAll()
-for row in cur.fetchall() :
-    _id = sqlId2objId(row[0])
-    print ("Adding tag: [%s] %s - %s" % (_id, str(row[1]), str(row[2])))
-    model.getService('tag').insert(row[1], row[2], _id=_id, relation=row[3], autotag=getAutoTag(row[1], row[2]))
+tagIds = set()
+with model.getService('tag').bulk() as bulk:
+    for row in cur.fetchall() :
+        _id = sqlId2objId(row[0])
+        print ("Adding tag: [%s] %s - %s" % (_id, str(row[1]), str(row[2])))
+        model.getService('tag').insert(row[1], row[2], _id=_id, relation=row[3], autotag=getAutoTag(row[1], row[2]), bulk=bulk)
+        tagIds.add(_id)
+for error in bulk.errors:
+    print ("ERROR: %s: %s" % (error['op'], error['errmsg']))
 
 import time
 import os
@@ -77,6 +82,18 @@ def analyze(vid):
         return 600, (1920, 1080), 30
     return length / fps, (w, h), fps
 
+# tags of the videos, given to the videos on insertion
+cur.execute("SELECT * FROM vids_labels")
+vidsTags = {}
+for row in cur.fetchall():
+    label_id = sqlId2objId(row[2])
+    vid_id = sqlId2objId(row[1])
+    if label_id not in tagIds:
+        print ("tag %s does not exist!" % label_id)
+        continue
+    if label_id not in vidsTags.setdefault(vid_id, []):
+        vidsTags[vid_id].append(label_id)
+
 cur.execute("SELECT * FROM vids")
 colid = 0
 name = 1
@@ -87,38 +104,31 @@ liked = 7  # number of times
 seen = 9  # last time seen
 disp_first_frame = 11
 model.getService('video').deleteAll()
-for row in cur.fetchall():
-    _id = sqlId2objId(row[colid])
-    print ("Adding video: [%s] %s - path: %s, added: %s, watched: %s, liked: %s, seen: %s, disp_first_frame: %s" \
-            % (_id, row[name], row[path], row[added], row[watched], row[liked], row[seen], row[disp_first_frame]))
-    duration, resolution, fps = analyze(row[path].replace('/', '\\'))
-    model.getService('video').insert(
-        filename=row[name], path=row[path].replace('/', '\\'),
-        seen=row[liked], duration=duration,
-        resolution=resolution, fps=fps,
-        creation=toTimeStamp(row[added]),
-        lastDisplay=toTimeStamp(row[seen]),
-        lastSeen=toTimeStamp(row[watched]),
-        thumbnail=0 if row[disp_first_frame] else None,
-        nbSnapshots=getNbSnapshots(row[path]),
-        _id=_id)
+vidIds = set()
+with model.getService('video').bulk() as bulk:
+    for row in cur.fetchall():
+        _id = sqlId2objId(row[colid])
+        print ("Adding video: [%s] %s - path: %s, added: %s, watched: %s, liked: %s, seen: %s, disp_first_frame: %s" \
+                % (_id, row[name], row[path], row[added], row[watched], row[liked], row[seen], row[disp_first_frame]))
+        duration, resolution, fps = analyze(row[path].replace('/', '\\'))
+        model.getService('video').insert(
+            filename=row[name], path=row[path].replace('/', '\\'),
+            seen=row[liked], duration=duration,
+            resolution=resolution, fps=fps,
+            creation=toTimeStamp(row[added]),
+            lastDisplay=toTimeStamp(row[seen]),
+            lastSeen=toTimeStamp(row[watched]),
+            thumbnail=0 if row[disp_first_frame] else None,
+            nbSnapshots=getNbSnapshots(row[path]),
+            tags=vidsTags.get(_id),
+            _id=_id,
+            bulk=bulk)
+        vidIds.add(_id)
+for error in bulk.errors:
+    print ("ERROR: %s: %s" % (error['op'], error['errmsg']))
 
-from bson.objectid import ObjectId
-cur.execute("SELECT * FROM vids_labels")
-c = 0
-for row in cur.fetchall():
-    label_id = sqlId2objId(row[2])
-    vid_id = sqlId2objId(row[1])
-    vid = model.getService('video').getById(vid_id)
-    tag = model.getService('tag').getById(label_id)
-    if tag is None:
-        print ("tag %s does not exist!" % label_id)
-        continue
-    if vid is None:
+for vid_id in vidsTags:
+    if vid_id not in vidIds:
         print ("vid %s does not exist!" % vid_id)
-        continue
-    print ("Adding tag: %s - %s to video: %s" % (tag['name'], tag['value'], vid['name']))
-    model.getService('video').addTag(vid_id, label_id)
-    c += 1
 
-print ("Imported %d tags" % c)
\ No newline at end of file
+print ("Imported %d tags" % sum(len(vidsTags[vid_id]) for vid_id in vidsTags if vid_id in vidIds))
@@ -0,0 +1,20 @@
+"""
+Move the pictures of the albums from the `picturesDetails` array of the album documents
+to the pictures collection. This migration also runs when the server starts, run this script
+to perform it ahead of time (it can be interrupted and run again).
+"""
+
+import log
+import logging
+
+from server import model
+
+def main():
+    log.init(2, False, filename="migratePictures.log", colored=False)
+    albums = model.getService('album')
+    model.getService('picture').migrateAlbums(albums._collection)
+    logging.info("%d pictures in %d albums" % (
+        model.getService('picture').getOverallCount(), albums.getOverallCount()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,20 @@
+"""
+Recompute the usage counters of all the tags (number of videos and albums holding each tag).
+These counters are maintained when tagging and untagging videos and albums, run this script
+to repair them if the collections have been modified by other means.
+"""
+
+import log
+import logging
+
+from server import model
+
+def main():
+    log.init(2, False, filename="rebuildTagUsage.log", colored=False)
+    model.getService('tag').rebuildUsage()
+    for tag in model.getService('tag').getAll(orderBy={'name': 1, 'value': 1}):
+        logging.info("%s - %s: %d videos, %d albums" % (
+            tag['name'], tag['value'], tag['videoUsage'], tag['albumUsage']))
+
+if __name__ == '__main__':
+    main()
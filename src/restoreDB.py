@@ -0,0 +1,23 @@
+"""
+Restore the collections of the database from a dump made by the backups of the server
+(see `server.backup`). The current documents of the restored collections are deleted.
+Stop the server before running this script.
+"""
+
+import argparse
+import log
+import logging
+
+from server import model
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, prog="restoreDB.py")
+    parser.add_argument('folder', help="folder of the dump to restore (in `Conf['data']['backup']['folder']`)")
+    parser.add_argument('collections', nargs='*', help="collections to restore (all by default)")
+    ns = parser.parse_args()
+    log.init(2, False, filename="restoreDB.log", colored=False)
+    model.getInstance().restoreDB(ns.folder, ns.collections or None)
+    logging.info("Database restored from %s" % ns.folder)
+
+if __name__ == '__main__':
+    main()
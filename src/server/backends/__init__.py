@@ -0,0 +1,20 @@
+# -*- coding: utf8 -*-
+
+"""
+Storage backends of the services.
+The services (see `server.services.baseService.Service`) are given a database object `db`, from which
+they retrieve their collections with `db[<name>]`. Any backend providing the following subset of the
+`pymongo` API can be used (see `Conf['data']['backend']`):
+    * database: `db[<name>]`, `add_son_manipulator(manipulator)`,
+      `command('aggregate', <name>, pipeline=<pipeline>, explain=True)` (see `server.services.instrumentation`)
+    * collection: `name`, `find(spec, projection)`, `find_one(spec, projection, sort=None)`,
+      `find_one_and_delete(filter)`, `count()`, `insert(doc_or_docs)`,
+      `update(spec, document, upsert=False, multi=False)`, `remove(spec)`,
+      `bulk_write(requests, ordered=True)`, `aggregate(pipeline)`, `ensure_index(keys, name, unique)`,
+      `index_information()`, `drop_index(name)`
+    * cursor (returned by `find`): `sort(key_or_list, direction)`, `skip(n)`, `limit(n)`, `count()`, `explain()`,
+      iteration
+Backends:
+    * 'mongoDB': a MongoDB server, through `pymongo` (see `server.model.Model`)
+    * 'sqlite': an embedded SQLite database file (see `server.backends.sqliteBackend`)
+"""
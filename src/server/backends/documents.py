@@ -0,0 +1,810 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import copy
+import heapq
+import math
+import random
+import re
+from datetime import datetime
+from functools import partial
+from itertools import islice
+
+from bson.objectid import ObjectId
+
+"""
+Evaluation of MongoDB queries, updates, projections and aggregation pipelines on documents
+loaded in memory, for the storage backends that don't have a query engine of their own
+(see `server.backends.sqliteBackend`).
+Only the operators used by the services are supported, a `QueryException` is raised
+for any other one.
+"""
+
+
+class QueryException(Exception):
+    pass
+
+
+class _Missing(object):
+    """
+    Value of the fields that don't exist in a document (different from a field set to None).
+    """
+    def __repr__(self):
+        return 'MISSING'
+
+MISSING = _Missing()
+
+
+def typeOrder(value):
+    """
+    Rank of the type of the given value in the order MongoDB uses to compare values of different types.
+    """
+    if value is None or value is MISSING:
+        return 1
+    if isinstance(value, bool):
+        return 8
+    if isinstance(value, (int, float)):
+        return 2
+    if isinstance(value, str):
+        return 3
+    if isinstance(value, dict):
+        return 4
+    if isinstance(value, (list, tuple)):
+        return 5
+    if isinstance(value, bytes):
+        return 6
+    if isinstance(value, ObjectId):
+        return 7
+    if isinstance(value, datetime):
+        return 9
+    return 10
+
+
+def sortKey(value):
+    """
+    Returns a comparable (and hashable) key of the given value, following the MongoDB ordering:
+    values are first ordered by type (see `typeOrder`), then by value.
+    """
+    order = typeOrder(value)
+    if order == 1:
+        return (1, 0)
+    if order == 4:
+        return (4, tuple((k, sortKey(v)) for k, v in value.items()))
+    if order == 5:
+        return (5, tuple(sortKey(v) for v in value))
+    if order == 7:
+        return (7, str(value))
+    if order == 10:
+        return (10, repr(value))
+    return (order, value)
+
+
+def equals(a, b):
+    return sortKey(a) == sortKey(b)
+
+
+def compare(a, b):
+    """
+    Returns -1, 0 or 1 if a is lower, equal or greater than b, None if the values
+    can't be compared by a query operator (values of different types).
+    """
+    if typeOrder(a) != typeOrder(b):
+        return None
+    a, b = sortKey(a), sortKey(b)
+    return (a > b) - (a < b)
+
+
+def _resolve(value, parts):
+    """
+    Returns the list of the values found at the given path (list of field names) of the given value.
+    Arrays found along the way are traversed: the path is resolved on each of their elements.
+    """
+    if len(parts) == 0:
+        return [value]
+    head, rest = parts[0], parts[1:]
+    if isinstance(value, dict):
+        if head not in value:
+            return []
+        return _resolve(value[head], rest)
+    if isinstance(value, list):
+        found = []
+        if head.isdigit() and int(head) < len(value):
+            found += _resolve(value[int(head)], rest)
+        for item in value:
+            if isinstance(item, dict):
+                found += _resolve(item, parts)
+        return found
+    return []
+
+
+def resolve(doc, path):
+    return _resolve(doc, path.split('.'))
+
+
+def _candidates(values):
+    """
+    Values a query operator is tested against: the values found at the path of the field,
+    and the elements of the arrays among them.
+    """
+    res = []
+    for value in values:
+        res.append(value)
+        if isinstance(value, list):
+            res += value
+    return res
+
+
+def _regex(pattern, options=''):
+    if hasattr(pattern, 'try_compile'):  # bson.regex.Regex
+        pattern = pattern.try_compile()
+    if hasattr(pattern, 'search'):
+        return pattern
+    flags = 0
+    for option in options or '':
+        flags |= {'i': re.I, 'm': re.M, 's': re.S, 'x': re.X}.get(option, 0)
+    return re.compile(pattern, flags)
+
+
+def _isRegex(value):
+    return hasattr(value, 'search') or hasattr(value, 'try_compile')
+
+
+def _eq(values, target):
+    if target is None:
+        return len(values) == 0 or any(v is None for v in _candidates(values))
+    if _isRegex(target):
+        regex = _regex(target)
+        return any(isinstance(v, str) and regex.search(v) for v in _candidates(values))
+    return any(equals(v, target) for v in _candidates(values))
+
+
+def _cmp(values, target, test):
+    for value in _candidates(values):
+        res = compare(value, target)
+        if res is not None and test(res):
+            return True
+    return False
+
+
+def _isOperators(cond):
+    return isinstance(cond, dict) and len(cond) > 0 and all(k.startswith('$') for k in cond)
+
+
+def _matchOperators(values, ops):
+    for op, arg in ops.items():
+        if op == '$eq':
+            ok = _eq(values, arg)
+        elif op == '$ne':
+            ok = not _eq(values, arg)
+        elif op == '$gt':
+            ok = _cmp(values, arg, lambda r: r > 0)
+        elif op == '$gte':
+            ok = _cmp(values, arg, lambda r: r >= 0)
+        elif op == '$lt':
+            ok = _cmp(values, arg, lambda r: r < 0)
+        elif op == '$lte':
+            ok = _cmp(values, arg, lambda r: r <= 0)
+        elif op == '$in':
+            ok = any(_eq(values, t) for t in arg)
+        elif op == '$nin':
+            ok = not any(_eq(values, t) for t in arg)
+        elif op == '$all':
+            ok = len(arg) > 0 and all(_eq(values, t) for t in arg)
+        elif op == '$exists':
+            ok = (len(values) > 0) == bool(arg)
+        elif op == '$size':
+            ok = any(isinstance(v, list) and len(v) == arg for v in values)
+        elif op == '$regex':
+            regex = _regex(arg, ops.get('$options', ''))
+            ok = any(isinstance(v, str) and regex.search(v) for v in _candidates(values))
+        elif op == '$options':
+            continue
+        elif op == '$not':
+            if _isRegex(arg):
+                ok = not _eq(values, arg)
+            else:
+                ok = not _matchOperators(values, arg)
+        elif op == '$elemMatch':
+            ok = any(
+                isinstance(v, list) and any(_matchValue(item, arg) for item in v)
+                for v in values)
+        else:
+            raise QueryException("Unsupported query operator: %s" % op)
+        if not ok:
+            return False
+    return True
+
+
+def _matchValue(value, cond):
+    """
+    Returns True if the given value (an element of an array) matches the given condition,
+    that can be operators, a query on the fields of a sub-document or a value.
+    """
+    if _isOperators(cond):
+        return _matchOperators([value], cond)
+    if isinstance(cond, dict) and isinstance(value, dict):
+        return match(value, cond)
+    return _eq([value], cond)
+
+
+def match(doc, query):
+    """
+    Returns True if the given document matches the given query.
+    """
+    for key, cond in (query or {}).items():
+        if key == '$and':
+            ok = all(match(doc, q) for q in cond)
+        elif key == '$or':
+            ok = any(match(doc, q) for q in cond)
+        elif key == '$nor':
+            ok = not any(match(doc, q) for q in cond)
+        elif key == '$comment':
+            continue
+        elif key.startswith('$'):
+            raise QueryException("Unsupported query operator: %s" % key)
+        elif _isOperators(cond):
+            ok = _matchOperators(resolve(doc, key), cond)
+        else:
+            ok = _eq(resolve(doc, key), cond)
+        if not ok:
+            return False
+    return True
+
+
+def _copyPath(src, dst, parts):
+    head, rest = parts[0], parts[1:]
+    if not isinstance(src, dict) or head not in src:
+        return
+    value = src[head]
+    if len(rest) == 0:
+        dst[head] = copy.deepcopy(value)
+    elif isinstance(value, dict):
+        _copyPath(value, dst.setdefault(head, {}), rest)
+    elif isinstance(value, list):
+        items = []
+        for item in value:
+            if isinstance(item, dict):
+                projected = {}
+                _copyPath(item, projected, rest)
+                items.append(projected)
+        dst[head] = items
+
+
+def _unsetPath(doc, parts):
+    head, rest = parts[0], parts[1:]
+    if isinstance(doc, list):
+        for item in doc:
+            _unsetPath(item, parts)
+    elif isinstance(doc, dict) and head in doc:
+        if len(rest) == 0:
+            del doc[head]
+        else:
+            _unsetPath(doc[head], rest)
+
+
+def project(doc, projection):
+    """
+    Apply the projection of a `find` query (a dict {field: <True|False>} or a list of fields)
+    to the given document, returns a new document.
+    """
+    if projection is None:
+        return doc
+    if isinstance(projection, (list, tuple)):
+        projection = {field: True for field in projection}
+    includeId = bool(projection.get('_id', True))
+    fields = {k: bool(v) for k, v in projection.items() if k != '_id'}
+    if any(fields.values()) or (len(fields) == 0 and projection.get('_id', False)):
+        res = {}
+        if includeId and '_id' in doc:
+            res['_id'] = doc['_id']
+        for field, include in fields.items():
+            if include:
+                _copyPath(doc, res, field.split('.'))
+        return res
+    res = copy.deepcopy(doc)
+    for field in fields:
+        _unsetPath(res, field.split('.'))
+    if not includeId:
+        res.pop('_id', None)
+    return res
+
+
+def _container(doc, path, create=True):
+    """
+    Returns the tuple (container, key) of the given path of the document, where container
+    is the dict (or list) holding the field. Missing containers are created unless `create`
+    is False, in which case (None, None) is returned if the path doesn't exist.
+    """
+    parts = path.split('.')
+    current = doc
+    for part in parts[:-1]:
+        if isinstance(current, list):
+            idx = int(part)
+            while create and len(current) <= idx:
+                current.append(None)
+            if idx >= len(current):
+                return None, None
+            if current[idx] is None and create:
+                current[idx] = {}
+            current = current[idx]
+        elif isinstance(current, dict):
+            if part not in current:
+                if not create:
+                    return None, None
+                current[part] = {}
+            current = current[part]
+        else:
+            raise QueryException("Cannot traverse field %s of %s" % (part, path))
+    key = parts[-1]
+    if isinstance(current, list):
+        key = int(key)
+        while create and len(current) <= key:
+            current.append(None)
+        if key >= len(current):
+            return None, None
+    elif not isinstance(current, dict):
+        if create:
+            raise QueryException("Cannot set field %s of %s" % (key, path))
+        return None, None
+    return current, key
+
+
+def _get(container, key):
+    if isinstance(container, list):
+        return container[key]
+    return container.get(key, MISSING)
+
+
+def _each(value):
+    if isinstance(value, dict) and '$each' in value:
+        return list(value['$each'])
+    return [value]
+
+
+def _number(value, field):
+    if typeOrder(value) != 2:
+        raise QueryException("Cannot apply a numeric update to the non-numeric field %s" % field)
+    return value
+
+
+def applyUpdate(doc, update, inserting=False):
+    """
+    Apply the given update (update operators or a replacement document) to the given document,
+    in place. `inserting` is True when the document is being inserted by an upsert.
+    Returns True if the document has been modified.
+    """
+    before = sortKey(doc)
+    if not any(k.startswith('$') for k in update):
+        _id = doc.get('_id')
+        doc.clear()
+        doc.update(copy.deepcopy(update))
+        if _id is not None:
+            doc['_id'] = _id
+        return sortKey(doc) != before
+
+    for op, fields in update.items():
+        if op == '$setOnInsert' and not inserting:
+            continue
+        for path, arg in fields.items():
+            if op == '$unset' or op == '$pull' or op == '$pullAll':
+                container, key = _container(doc, path, create=False)
+                if container is None:
+                    continue
+            else:
+                container, key = _container(doc, path)
+            current = _get(container, key)
+            if op in ('$set', '$setOnInsert'):
+                container[key] = copy.deepcopy(arg)
+            elif op == '$unset':
+                if isinstance(container, list):
+                    container[key] = None
+                else:
+                    container.pop(key, None)
+            elif op == '$inc':
+                container[key] = (0 if current is MISSING else _number(current, path)) + _number(arg, path)
+            elif op == '$mul':
+                container[key] = (0 if current is MISSING else _number(current, path)) * _number(arg, path)
+            elif op == '$max':
+                if current is MISSING or sortKey(arg) > sortKey(current):
+                    container[key] = copy.deepcopy(arg)
+            elif op == '$min':
+                if current is MISSING or sortKey(arg) < sortKey(current):
+                    container[key] = copy.deepcopy(arg)
+            elif op in ('$push', '$addToSet'):
+                if current is MISSING:
+                    current = container[key] = []
+                if not isinstance(current, list):
+                    raise QueryException("Cannot apply %s to the non-array field %s" % (op, path))
+                for item in _each(arg):
+                    if op == '$push' or not any(equals(item, v) for v in current):
+                        current.append(copy.deepcopy(item))
+            elif op in ('$pull', '$pullAll'):
+                if not isinstance(current, list):
+                    continue
+                if op == '$pullAll':
+                    container[key] = [v for v in current if not any(equals(v, t) for t in arg)]
+                else:
+                    container[key] = [v for v in current if not _matchValue(v, arg)]
+            else:
+                raise QueryException("Unsupported update operator: %s" % op)
+    return sortKey(doc) != before
+
+
+def upsertDocument(query):
+    """
+    Returns the document inserted by an upsert that doesn't match any document:
+    the fields the query tests for equality.
+    """
+    doc = {}
+    for key, cond in query.items():
+        if key == '$and':
+            for q in cond:
+                doc.update(upsertDocument(q))
+        elif key.startswith('$'):
+            continue
+        elif _isOperators(cond):
+            if '$eq' in cond:
+                container, k = _container(doc, key)
+                container[k] = copy.deepcopy(cond['$eq'])
+        else:
+            container, k = _container(doc, key)
+            container[k] = copy.deepcopy(cond)
+    return doc
+
+
+class SortKey(object):
+    """
+    Sort key of a document given a list of (field, direction) tuples, honoring the direction of each field.
+    """
+    __slots__ = ('keys', 'directions')
+
+    def __init__(self, doc, sort):
+        self.directions = [direction for field, direction in sort]
+        self.keys = [fieldSortKey(doc, field, direction) for field, direction in sort]
+
+    def __lt__(self, other):
+        for key, otherKey, direction in zip(self.keys, other.keys, self.directions):
+            if key != otherKey:
+                return key < otherKey if direction > 0 else key > otherKey
+        return False
+
+
+def fieldSortKey(doc, field, direction):
+    """
+    Sort key of the given field of the document. Arrays are ordered by their smallest element
+    in ascending order and by their largest element in descending order.
+    """
+    values = resolve(doc, field)
+    if len(values) == 1 and not isinstance(values[0], list):
+        return sortKey(values[0])
+    keys = [sortKey(v) for value in values for v in (value if isinstance(value, list) else [value])]
+    if len(keys) == 0:
+        return sortKey(None)
+    return min(keys) if direction > 0 else max(keys)
+
+
+def sortDocuments(docs, sort, limit=None):
+    """
+    Sort the given documents given a list of (field, direction) tuples.
+    If only the first `limit` documents are needed, they are selected with a heap.
+    """
+    if limit is not None:
+        return heapq.nsmallest(limit, docs, key=lambda doc: SortKey(doc, sort))
+    return sorted(docs, key=lambda doc: SortKey(doc, sort))
+
+
+def _fieldValue(value, parts):
+    """
+    Value of a field path in an aggregation expression: arrays along the path give the array
+    of the values of the path in their elements.
+    """
+    for idx, part in enumerate(parts):
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list):
+            items = [_fieldValue(item, parts[idx:]) for item in value if isinstance(item, dict)]
+            return [item for item in items if item is not MISSING]
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def _arithmetic(args, op):
+    if any(arg is None or arg is MISSING for arg in args):
+        return None
+    for arg in args:
+        _number(arg, op)
+    if op == '$add':
+        return sum(args)
+    if op == '$multiply':
+        res = 1
+        for arg in args:
+            res *= arg
+        return res
+    a, b = args
+    if op == '$subtract':
+        return a - b
+    if op == '$divide':
+        return float(a) / b
+    if op == '$mod':
+        # the result has the sign of the dividend
+        if isinstance(a, float) or isinstance(b, float):
+            return math.fmod(a, b)
+        res = abs(a) % abs(b)
+        return -res if a < 0 else res
+    raise QueryException("Unsupported expression operator: %s" % op)
+
+
+def evaluate(doc, expr):
+    """
+    Evaluate an aggregation expression on the given document.
+    Returns MISSING if the expression refers to a field that doesn't exist.
+    """
+    if isinstance(expr, str):
+        if expr == '$$ROOT':
+            return doc
+        if expr.startswith('$$'):
+            raise QueryException("Unsupported variable: %s" % expr)
+        if expr.startswith('$'):
+            return _fieldValue(doc, expr[1:].split('.'))
+        return expr
+    if isinstance(expr, list):
+        return [evaluate(doc, item) for item in expr]
+    if not isinstance(expr, dict):
+        return expr
+    if len(expr) == 1 and next(iter(expr)).startswith('$'):
+        op, arg = next(iter(expr.items()))
+        if op == '$literal':
+            return arg
+        args = evaluate(doc, arg) if isinstance(arg, list) else [evaluate(doc, arg)]
+        if op in ('$add', '$multiply', '$subtract', '$divide', '$mod'):
+            return _arithmetic(args, op)
+        if op == '$size':
+            if not isinstance(args[0], list):
+                raise QueryException("The argument to $size must be an array")
+            return len(args[0])
+        if op == '$ifNull':
+            return args[0] if args[0] is not None and args[0] is not MISSING else args[1]
+        if op == '$cond':
+            if isinstance(arg, dict):
+                args = [evaluate(doc, arg['if']), evaluate(doc, arg['then']), evaluate(doc, arg['else'])]
+            return args[1] if args[0] not in (None, MISSING, False, 0) else args[2]
+        if op == '$concat':
+            if any(not isinstance(a, str) for a in args):
+                return None
+            return ''.join(args)
+        if op == '$toLower':
+            return '' if args[0] in (None, MISSING) else str(args[0]).lower()
+        if op == '$arrayElemAt':
+            array, idx = args
+            if not isinstance(array, list):
+                return None
+            return array[idx] if -len(array) <= idx < len(array) else MISSING
+        if op in ('$max', '$min'):
+            values = args[0] if len(args) == 1 and isinstance(args[0], list) else args
+            values = [v for v in values if v is not None and v is not MISSING]
+            if len(values) == 0:
+                return None
+            return (max if op == '$max' else min)(values, key=sortKey)
+        if op in ('$eq', '$ne', '$gt', '$gte', '$lt', '$lte'):
+            a, b = [sortKey(None if v is MISSING else v) for v in args]
+            return {'$eq': a == b, '$ne': a != b, '$gt': a > b, '$gte': a >= b,
+                    '$lt': a < b, '$lte': a <= b}[op]
+        if op == '$and':
+            return all(a not in (None, MISSING, False, 0) for a in args)
+        if op == '$or':
+            return any(a not in (None, MISSING, False, 0) for a in args)
+        if op == '$not':
+            return args[0] in (None, MISSING, False, 0)
+        raise QueryException("Unsupported expression operator: %s" % op)
+    res = {}
+    for key, value in expr.items():
+        value = evaluate(doc, value)
+        if value is not MISSING:
+            res[key] = value
+    return res
+
+
+def _isFlag(value):
+    return isinstance(value, (bool, int)) and value in (0, 1)
+
+
+def _projectStage(doc, spec):
+    includeId = True
+    inclusion = {}
+    computed = {}
+    for key, value in spec.items():
+        if key == '_id' and _isFlag(value):
+            includeId = bool(value)
+        elif _isFlag(value):
+            inclusion[key] = bool(value)
+        else:
+            computed[key] = value
+    if len(computed) == 0 and not any(inclusion.values()):
+        res = dict(doc)
+        for key in inclusion:
+            _unsetPath(res, key.split('.'))
+        if not includeId:
+            res.pop('_id', None)
+        return res
+    res = {}
+    if includeId and '_id' in doc:
+        res['_id'] = doc['_id']
+    for key in inclusion:
+        _copyPath(doc, res, key.split('.'))
+    for key, expr in computed.items():
+        value = evaluate(doc, expr)
+        if value is not MISSING:
+            container, k = _container(res, key)
+            container[k] = value
+    return res
+
+
+def _addFields(doc, spec):
+    res = dict(doc)
+    for key, expr in spec.items():
+        value = evaluate(doc, expr)
+        if value is not MISSING:
+            container, k = _container(res, key)
+            container[k] = value
+    return res
+
+
+def _unwind(docs, spec):
+    if isinstance(spec, str):
+        spec = {'path': spec}
+    path = spec['path'][1:]
+    indexField = spec.get('includeArrayIndex')
+    preserve = spec.get('preserveNullAndEmptyArrays', False)
+    for doc in docs:
+        value = _fieldValue(doc, path.split('.'))
+        if isinstance(value, list) and len(value) > 0:
+            for idx, item in enumerate(value):
+                res = copy.copy(doc)
+                container, key = _container(res, path)
+                container[key] = item
+                if indexField is not None:
+                    res[indexField] = idx
+                yield res
+        elif isinstance(value, list) or value is None or value is MISSING:
+            if preserve:
+                res = dict(doc)
+                if indexField is not None:
+                    res[indexField] = None
+                yield res
+        else:
+            res = dict(doc)
+            if indexField is not None:
+                res[indexField] = None
+            yield res
+
+
+def _group(docs, spec):
+    groups = {}
+    for doc in docs:
+        _id = evaluate(doc, spec['_id'])
+        if _id is MISSING:
+            _id = None
+        key = sortKey(_id)
+        if key not in groups:
+            groups[key] = {'_id': _id}
+            for field, acc in spec.items():
+                if field != '_id':
+                    groups[key][field] = {'values': [], 'n': 0}
+        group = groups[key]
+        for field, acc in spec.items():
+            if field == '_id':
+                continue
+            (op, expr), = acc.items()
+            value = evaluate(doc, expr)
+            group[field]['values'].append(value)
+    for key, group in groups.items():
+        res = {'_id': group['_id']}
+        for field, acc in spec.items():
+            if field == '_id':
+                continue
+            op = next(iter(acc))
+            values = group[field]['values']
+            present = [v for v in values if v is not None and v is not MISSING]
+            numbers = [v for v in present if typeOrder(v) == 2]
+            if op == '$sum':
+                res[field] = sum(numbers)
+            elif op == '$avg':
+                res[field] = float(sum(numbers)) / len(numbers) if len(numbers) > 0 else None
+            elif op == '$max':
+                res[field] = max(present, key=sortKey) if len(present) > 0 else None
+            elif op == '$min':
+                res[field] = min(present, key=sortKey) if len(present) > 0 else None
+            elif op == '$push':
+                res[field] = [v for v in values if v is not MISSING]
+            elif op == '$addToSet':
+                res[field] = list({sortKey(v): v for v in values if v is not MISSING}.values())
+            elif op == '$first':
+                res[field] = None if values[0] is MISSING else values[0]
+            elif op == '$last':
+                res[field] = None if values[-1] is MISSING else values[-1]
+            else:
+                raise QueryException("Unsupported accumulator: %s" % op)
+        yield res
+
+
+def _lookupStage(docs, spec, lookup):
+    docs = list(docs)
+    localField = spec['localField']
+    values = {}
+    for doc in docs:
+        for value in _candidates(resolve(doc, localField)):
+            values[sortKey(value)] = value
+    joined = {}
+    for foreign in lookup(spec['from'], spec['foreignField'], list(values.values())):
+        for value in _candidates(resolve(foreign, spec['foreignField'])):
+            joined.setdefault(sortKey(value), []).append(foreign)
+    for doc in docs:
+        found = []
+        seen = set()
+        for value in _candidates(resolve(doc, localField)):
+            for foreign in joined.get(sortKey(value), []):
+                if id(foreign) not in seen:
+                    seen.add(id(foreign))
+                    found.append(copy.deepcopy(foreign))
+        res = dict(doc)
+        res[spec['as']] = found
+        yield res
+
+
+def aggregate(docs, pipeline, lookup):
+    """
+    Run the given aggregation pipeline on the given iterable of documents, returns an iterator
+    over the results.
+    `lookup(collection, field, values)` is expected to return the documents of the given collection
+    whose `field` is one of the given values, it is used by the `$lookup` stages.
+    """
+    for idx, stage in enumerate(pipeline):
+        (name, spec), = stage.items()
+        # the stages are generators: the specs have to be bound now
+        if name == '$match':
+            docs = filter(partial(match, query=spec), docs)
+        elif name == '$project':
+            docs = map(partial(_projectStage, spec=spec), docs)
+        elif name == '$addFields':
+            docs = map(partial(_addFields, spec=spec), docs)
+        elif name == '$sort':
+            # a sort followed by a limit only keeps the documents that will be returned
+            limit = None
+            following = pipeline[idx + 1:idx + 3]
+            skip = following[0].get('$skip', 0) if len(following) > 0 else 0
+            for nextStage in following:
+                if '$limit' in nextStage:
+                    limit = skip + nextStage['$limit']
+                    break
+                if '$skip' not in nextStage:
+                    break
+            docs = iter(sortDocuments(docs, list(spec.items()), limit))
+        elif name == '$skip':
+            docs = islice(docs, spec, None)
+        elif name == '$limit':
+            docs = islice(docs, spec)
+        elif name == '$unwind':
+            docs = _unwind(docs, spec)
+        elif name == '$group':
+            docs = _group(docs, spec)
+        elif name == '$lookup':
+            docs = _lookupStage(docs, spec, lookup)
+        elif name == '$sample':
+            docs = list(docs)
+            docs = iter(random.sample(docs, min(spec['size'], len(docs))))
+        elif name == '$count':
+            count = sum(1 for doc in docs)
+            docs = iter([{spec: count}] if count > 0 else [])
+        elif name == '$facet':
+            docs = list(docs)
+            docs = iter([{
+                field: list(aggregate(docs, subPipeline, lookup))
+                for field, subPipeline in spec.items()
+            }])
+        else:
+            raise QueryException("Unsupported aggregation stage: %s" % name)
+    return docs
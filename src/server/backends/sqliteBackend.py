@@ -0,0 +1,646 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from itertools import islice
+from threading import RLock
+
+from bson import json_util
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, InsertOne, UpdateOne, UpdateMany, ReplaceOne, DeleteOne, DeleteMany
+from pymongo.errors import DuplicateKeyError, BulkWriteError, OperationFailure
+from pymongo.results import BulkWriteResult
+
+from server.backends import documents
+from tools.utils import timeFormat
+
+# SQLite limits the number of host parameters of a single query to 999
+MAX_QUERY_PARAMS = 900
+# number of documents loaded from the database at once when iterating over the results of a query
+LOAD_BATCH_SIZE = 100
+
+
+def _idKey(_id):
+    """
+    Value of the primary key of the document with the given _id.
+    """
+    if isinstance(_id, (ObjectId, str)):
+        return str(_id)
+    return json_util.dumps(_id)
+
+
+def _keyValue(value):
+    """
+    Value stored in the index table for the given value of an indexed field,
+    None if the value can't be looked up using the index.
+    """
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, (int, float, str)):
+        return value
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return None
+
+
+def _isIndexable(value):
+    return not isinstance(value, (dict, list)) and value is not None and _keyValue(value) is not None
+
+
+def _indexValues(doc, field):
+    """
+    Values of the given field of the document stored in the index table: the elements of arrays
+    are indexed separately, missing fields are indexed as NULL.
+    """
+    values = []
+    for value in documents.resolve(doc, field):
+        values += value if isinstance(value, list) else [value]
+    keys = [_keyValue(value) for value in values]
+    return keys if len(keys) > 0 else [None]
+
+
+class _Filter(object):
+    """
+    Translation of the parts of a query on indexed fields to a SQL condition. The condition selects
+    a superset of the documents matching the query, which are then tested one by one.
+    """
+    def __init__(self, keysTable, fields):
+        self._keysTable = keysTable
+        self._fields = fields
+        self.params = []
+
+    def _lookup(self, field, condition, params):
+        self.params += [field] + params
+        return 't.id IN (SELECT id FROM "%s" WHERE field = ? AND %s)' % (self._keysTable, condition)
+
+    def _field(self, field, cond):
+        """
+        Returns the list of SQL conditions for the given field condition of the query.
+        """
+        if field != '_id' and field not in self._fields:
+            return []
+        if not documents._isOperators(cond):
+            cond = {'$eq': cond}
+        clauses = []
+        for op, arg in cond.items():
+            if op == '$eq' and _isIndexable(arg):
+                if field == '_id':
+                    clauses.append('t.id = ?')
+                    self.params.append(_idKey(arg))
+                else:
+                    clauses.append(self._lookup(field, 'value = ?', [_keyValue(arg)]))
+            elif op == '$in' and len(arg) < MAX_QUERY_PARAMS and all(_isIndexable(a) for a in arg):
+                if len(arg) == 0:
+                    clauses.append('0')
+                elif field == '_id':
+                    clauses.append('t.id IN (%s)' % ', '.join('?' * len(arg)))
+                    self.params += [_idKey(a) for a in arg]
+                else:
+                    clauses.append(self._lookup(
+                        field, 'value IN (%s)' % ', '.join('?' * len(arg)), [_keyValue(a) for a in arg]))
+            elif op == '$all' and len(arg) > 0 and all(_isIndexable(a) for a in arg) and field != '_id':
+                clauses += [self._lookup(field, 'value = ?', [_keyValue(a)]) for a in arg]
+            elif op in ('$gt', '$gte', '$lt', '$lte') and isinstance(arg, (int, float, str)) \
+                    and not isinstance(arg, bool) and field != '_id':
+                sqlOp = {'$gt': '>', '$gte': '>=', '$lt': '<', '$lte': '<='}[op]
+                clauses.append(self._lookup(field, 'value %s ?' % sqlOp, [arg]))
+        return clauses
+
+    def translate(self, query):
+        """
+        Returns the SQL condition selecting the documents that may match the given query,
+        or None if any document may match.
+        """
+        clauses = []
+        for key, cond in (query or {}).items():
+            if key == '$and':
+                clauses += [c for c in (self.translate(q) for q in cond) if c is not None]
+            elif key == '$or':
+                params = list(self.params)
+                branches = [self.translate(q) for q in cond]
+                if len(branches) == 0 or any(b is None for b in branches):
+                    # one of the branches can match any document
+                    self.params = params
+                    continue
+                clauses.append('(%s)' % ' OR '.join(branches))
+            elif not key.startswith('$'):
+                clauses += self._field(key, cond)
+        if len(clauses) == 0:
+            return None
+        return '(%s)' % ' AND '.join(clauses)
+
+
+class SQLiteCursor(object):
+    """
+    Result of `SQLiteCollection.find`, mimics the `pymongo.cursor.Cursor` methods used by the services.
+    """
+    def __init__(self, collection, spec, projection=None, manipulate=True):
+        super(SQLiteCursor, self).__init__()
+        self._collection = collection
+        self._spec = spec or {}
+        self._projection = projection
+        self._manipulate = manipulate
+        self._sort = None
+        self._skip = 0
+        self._limit = 0
+        self._iterator = None
+
+    def sort(self, key_or_list, direction=None):
+        if isinstance(key_or_list, str):
+            self._sort = [(key_or_list, direction or ASCENDING)]
+        else:
+            self._sort = list(key_or_list)
+        return self
+
+    def skip(self, skip):
+        self._skip = skip
+        return self
+
+    def limit(self, limit):
+        self._limit = limit
+        return self
+
+    def count(self, with_limit_and_skip=False):
+        if not with_limit_and_skip:
+            return self._collection._count(self._spec)
+        return sum(1 for doc in self._collection._find(
+            self._spec, sort=self._sort, skip=self._skip, limit=self._limit))
+
+    def explain(self):
+        return self._collection.explain(self._spec, self._sort)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._iterator is None:
+            self._iterator = self._collection._find(
+                self._spec, self._projection, self._sort, self._skip, self._limit, self._manipulate)
+        return next(self._iterator)
+
+    next = __next__
+
+
+class SQLiteCollection(object):
+    """
+    Collection of documents stored in a table of the SQLite database, with the subset of the API
+    of `pymongo.collection.Collection` used by the services.
+    Documents are stored as extended JSON in a column of the table of the collection.
+    The fields given to `ensure_index` are indexed in a separate table holding one row per document
+    and per value of the field (one per element for arrays, like the MongoDB multikey indexes).
+    The parts of the queries on indexed fields are run by SQLite using this table, the results are then
+    filtered, sorted and aggregated in python (see `server.backends.documents`).
+    """
+    def __init__(self, database, name):
+        super(SQLiteCollection, self).__init__()
+        self.database = database
+        self.name = name
+        self._keysTable = '%s__keys' % name
+        # {name: {'fields': [field], 'unique': bool}}
+        self._indexes = {}
+        # indexed fields
+        self._fields = set()
+        with database._transaction() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS "%s" (id TEXT PRIMARY KEY, doc TEXT NOT NULL)' % name)
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS "%s" (field TEXT NOT NULL, value, id TEXT NOT NULL)'
+                % self._keysTable)
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS "%s_field_value_idx" ON "%s" (field, value)'
+                % (self._keysTable, self._keysTable))
+            connection.execute(
+                'CREATE INDEX IF NOT EXISTS "%s_id_field_idx" ON "%s" (id, field, value)'
+                % (self._keysTable, self._keysTable))
+            cursor = connection.execute(
+                'SELECT name, fields, isUnique FROM _indexes WHERE collection = ?', (name,))
+            for indexName, fields, unique in cursor.fetchall():
+                self._indexes[indexName] = {'fields': json.loads(fields), 'unique': bool(unique)}
+                self._fields.update(self._indexes[indexName]['fields'])
+
+    def _candidatesQuery(self, spec, sort=None):
+        """
+        Returns the tuple (sql, params, sorted): the SQL query selecting the ids of the documents that may
+        match the given query, its parameters, and whether the ids are selected in the order given by `sort`.
+        Documents are sorted by SQLite if all the sort fields are indexed, in insertion order otherwise.
+        """
+        sqlFilter = _Filter(self._keysTable, self._fields)
+        where = sqlFilter.translate(spec)
+        params = sqlFilter.params
+        if len(params) > MAX_QUERY_PARAMS:
+            where, params = None, []
+        sql = 'SELECT t.id FROM "%s" t' % self.name
+        if where is not None:
+            sql += ' WHERE ' + where
+        order = []
+        sortable = sort is not None and all(f == '_id' or f in self._fields for f, d in sort)
+        if sortable:
+            for field, direction in sort:
+                desc = ' DESC' if direction < 0 else ''
+                if field == '_id':
+                    order.append('t.id' + desc)
+                else:
+                    # arrays are ordered by their smallest element in ascending order,
+                    # and by their largest element in descending order
+                    order.append('(SELECT %s(value) FROM "%s" k WHERE k.id = t.id AND k.field = ?)%s'
+                                 % ('MAX' if direction < 0 else 'MIN', self._keysTable, desc))
+                    params.append(field)
+        order.append('t.rowid')
+        sql += ' ORDER BY ' + ', '.join(order)
+        return sql, params, sortable
+
+    def _candidates(self, spec, sort=None):
+        """
+        Returns the tuple (ids, sorted) where `ids` is the list of ids of the documents that may
+        match the given query, and `sorted` is True if they are in the order given by `sort`.
+        """
+        sql, params, sortable = self._candidatesQuery(spec, sort)
+        with self.database._lock:
+            ids = [row[0] for row in self.database._connection.execute(sql, params)]
+        return ids, sortable
+
+    def explain(self, spec, sort=None):
+        """
+        Returns how the given query is run: the SQL query selecting the candidate documents and its
+        plan (as given by `EXPLAIN QUERY PLAN`), the indexed fields, and whether the documents are sorted by SQLite.
+        """
+        sql, params, sortable = self._candidatesQuery(spec, sort)
+        with self.database._lock:
+            plan = [row[-1] for row in self.database._connection.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+        return {
+            'backend': 'sqlite',
+            'collection': self.name,
+            'sql': sql,
+            'plan': plan,
+            'indexedFields': sorted(self._fields),
+            'sortedBySQL': sortable
+        }
+
+    def _load(self, ids):
+        """
+        Returns a generator over the documents of the given ids, in the same order.
+        Documents are loaded by batches, as the generator is consumed.
+        """
+        for start in range(0, len(ids), LOAD_BATCH_SIZE):
+            chunk = ids[start:start + LOAD_BATCH_SIZE]
+            with self.database._lock:
+                rows = self.database._connection.execute(
+                    'SELECT id, doc FROM "%s" WHERE id IN (%s)' % (self.name, ', '.join('?' * len(chunk))),
+                    chunk).fetchall()
+            loaded = {_id: doc for _id, doc in rows}
+            for _id in chunk:
+                # the document may have been deleted in the meantime
+                if _id in loaded:
+                    yield json_util.loads(loaded[_id])
+
+    def _matching(self, spec, sort=None):
+        """
+        Returns the tuple (docs, sorted), where `docs` is a generator over the documents matching
+        the given query and `sorted` is True if they are in the order given by `sort`.
+        """
+        ids, sortedBySQL = self._candidates(spec, sort)
+        return (doc for doc in self._load(ids) if documents.match(doc, spec)), sortedBySQL
+
+    def _find(self, spec, projection=None, sort=None, skip=0, limit=0, manipulate=False):
+        docs, sortedBySQL = self._matching(spec, sort)
+        if sort is not None and not sortedBySQL:
+            docs = iter(documents.sortDocuments(docs, sort, skip + limit if limit > 0 else None))
+        for doc in islice(docs, skip, skip + limit if limit > 0 else None):
+            doc = documents.project(doc, projection)
+            if manipulate:
+                doc = self.database._outgoing(doc, self)
+            yield doc
+
+    def _count(self, spec):
+        if any(not key.startswith('$comment') for key in (spec or {})):
+            return sum(1 for doc in self._matching(spec)[0])
+        with self.database._lock:
+            return self.database._connection.execute('SELECT COUNT(*) FROM "%s"' % self.name).fetchone()[0]
+
+    def _indexRows(self, doc, fields):
+        _id = _idKey(doc['_id'])
+        return [(field, value, _id) for field in fields for value in _indexValues(doc, field)]
+
+    def _checkUnique(self, doc):
+        """
+        Raise a `DuplicateKeyError` if the given document has the same values as another document
+        for the fields of a unique index (the first value is used for array fields).
+        """
+        for name, index in self._indexes.items():
+            if not index['unique']:
+                continue
+            sql = 'SELECT id FROM "%s" WHERE id != ?' % self.name
+            params = [_idKey(doc['_id'])]
+            for field in index['fields']:
+                sql += ' AND id IN (SELECT id FROM "%s" WHERE field = ? AND value IS ?)' % self._keysTable
+                params += [field, _indexValues(doc, field)[0]]
+            if self.database._connection.execute(sql + ' LIMIT 1', params).fetchone() is not None:
+                raise DuplicateKeyError(
+                    "E11000 duplicate key error collection: %s index: %s dup key: %s"
+                    % (self.name, name, [_indexValues(doc, f)[0] for f in index['fields']]), 11000)
+
+    def _write(self, doc, new):
+        connection = self.database._connection
+        self._checkUnique(doc)
+        _id = _idKey(doc['_id'])
+        data = json_util.dumps(doc)
+        if new:
+            try:
+                connection.execute('INSERT INTO "%s" (id, doc) VALUES (?, ?)' % self.name, (_id, data))
+            except sqlite3.IntegrityError:
+                raise DuplicateKeyError(
+                    "E11000 duplicate key error collection: %s index: _id_ dup key: %s"
+                    % (self.name, _id), 11000)
+        else:
+            connection.execute('UPDATE "%s" SET doc = ? WHERE id = ?' % self.name, (data, _id))
+            connection.execute('DELETE FROM "%s" WHERE id = ?' % self._keysTable, (_id,))
+        connection.executemany(
+            'INSERT INTO "%s" (field, value, id) VALUES (?, ?, ?)' % self._keysTable,
+            self._indexRows(doc, self._fields))
+
+    def _delete(self, ids):
+        connection = self.database._connection
+        for start in range(0, len(ids), MAX_QUERY_PARAMS):
+            chunk = ids[start:start + MAX_QUERY_PARAMS]
+            placeholders = ', '.join('?' * len(chunk))
+            connection.execute('DELETE FROM "%s" WHERE id IN (%s)' % (self.name, placeholders), chunk)
+            connection.execute('DELETE FROM "%s" WHERE id IN (%s)' % (self._keysTable, placeholders), chunk)
+
+    def _insert(self, docs):
+        for doc in docs:
+            if '_id' not in doc:
+                doc['_id'] = ObjectId()
+            self._write(doc, new=True)
+        return [doc['_id'] for doc in docs]
+
+    def _update(self, spec, document, upsert=False, multi=False):
+        """
+        Returns the tuple (matched, modified, upsertedId).
+        """
+        matched = modified = 0
+        for doc in self._matching(spec)[0]:
+            matched += 1
+            if documents.applyUpdate(doc, document):
+                self._write(doc, new=False)
+                modified += 1
+            if not multi:
+                break
+        if matched == 0 and upsert:
+            doc = documents.upsertDocument(spec)
+            documents.applyUpdate(doc, document, inserting=True)
+            return 0, 0, self._insert([doc])[0]
+        return matched, modified, None
+
+    def _remove(self, spec, multi=True):
+        if not multi:
+            docs = islice(self._matching(spec)[0], 1)
+        elif any(not key.startswith('$comment') for key in spec):
+            docs = self._matching(spec)[0]
+        else:
+            with self.database._lock:
+                n = self._count({})
+                self.database._connection.execute('DELETE FROM "%s"' % self.name)
+                self.database._connection.execute('DELETE FROM "%s"' % self._keysTable)
+            return n
+        ids = [_idKey(doc['_id']) for doc in docs]
+        self._delete(ids)
+        return len(ids)
+
+    def find(self, spec=None, projection=None, **kwargs):
+        return SQLiteCursor(self, spec, projection)
+
+    def find_one(self, spec=None, projection=None, sort=None, **kwargs):
+        if spec is not None and not isinstance(spec, dict):
+            spec = {'_id': spec}
+        cursor = self.find(spec, projection).limit(1)
+        if sort is not None:
+            cursor.sort(sort)
+        return next(cursor, None)
+
+    def find_one_and_delete(self, filter, projection=None, sort=None, **kwargs):
+        with self.database._transaction():
+            doc = next(self._find(filter, sort=sort, limit=1), None)
+            if doc is None:
+                return None
+            self._delete([_idKey(doc['_id'])])
+        return documents.project(doc, projection)
+
+    def count(self, spec=None, **kwargs):
+        return self._count(spec)
+
+    def insert(self, doc_or_docs, **kwargs):
+        docs = doc_or_docs if isinstance(doc_or_docs, list) else [doc_or_docs]
+        with self.database._transaction():
+            ids = self._insert(docs)
+        return ids if isinstance(doc_or_docs, list) else ids[0]
+
+    def update(self, spec, document, upsert=False, multi=False, **kwargs):
+        with self.database._transaction():
+            matched, modified, upserted = self._update(spec, document, upsert, multi)
+        res = {'n': matched, 'nModified': modified, 'updatedExisting': matched > 0, 'ok': 1.0}
+        if upserted is not None:
+            res['n'] = 1
+            res['upserted'] = upserted
+        return res
+
+    def remove(self, spec_or_id=None, multi=True, **kwargs):
+        if spec_or_id is None:
+            spec_or_id = {}
+        if not isinstance(spec_or_id, dict):
+            spec_or_id = {'_id': spec_or_id}
+        with self.database._transaction():
+            n = self._remove(spec_or_id, multi)
+        return {'n': n, 'ok': 1.0}
+
+    def bulk_write(self, requests, ordered=True, **kwargs):
+        """
+        Run the given `pymongo` write operations in a single transaction. As with MongoDB,
+        the operations preceding a failed one are still applied. A `BulkWriteError` is raised after all
+        the operations have been attempted (`ordered=False`) or after the first failed one (`ordered=True`).
+        """
+        res = {'writeErrors': [], 'writeConcernErrors': [], 'nInserted': 0, 'nUpserted': 0,
+               'nMatched': 0, 'nModified': 0, 'nRemoved': 0, 'upserted': []}
+        with self.database._transaction():
+            for idx, op in enumerate(requests):
+                try:
+                    if isinstance(op, InsertOne):
+                        self._insert([op._doc])
+                        res['nInserted'] += 1
+                    elif isinstance(op, (UpdateOne, UpdateMany, ReplaceOne)):
+                        matched, modified, upserted = self._update(
+                            op._filter, op._doc, op._upsert, multi=isinstance(op, UpdateMany))
+                        res['nMatched'] += matched
+                        res['nModified'] += modified
+                        if upserted is not None:
+                            res['nUpserted'] += 1
+                            res['upserted'].append({'index': idx, '_id': upserted})
+                    elif isinstance(op, (DeleteOne, DeleteMany)):
+                        res['nRemoved'] += self._remove(op._filter, multi=isinstance(op, DeleteMany))
+                    else:
+                        raise documents.QueryException("Unsupported bulk operation: %r" % op)
+                except (DuplicateKeyError, documents.QueryException) as e:
+                    res['writeErrors'].append({
+                        'index': idx,
+                        'code': getattr(e, 'code', None),
+                        'errmsg': str(e),
+                        'op': op
+                    })
+                    if ordered:
+                        break
+        if len(res['writeErrors']) > 0:
+            raise BulkWriteError(res)
+        return BulkWriteResult(res, True)
+
+    def _lookup(self, collection, field, values):
+        """
+        Documents of the given collection whose `field` is one of the given values (see `documents.aggregate`).
+        """
+        collection = self.database[collection]
+        for start in range(0, len(values), MAX_QUERY_PARAMS // 2):
+            chunk = values[start:start + MAX_QUERY_PARAMS // 2]
+            for doc in collection._find({field: {'$in': chunk}}):
+                yield doc
+
+    def aggregate(self, pipeline, **kwargs):
+        """
+        Run the given aggregation pipeline, the leading `$match` stages are used to select
+        the documents using the indexes.
+        """
+        matches = []
+        for stage in pipeline:
+            if '$match' not in stage:
+                break
+            matches.append(stage['$match'])
+        docs = self._matching({'$and': matches})[0]
+        return documents.aggregate(docs, pipeline[len(matches):], self._lookup)
+
+    def ensure_index(self, key_or_list, name=None, unique=False, **kwargs):
+        if isinstance(key_or_list, str):
+            key_or_list = [(key_or_list, ASCENDING)]
+        fields = [field for field, direction in key_or_list]
+        name = name or '_'.join('%s_%s' % (field, direction) for field, direction in key_or_list)
+        index = {'fields': fields, 'unique': bool(unique)}
+        if self._indexes.get(name) == index:
+            return name
+        newFields = [field for field in fields if field not in self._fields]
+        with self.database._transaction() as connection:
+            connection.execute(
+                'INSERT OR REPLACE INTO _indexes (collection, name, fields, isUnique) VALUES (?, ?, ?, ?)',
+                (self.name, name, json.dumps(fields), int(bool(unique))))
+            start = time.time()
+            rows = connection.execute('SELECT doc FROM "%s"' % self.name).fetchall() if len(newFields) > 0 else []
+            for row in rows:
+                connection.executemany(
+                    'INSERT INTO "%s" (field, value, id) VALUES (?, ?, ?)' % self._keysTable,
+                    self._indexRows(json_util.loads(row[0]), newFields))
+            if len(rows) > 0:
+                logging.info("Indexed fields %s of %d documents of collection %s in %s"
+                             % (', '.join(newFields), len(rows), self.name, timeFormat(time.time() - start)))
+            self._indexes[name] = index
+            self._fields.update(newFields)
+        return name
+
+    create_index = ensure_index
+
+    def index_information(self):
+        return {name: {'key': [(field, ASCENDING) for field in index['fields']], 'unique': index['unique']}
+                for name, index in self._indexes.items()}
+
+    def drop_index(self, name):
+        if name not in self._indexes:
+            raise OperationFailure("index not found with name [%s]" % name)
+        with self.database._transaction() as connection:
+            connection.execute('DELETE FROM _indexes WHERE collection = ? AND name = ?', (self.name, name))
+            del self._indexes[name]
+            fields = set(field for index in self._indexes.values() for field in index['fields'])
+            for field in self._fields - fields:
+                connection.execute('DELETE FROM "%s" WHERE field = ?' % self._keysTable, (field,))
+            self._fields = fields
+
+
+class SQLiteDatabase(object):
+    """
+    Embedded storage backend: a SQLite database file, holding one table per collection.
+    Collections are retrieved with `db[<name>]`, like with a `pymongo.database.Database`,
+    and provide the same methods as the MongoDB collections for the queries of the services.
+    """
+    def __init__(self, dbPath):
+        super(SQLiteDatabase, self).__init__()
+        dirPath = os.path.dirname(dbPath)
+        if dirPath and not os.path.exists(dirPath):
+            os.makedirs(dirPath)
+        # the connection is shared by all threads of the server, access is serialized by the lock
+        self._lock = RLock()
+        # depth of the nested transactions, only the outermost one commits
+        self._depth = 0
+        self._connection = sqlite3.connect(dbPath, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._manipulators = []
+        self._collections = {}
+        with self._transaction() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS _indexes ('
+                'collection TEXT NOT NULL, name TEXT NOT NULL, fields TEXT NOT NULL, isUnique INTEGER, '
+                'PRIMARY KEY (collection, name))')
+
+    @contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._depth += 1
+            try:
+                yield self._connection
+                if self._depth == 1:
+                    self._connection.commit()
+            except:
+                if self._depth == 1:
+                    self._connection.rollback()
+                raise
+            finally:
+                self._depth -= 1
+
+    def __getitem__(self, name):
+        with self._lock:
+            if name not in self._collections:
+                self._collections[name] = SQLiteCollection(self, name)
+            return self._collections[name]
+
+    def add_son_manipulator(self, manipulator):
+        """
+        Add a manipulator applied to the documents returned by `find` and `find_one`
+        (not to the results of the aggregations), as with MongoDB.
+        """
+        self._manipulators.append(manipulator)
+
+    def command(self, command, value, pipeline=None, explain=False, **kwargs):
+        """
+        Only the explanation of aggregations is supported:
+        `command('aggregate', <collection>, pipeline=<pipeline>, explain=True)`
+        """
+        if command != 'aggregate' or not explain:
+            raise documents.QueryException("Unsupported command: %s" % command)
+        matches = []
+        for stage in pipeline:
+            if '$match' not in stage:
+                break
+            matches.append(stage['$match'])
+        res = self[value].explain({'$and': matches})
+        res['stages'] = [list(stage)[0] for stage in pipeline[len(matches):]]
+        return res
+
+    def _outgoing(self, doc, collection):
+        for manipulator in self._manipulators:
+            doc = manipulator.transform_outgoing(doc, collection)
+        return doc
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
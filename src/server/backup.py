@@ -0,0 +1,256 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import gzip
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+import time
+from datetime import datetime
+from threading import Thread, Event, Lock
+
+from bson import json_util
+
+from tools.utils import dateFormat, sizeFormat, timeFormat
+
+# name of the folders of the dumps, also gives their chronological order
+DUMP_FOLDER_FORMAT = '%Y-%m-%d_%H-%M-%S'
+DUMP_FOLDER_RE = re.compile(r'^\d{4}-\d{2}-\d{2}_\d{2}-\d{2}-\d{2}$')
+# number of documents inserted at once when restoring a dump
+RESTORE_BATCH_SIZE = 1000
+# delay (in seconds) before a failed dump is attempted again
+RETRY_DELAY = 60 * 60
+
+
+class BackupScheduler(Thread):
+    """
+    Background thread dumping the collections of the database every `delay` seconds.
+    Each dump is a folder holding one gzipped file per collection, with one document
+    (in MongoDB extended JSON) per line. The file of a collection that did not change since
+    the previous dump is a hard link to the file of the previous dump instead of a new copy.
+    Only the `retention` most recent dumps are kept.
+    The status of the last dump is saved in the file `status.json` of the dumps folder,
+    so that the delay between two dumps is respected across restarts.
+    Documents are read with the backend's `aggregate`, whatever the storage backend, and the dumps
+    can be restored with `restore`.
+    """
+    def __init__(self, db, collections, conf):
+        """
+        * `db`: the database, as given to the services
+        * `collections`: names of the collections to dump
+        * `conf`: the backup configuration, see `Conf['data']['backup']`
+        """
+        super(BackupScheduler, self).__init__(name='BackupScheduler')
+        self.daemon = True
+        self._db = db
+        self._collections = collections
+        self._folder = conf['folder']
+        self._delay = conf['delay']
+        self._retention = conf['retention']
+        self._startDelay = conf['startDelay']
+        self._lock = Lock()
+        # set to interrupt the wait for the next dump
+        self._wake = Event()
+        self._stopping = False
+        self._requested = False
+        self._state = 'starting'
+        self._nextDump = None
+        self._lastError = None
+        self._status = self._readStatus()
+
+    def _statusFile(self):
+        return os.path.join(self._folder, 'status.json')
+
+    def _readStatus(self):
+        try:
+            with open(self._statusFile(), 'r') as f:
+                return json.load(f)
+        except Exception:
+            return None
+
+    def status(self):
+        """
+        Returns the status of the backups: state of the scheduler ('starting', 'waiting',
+        'running' or 'stopped'), time of the next dump, last dump, last error and available dumps.
+        """
+        with self._lock:
+            return {
+                'state': self._state,
+                'nextDump': self._nextDump,
+                'nextDumpForHumans': dateFormat(self._nextDump) if self._nextDump is not None else None,
+                'lastDump': self._status,
+                'lastError': self._lastError,
+                'dumps': self._dumps()
+            }
+
+    def request(self):
+        """
+        Ask for a dump to be made as soon as possible, without waiting for the delay to expire.
+        """
+        with self._lock:
+            self._requested = True
+        self._wake.set()
+
+    def stop(self):
+        """
+        Stop the scheduler. A dump in progress is interrupted after the collection being dumped.
+        """
+        with self._lock:
+            self._stopping = True
+            self._state = 'stopped'
+        self._wake.set()
+
+    def _setState(self, state, nextDump=None):
+        with self._lock:
+            if not self._stopping:
+                self._state = state
+            self._nextDump = nextDump
+
+    def run(self):
+        # leave the server some time to serve its first requests
+        self._setState('starting', time.time() + self._startDelay)
+        self._wake.wait(self._startDelay)
+        while not self._stopping:
+            self._wake.clear()
+            lastDump = self._status['lastDump'] if self._status is not None else 0
+            due = lastDump + self._delay
+            with self._lock:
+                requested = self._requested
+                self._requested = False
+                if self._lastError is not None:
+                    due = max(due, self._lastError['time'] + RETRY_DELAY)
+            if requested or time.time() >= due:
+                self._setState('running')
+                self.dump()
+                continue
+            self._setState('waiting', due)
+            logging.info("Next database dump on %s" % dateFormat(due))
+            self._wake.wait(due - time.time())
+        self._setState('stopped')
+
+    def _dumps(self):
+        """
+        Returns the sorted list of the names of the dump folders.
+        """
+        if not os.path.isdir(self._folder):
+            return []
+        return sorted(name for name in os.listdir(self._folder)
+                      if DUMP_FOLDER_RE.match(name) and os.path.isdir(os.path.join(self._folder, name)))
+
+    def _dumpCollection(self, name, dirPath, previous):
+        """
+        Dump the given collection in a gzipped file of the folder `dirPath`. `previous` is the
+        status of the dump of this collection in the previous dump, if any.
+        Returns the status of this dump.
+        """
+        path = os.path.join(dirPath, '%s.json.gz' % name)
+        digest = hashlib.sha1()
+        nb = 0
+        with gzip.open(path + '.tmp', 'wb') as f:
+            # unlike `find`, `aggregate` returns the documents unchanged by the son manipulators
+            for doc in self._db[name].aggregate([{'$match': {}}], allowDiskUse=True, cursor={}):
+                line = (json_util.dumps(doc) + '\n').encode('utf8')
+                digest.update(line)
+                f.write(line)
+                nb += 1
+        res = {'documents': nb, 'sha1': digest.hexdigest(), 'file': path, 'linked': False}
+        if previous is not None and previous['sha1'] == res['sha1'] and os.path.exists(previous['file']):
+            try:
+                os.link(previous['file'], path)
+                os.remove(path + '.tmp')
+                res['linked'] = True
+            except OSError as e:
+                logging.warning("Unable to link %s to the previous dump: %s" % (name, repr(e)))
+        if not res['linked']:
+            os.rename(path + '.tmp', path)
+        res['size'] = os.path.getsize(path)
+        return res
+
+    def dump(self):
+        """
+        Create a new dump of the collections, then delete the dumps exceeding the retention.
+        """
+        start = time.time()
+        dirPath = os.path.join(self._folder, datetime.fromtimestamp(int(start)).strftime(DUMP_FOLDER_FORMAT))
+        previous = self._status.get('collections', {}) if self._status is not None else {}
+        logging.info("Dumping database into folder: %s" % dirPath)
+        try:
+            os.makedirs(dirPath)
+            collections = {}
+            for name in self._collections:
+                if self._stopping:
+                    raise Exception("Backups stopped before the end of the dump")
+                collections[name] = self._dumpCollection(name, dirPath, previous.get(name))
+        except Exception as e:
+            logging.error("Unable to perform the dump, an error occured.")
+            logging.exception(e)
+            shutil.rmtree(dirPath, ignore_errors=True)
+            with self._lock:
+                self._lastError = {'time': time.time(), 'dateForHumans': dateFormat(time.time()), 'error': repr(e)}
+            return
+
+        size = sum(c['size'] for c in collections.values())
+        stored = sum(c['size'] for c in collections.values() if not c['linked'])
+        self._writeStatus({
+            'lastDump': start,
+            'dateForHumans': dateFormat(start),
+            'duration': time.time() - start,
+            'size': size,
+            'sizeForHumans': sizeFormat(size),
+            'storedSize': stored,
+            'folder': dirPath,
+            'collections': collections
+        })
+        with self._lock:
+            self._lastError = None
+        logging.info("Dump successfully done in %s (%s, %s of new data)"
+                     % (timeFormat(time.time() - start), sizeFormat(size), sizeFormat(stored)))
+        self._applyRetention()
+
+    def _writeStatus(self, status):
+        with open(self._statusFile() + '.tmp', 'w') as f:
+            json.dump(status, f)
+        if os.path.exists(self._statusFile()):
+            os.remove(self._statusFile())
+        os.rename(self._statusFile() + '.tmp', self._statusFile())
+        with self._lock:
+            self._status = status
+
+    def _applyRetention(self):
+        dumps = self._dumps()
+        for name in dumps[:max(0, len(dumps) - self._retention)]:
+            logging.info("Deleting old dump: %s" % name)
+            shutil.rmtree(os.path.join(self._folder, name), ignore_errors=True)
+
+
+def restore(db, dirPath, collections=None):
+    """
+    Restore the collections dumped in the given folder by a `BackupScheduler` (all of them by default).
+    The current documents of these collections are deleted.
+    """
+    for filename in sorted(os.listdir(dirPath)):
+        if not filename.endswith('.json.gz'):
+            continue
+        name = filename[:-len('.json.gz')]
+        if collections is not None and name not in collections:
+            continue
+        logging.info("Restoring collection %s" % name)
+        collection = db[name]
+        collection.remove({})
+        batch = []
+        nb = 0
+        with gzip.open(os.path.join(dirPath, filename), 'rb') as f:
+            for line in f:
+                batch.append(json_util.loads(line.decode('utf8')))
+                if len(batch) >= RESTORE_BATCH_SIZE:
+                    collection.insert(batch)
+                    nb += len(batch)
+                    batch = []
+        if len(batch) > 0:
+            collection.insert(batch)
+            nb += len(batch)
+        logging.info("Restored %d documents in collection %s" % (nb, name))
@@ -0,0 +1,104 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import json
+import logging
+import os
+import sqlite3
+from threading import Lock
+
+from conf import Conf
+
+# SQLite limits the number of host parameters of a single query to 999
+MAX_QUERY_PARAMS = 900
+
+
+class FaceStore(object):
+    """
+    Indexed storage of the face annotations of album pictures, backed by a SQLite database.
+    Annotations are indexed by picture path (relative to the albums root folder, as in
+    `fullPath + filename`), which allows to retrieve the annotations of a whole page of pictures
+    with a single query instead of opening one annotation cache file per picture.
+    """
+    def __init__(self, dbPath):
+        super(FaceStore, self).__init__()
+        dirPath = os.path.dirname(dbPath)
+        if dirPath and not os.path.exists(dirPath):
+            os.makedirs(dirPath)
+        # the connection is shared by all threads of the server, access is serialized by the lock
+        self._lock = Lock()
+        self._connection = sqlite3.connect(dbPath, check_same_thread=False)
+        with self._lock, self._connection:
+            self._connection.execute(
+                'CREATE TABLE IF NOT EXISTS faces ('
+                'path TEXT PRIMARY KEY, version TEXT, faces TEXT NOT NULL)')
+
+    def get(self, paths):
+        """
+        Returns a dict {path: faces} for each of the given picture paths found in the store.
+        """
+        paths = list(paths)
+        found = {}
+        with self._lock:
+            for start in range(0, len(paths), MAX_QUERY_PARAMS):
+                chunk = paths[start:start + MAX_QUERY_PARAMS]
+                cursor = self._connection.execute(
+                    'SELECT path, faces FROM faces WHERE path IN (%s)'
+                    % ', '.join('?' * len(chunk)), chunk)
+                for path, faces in cursor:
+                    found[path] = json.loads(faces)
+        return found
+
+    def put(self, items, version=None):
+        """
+        Save the face annotations of the given pictures.
+        `items` is expected to be an iterable of `(path, faces)` tuples.
+        Existing annotations for the same pictures are replaced.
+        """
+        rows = [(path, version, json.dumps(faces)) for path, faces in items]
+        if len(rows) == 0:
+            return
+        with self._lock, self._connection:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO faces (path, version, faces) VALUES (?, ?, ?)', rows)
+        logging.debug("Saved face annotations of %d pictures", len(rows))
+
+    def delete(self, paths):
+        paths = list(paths)
+        with self._lock, self._connection:
+            for start in range(0, len(paths), MAX_QUERY_PARAMS):
+                chunk = paths[start:start + MAX_QUERY_PARAMS]
+                self._connection.execute(
+                    'DELETE FROM faces WHERE path IN (%s)' % ', '.join('?' * len(chunk)), chunk)
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+# this module is a singleton
+_instance = None
+
+_lock = Lock()
+
+def getInstance():
+    global _instance
+    global _lock
+    if _instance is None:
+        with _lock:
+            # re-test the _instance value, avoiding the case where another
+            # thread did the initialization between the previous test and the
+            # lock
+            if _instance is None:
+                _instance = FaceStore(Conf['data']['albums']['faceStorePath'])
+    return _instance
+
+def get(paths):
+    return getInstance().get(paths)
+
+def put(items, version=None):
+    return getInstance().put(items, version)
+
+def delete(paths):
+    return getInstance().delete(paths)
@@ -2,25 +2,180 @@
 
 from __future__ import unicode_literals
 
+import copy
+import time
+from collections import OrderedDict
 from threading import Lock
 from functools import wraps
 
 
+class Cache(object):
+    """
+    Thread-safe cache of a namespace of the memory.
+    Entries expire `ttl` seconds after they have been set (never if `ttl` is None),
+    and the least recently used entries are evicted when the cache holds more than `maxSize`
+    entries (no limit if `maxSize` is None). If `sizeOf` is given, `maxSize` is the maximum
+    total size of the values instead, as given by `sizeOf(value)` (e.g. `len` for bytes).
+    """
+    def __init__(self, namespace, ttl=None, maxSize=None, sizeOf=None):
+        super(Cache, self).__init__()
+        self.namespace = namespace
+        self.ttl = ttl
+        self.maxSize = maxSize
+        self._sizeOf = sizeOf or (lambda value: 1)
+        self._lock = Lock()
+        # {key: (expiration time or None, value, size)}, least recently used first
+        self._entries = OrderedDict()
+        # total size of the entries
+        self._size = 0
+        # {key: [lock, number of threads using the lock]}, see `getOrCompute`
+        self._keyLocks = {}
+        # incremented on each invalidation, so that values computed meanwhile are not stored
+        self._generation = 0
+        self._stats = {'hits': 0, 'misses': 0, 'loads': 0, 'loadTime': 0.0, 'evictions': 0, 'expirations': 0}
+
+    def _lookup(self, key, count=True):
+        """
+        Returns the tuple (found, value). Must be called with the lock acquired.
+        """
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] is not None and entry[0] <= time.time():
+            self._remove(key)
+            self._stats['expirations'] += 1
+            entry = None
+        if count:
+            self._stats['hits' if entry is not None else 'misses'] += 1
+        if entry is None:
+            return False, None
+        self._entries.move_to_end(key)
+        return True, entry[1]
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[2]
+
+    def _store(self, key, value, ttl):
+        ttl = self.ttl if ttl is None else ttl
+        self._remove(key)
+        size = self._sizeOf(value)
+        if self.maxSize is not None and size > self.maxSize:
+            return  # would evict all the other entries
+        self._entries[key] = (time.time() + ttl if ttl is not None else None, value, size)
+        self._size += size
+        while self.maxSize is not None and self._size > self.maxSize:
+            self._remove(next(iter(self._entries)))
+            self._stats['evictions'] += 1
+
+    def get(self, key, default=None):
+        with self._lock:
+            found, value = self._lookup(key)
+        return value if found else default
+
+    def set(self, key, value, ttl=None):
+        """
+        Set the value of the given key, `ttl` overrides the ttl of the cache for this entry.
+        """
+        with self._lock:
+            self._store(key, value, ttl)
+
+    def getOrCompute(self, key, compute, ttl=None):
+        """
+        Returns the value of the given key, computed by calling `compute()` (and stored) if it is
+        not in the cache. When several threads ask for the same missing key, only one of them
+        computes the value, the others wait for it.
+        """
+        with self._lock:
+            found, value = self._lookup(key)
+            if found:
+                return value
+            keyLock = self._keyLocks.setdefault(key, [Lock(), 0])
+            keyLock[1] += 1
+        try:
+            with keyLock[0]:
+                with self._lock:
+                    # the value may have been computed by another thread meanwhile
+                    found, value = self._lookup(key, count=False)
+                    generation = self._generation
+                if found:
+                    return value
+                start = time.time()
+                value = compute()
+                with self._lock:
+                    self._stats['loads'] += 1
+                    self._stats['loadTime'] += time.time() - start
+                    if generation == self._generation:
+                        self._store(key, value, ttl)
+                return value
+        finally:
+            with self._lock:
+                keyLock[1] -= 1
+                if keyLock[1] == 0:
+                    del self._keyLocks[key]
+
+    def invalidate(self, *keys):
+        """
+        Remove the given keys from the cache.
+        """
+        with self._lock:
+            self._generation += 1
+            for key in keys:
+                self._remove(key)
+
+    def clear(self):
+        """
+        Remove all the entries of the cache.
+        """
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._size = 0
+
+    def stats(self):
+        with self._lock:
+            stats = dict(self._stats, entries=len(self._entries), size=self._size, maxSize=self.maxSize, ttl=self.ttl)
+        lookups = stats['hits'] + stats['misses']
+        stats['hitRatio'] = float(stats['hits']) / lookups if lookups > 0 else None
+        return stats
+
+
 class Memory(object):
     """
     A singleton containing all the memory items shared by
-    all threads of the server.
+    all threads of the server, and the caches of the server (see `getCache`).
     """
     def __init__(self):
         super(Memory, self).__init__()
+        self._lock = Lock()
         self._memory = {}
+        self._caches = {}
 
     def setVal(self, mid, value):
-        self._memory[mid] = value
+        with self._lock:
+            self._memory[mid] = value
 
     def getVal(self, mid):
-        if mid in self._memory:
-            return self._memory[mid]
+        with self._lock:
+            if mid in self._memory:
+                return self._memory[mid]
+
+    def getCache(self, namespace, ttl=None, maxSize=None, sizeOf=None):
+        """
+        Returns the cache of the given namespace, created with the given `ttl`, `maxSize`
+        and `sizeOf` (see `Cache`) if it doesn't exist yet.
+        """
+        with self._lock:
+            if namespace not in self._caches:
+                self._caches[namespace] = Cache(namespace, ttl, maxSize, sizeOf)
+            return self._caches[namespace]
+
+    def getStats(self):
+        """
+        Returns the statistics of all the caches, {namespace: stats}.
+        """
+        with self._lock:
+            caches = list(self._caches.values())
+        return {cache.namespace: cache.stats() for cache in caches}
 
 # this module is a singleton
 _instance = None
@@ -54,3 +209,32 @@ def singletonize(method):
 
 getVal = singletonize(Memory.getVal)
 setVal = singletonize(Memory.setVal)
+getCache = singletonize(Memory.getCache)
+getStats = singletonize(Memory.getStats)
+
+
+def memoize(namespace, ttl=None, maxSize=None, copyResults=False):
+    """
+    Decorator caching the results of a method of a service in the cache of the given namespace,
+    by arguments (the instance is not part of the key: services are singletons).
+    Arguments have to be hashable. If `copyResults` is True, callers get a deep copy of the cached
+    value and can modify it.
+    The decorated method has the attributes `invalidate(*args, **kwargs)`, removing the result
+    of the call with the given arguments, and `clear()`, removing all the results. They are
+    to be called by the methods modifying the data the results depend on.
+    """
+    def decorator(method):
+        def key(args, kwargs):
+            return (args, tuple(sorted(kwargs.items())))
+
+        @wraps(method)
+        def wrapper(self, *args, **kwargs):
+            value = getCache(namespace, ttl, maxSize).getOrCompute(
+                key(args, kwargs), lambda: method(self, *args, **kwargs))
+            return copy.deepcopy(value) if copyResults else value
+
+        wrapper.invalidate = lambda *args, **kwargs: \
+            getCache(namespace, ttl, maxSize).invalidate(key(args, kwargs))
+        wrapper.clear = lambda: getCache(namespace, ttl, maxSize).clear()
+        return wrapper
+    return decorator
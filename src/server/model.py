@@ -5,22 +5,24 @@ from __future__ import unicode_literals
 import logging
 import sys
 import os
-import json
-import time
-from datetime import datetime
 from threading import Thread
 import subprocess
 from threading import Lock
+from functools import wraps
+from concurrent.futures import ThreadPoolExecutor
 from pymongo import MongoClient, database
 from pymongo.errors import ConnectionFailure
 from pymongo.son_manipulator import SONManipulator
 
 from conf import Conf
+from server.backends.sqliteBackend import SQLiteDatabase
+from server.backup import BackupScheduler, restore
 from server.services.baseService import Service
 from server.services.videoService import VideoService
 from server.services.tagService import TagService
 from server.services.albumService import AlbumService
-from tools.utils import dateFormat, sizeFormat, getFolderSize
+from server.services.historyService import HistoryService
+from server.services.pictureService import PictureService
 
 class ObjectIdManipulator(SONManipulator):
     def transform_outgoing(self, son, collection):
@@ -33,6 +35,30 @@ class ModelException(Exception):
     pass
 
 
+class AsyncService(object):
+    """
+    Wraps a service so that each of its methods is run on the thread pool of the model
+    and returns a `concurrent.futures.Future` (that Tornado coroutines can yield) instead
+    of blocking the calling thread.
+    Methods returning cursors or generators should be called with the parameters making them
+    return lists, so that the documents are not fetched on the calling thread.
+    """
+    def __init__(self, service, executor):
+        super(AsyncService, self).__init__()
+        self._service = service
+        self._executor = executor
+
+    def __getattr__(self, name):
+        method = getattr(self._service, name)
+        if not callable(method):
+            return method
+
+        @wraps(method)
+        def submit(*args, **kwargs):
+            return self._executor.submit(method, *args, **kwargs)
+        return submit
+
+
 class MongoServerProcess(Thread):
     def __init__(self):
         super(MongoServerProcess, self).__init__()
@@ -66,12 +92,47 @@ class Model(object):
     It is used to retrieve text to be used by the nlp algorithm from the loops
     collection and to cache items like account list, locations or
     generated reports
-    It manages its own back-up system by creating DB dumps every week
-    (or any configured delay)
+    It manages its own back-up system by creating DB dumps every day
+    (or any configured delay) on a background thread, see `startBackups`.
+    The data can also be stored in an embedded SQLite database instead of a MongoDB server,
+    see `Conf['data']['backend']` and `server.backends`.
     """
     def __init__(self):
         super(Model, self).__init__()
         self._server_process = None
+        self._connection = None
+        self._backend = Conf['data']['backend']
+        if self._backend == 'sqlite':
+            logging.info("Opening SQLite database: %s" % Conf['data']['sqlite']['path'])
+            self._db = SQLiteDatabase(Conf['data']['sqlite']['path'])
+        elif self._backend == 'mongoDB':
+            self._connectMongoDB()
+            self._db = self._connection[Conf['data']['mongoDB']['dbName']]
+        else:
+            raise ModelException("Unknown storage backend: %s" % self._backend)
+
+        self._executor = ThreadPoolExecutor(max_workers=Conf['data']['workers'])
+        self._db.add_son_manipulator(ObjectIdManipulator())
+
+        history = HistoryService(self._db)
+        pictures = PictureService(self._db)
+        self._services = {
+            'history': history,
+            'picture': pictures,
+            'video':  VideoService(self._db, history),
+            'tag': TagService(self._db),
+            'album': AlbumService(self._db, pictures)
+        }
+
+        self._asyncServices = {
+            name: AsyncService(service, self._executor)
+            for name, service in self._services.items()
+        }
+
+        # started by `startBackups`
+        self._backups = None
+
+    def _connectMongoDB(self):
         logging.info("Starting mongo client")
         # create connection
         try:
@@ -107,90 +168,57 @@ class Model(object):
                 raise ModelException("Exiting now. Set Conf['data']['mongoDB']['forceStart'] tu True \
 to attempt to force to start a MongoDB server instance locally.")
 
-        self._db = self._connection[Conf['data']['mongoDB']['dbName']]
-        self._db.add_son_manipulator(ObjectIdManipulator())
-
-        self._services = {
-            'video':  VideoService(self._db),
-            'tag': TagService(self._db),
-            'album': AlbumService(self._db)
-        }
+    def startBackups(self):
+        """
+        Start the thread making the periodic backups of the database (see `server.backup`).
+        To be called once the server is ready, so that the dumps don't delay the start-up.
+        """
+        if self._backups is None:
+            self._backups = BackupScheduler(
+                self._db, [service._collection.name for service in self._services.values()],
+                Conf['data']['backup'])
+            self._backups.start()
 
-        self.dumpDB(Conf['data']['mongoDB']['dumpFolder'])
+    def restoreDB(self, dirPath, collections=None):
+        """
+        Restore the given collections (all by default) from the dump of the given folder,
+        see `server.backup.restore`.
+        """
+        restore(self._db, dirPath, collections)
 
-    def dumpDB(self, dirPath):
+    def getBackups(self):
         """
-        Create a dump of the database for a future data restore in the given dirPath.
-        A script `restore.bat` and `restore.sh` will be created to allow later restore of the data
+        Returns the `BackupScheduler` of the database, None if the backups have not been started.
         """
-        if not os.path.exists(dirPath):
-            os.mkdir(dirPath)
-        statusFile = os.path.join(dirPath, 'status.json')
-        if os.path.exists(statusFile):
-            try:
-                with open(statusFile, 'r') as f:
-                    status = json.load(f)
-            except Exception as e:
-                status = None
-        else:
-            status = None
-        if status is not None and time.time() - status['lastDump'] \
-                < Conf['data']['mongoDB']['dumpDelay']:
-            logging.info("Dumping database is not required: \
-last dump performed on %s. Next dump will be done on %s."
-% (status['dateForHumans'],
-   dateFormat(status['lastDump'] + Conf['data']['mongoDB']['dumpDelay'])))
-            return # do not perform the dump right now.
-        dirPath = os.path.join(dirPath, datetime.fromtimestamp(
-            int(time.time())).strftime('%Y-%m-%d_%H-%M-%S'))
-        logging.info("Dumping data into folder: %s" % dirPath)
-        try:
-            os.mkdir(dirPath)
-            subprocess_call = '"%smongodump.exe" --db %s --out %s'\
-                % (Conf['data']['mongoDB']['rootFolder'],
-                   Conf['data']['mongoDB']['dbName'],
-                   dirPath)
-            logging.debug("Calling: %s" % subprocess_call)
-            subprocess.call(subprocess_call, shell=True)
-            size = getFolderSize(dirPath)
-            logging.info("Dump successfully done (%s)! \
-You may want to restore these data later using:" % (sizeFormat(size)))
-            restore_cmd = '"%smongorestore.exe" --db %s "%s"'\
-                % (Conf['data']['mongoDB']['rootFolder'],
-                   Conf['data']['mongoDB']['dbName'],
-                   os.path.join(dirPath, Conf['data']['mongoDB']['dbName']))
-            logging.info(restore_cmd)
-            with open(os.path.join(dirPath, 'restore.bat'), 'w') as f:
-                f.write(restore_cmd + '\n')
-                f.write('pause\n')
-            with open(os.path.join(dirPath, 'restore.sh'), 'w') as f:
-                f.write(restore_cmd + '\n')
-        except Exception as e:
-            logging.error("Unable to perform the dump, an error occured.")
-            logging.error(repr(e))
-            logging.error("A new dump will be attempted upon next start-up.")
-            return
-        with open(statusFile, 'w') as sf:
-            json.dump({
-                'lastDump': time.time(),
-                'dateForHumans': dateFormat(time.time()),
-                'size': size,
-                'sizeForHumans': sizeFormat(size),
-                'folder': dirPath,
-                'restoreCommand': restore_cmd}, sf)
+        return self._backups
 
     def getService(self, service):
         if service in self._services:
             return self._services[service]
         raise ModelException('The service %s does not exist' % service)
 
+    def getAsyncService(self, service):
+        """
+        Returns the given service wrapped in an `AsyncService`, to be used from the
+        request handlers: `videos = yield model.getAsyncService('video').find(...)`
+        """
+        if service in self._asyncServices:
+            return self._asyncServices[service]
+        raise ModelException('The service %s does not exist' % service)
+
     def disconnect(self):
+        if self._backups is not None:
+            self._backups.stop()
+        # let the pending queries complete
+        self._executor.shutdown(wait=True)
         if self._server_process is not None:
             logging.info("Waiting for MongoDB server process to stop...")
             self._server_process.stop()
             # self._server_process.terminate()
             self._server_process.join()
             logging.info("MongoDB server stopped.")
+        if self._backend == 'sqlite':
+            self._db.close()
 
 
 # this module is a singleton
@@ -213,3 +241,12 @@ def getInstance():
 
 def getService(service):
     return getInstance().getService(service)
+
+def getAsyncService(service):
+    return getInstance().getAsyncService(service)
+
+def startBackups():
+    return getInstance().startBackups()
+
+def getBackups():
+    return getInstance().getBackups()
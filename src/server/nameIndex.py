@@ -0,0 +1,161 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import logging
+import time
+from threading import Lock
+
+from tools.utils import timeFormat
+
+# length of the substrings indexed
+GRAM_SIZE = 3
+# minimum delay (in seconds) between two checks of the version of the names of the collection
+VERSION_CHECK_INTERVAL = 5
+# collection holding the version of the names of each indexed collection, {_id: <collection>, version}
+VERSIONS_COLLECTION = 'nameIndexVersions'
+
+
+def normalize(name):
+    """
+    Normalize a name the way it is indexed and searched: case-insensitive,
+    with all blank characters collapsed into single spaces.
+    """
+    return ' '.join((name or '').casefold().split())
+
+def grams(text):
+    return set(text[i:i + GRAM_SIZE] for i in range(len(text) - GRAM_SIZE + 1))
+
+
+class NameIndex(object):
+    """
+    In-memory trigram index of the `name` field of the documents of a collection.
+    A search for "a b" has the same semantics as the regexp `.*a.*b.*` (case-insensitive):
+    the index returns the ids of the documents whose name contains all the trigrams
+    of each word of the query. These are only candidates (the words might not appear
+    in the right order), that should be checked against the regexp by the database,
+    using the index on `_id` instead of scanning the whole collection.
+    The index is built from the collection on the first search, and is then kept up to date
+    by the service owning the collection when documents are inserted, renamed or deleted.
+    Each of these changes also increments the version of the names of the collection, stored in
+    the database: other processes writing to the collection (such as the scripts import.py,
+    update.py or fixAlbums.py) thus make the index of the server stale, which is detected by
+    comparing this version with the changes made by the process itself (at most every
+    `VERSION_CHECK_INTERVAL` seconds, on search), and the index is rebuilt.
+    """
+    def __init__(self, collection):
+        super(NameIndex, self).__init__()
+        self._collection = collection
+        self._lock = Lock()
+        # {trigram: set(ids)}
+        self._index = None
+        # {id: normalized name}
+        self._names = {}
+        self._versions = collection.database[VERSIONS_COLLECTION]
+        # version of the names when the index was built, and number of changes made since then
+        # by this process: any other value of the version means that another process made changes
+        self._version = None
+        self._changes = 0
+        self._lastCheck = 0
+
+    def _readVersion(self):
+        doc = self._versions.find_one({'_id': self._collection.name})
+        return doc['version'] if doc is not None else 0
+
+    def _build(self):
+        start = time.time()
+        self._version = self._readVersion()
+        self._changes = 0
+        self._lastCheck = start
+        self._index = {}
+        self._names = {}
+        for doc in self._collection.find({}, {'name': True}):
+            self._add(doc['_id'], doc.get('name'))
+        logging.info("Indexed names of %d documents of collection %s in %s"
+                     % (len(self._names), self._collection.name, timeFormat(time.time() - start)))
+
+    def _add(self, _id, name):
+        name = normalize(name)
+        self._names[_id] = name
+        for gram in grams(name):
+            self._index.setdefault(gram, set()).add(_id)
+
+    def _remove(self, _id):
+        name = self._names.pop(_id, None)
+        if name is None:
+            return
+        for gram in grams(name):
+            ids = self._index.get(gram)
+            if ids is not None:
+                ids.discard(_id)
+                if len(ids) == 0:
+                    del self._index[gram]
+
+    def touch(self):
+        """
+        Increment the version of the names of the collection, after they have been changed by this process.
+        """
+        with self._lock:
+            self._versions.update(
+                {'_id': self._collection.name}, {'$inc': {'version': 1}}, upsert=True)
+            self._changes += 1
+
+    def add(self, _id, name, touch=True):
+        """
+        Index (or re-index) the name of the document given by id.
+        If `touch` is False, the caller is expected to call `touch` once it has indexed several names.
+        """
+        _id = str(_id)
+        with self._lock:
+            if self._index is not None:  # otherwise the name will be read when the index gets built
+                self._remove(_id)
+                self._add(_id, name)
+        if touch:
+            self.touch()
+
+    def remove(self, _id):
+        _id = str(_id)
+        with self._lock:
+            if self._index is not None:
+                self._remove(_id)
+        self.touch()
+
+    def clear(self):
+        """
+        Drop the index, after changes of names that were not indexed one by one.
+        It will be rebuilt from the collection on the next search.
+        """
+        with self._lock:
+            self._index = None
+            self._names = {}
+        self.touch()
+
+    def search(self, query):
+        """
+        Returns the set of ids of the documents whose name may match the given query,
+        or None if the query has no word long enough to be looked up in the index
+        (in which case all documents are candidates).
+        """
+        words = [word for word in normalize(query).split(' ') if len(word) >= GRAM_SIZE]
+        if len(words) == 0:
+            return None
+        with self._lock:
+            if self._index is not None and time.time() - self._lastCheck >= VERSION_CHECK_INTERVAL:
+                self._lastCheck = time.time()
+                version = self._readVersion()
+                if version != self._version + self._changes:
+                    logging.info("Names of collection %s changed by another process, rebuilding their index"
+                                 % self._collection.name)
+                    self._index = None
+            if self._index is None:
+                self._build()
+            # intersect the smallest sets first
+            postings = sorted(
+                (self._index.get(gram, set()) for word in words for gram in grams(word)),
+                key=len)
+            candidates = set(postings[0])
+            for ids in postings[1:]:
+                if len(candidates) == 0:
+                    break
+                candidates &= ids
+            return candidates
@@ -12,6 +12,7 @@ import shutil
 import random
 from pprint import pformat
 
+from tornado import gen
 from tornado.web import RequestHandler, HTTPError
 
 from server import model, memory
@@ -21,75 +22,111 @@ from tools.utils import timeFormat
 class AlbumsHandler(RequestHandler):
     """Handle requests related to the videos"""
 
-    def __populatePicturesURLs(self, album):
+    def __pictureURL(self, albumId, pictureIdx):
         """
-        Will populate the `url` field of each picture of the given album dict with valid URLs.
+        Returns the URL of the picture number `pictureIdx` of the given album,
+        complying to the route format defined in the server class.
         """
-        picBaseURL = '/download/album/'
-        # ensure trailing slash
-        if picBaseURL[-1] != '/':
-            picBaseURL += '/'
-        #add album id to complain to the route format defined in the server class
-        picBaseURL += "%s/" % str(album['_id'])
+        return '/download/album/%s/%d' % (str(albumId), pictureIdx)
 
+    def __populatePicturesURLs(self, album, offset=0):
+        """
+        Will populate the `url` field of each picture of the given album dict with valid URLs.
+        `offset` is the index in the album of the first picture of the `picturesDetails` field
+        (if only a page of pictures is given).
+        """
         for i, pic in enumerate(album['picturesDetails']):
-            pic['url'] = picBaseURL + str(i)
+            pic['url'] = self.__pictureURL(album['_id'], offset + i)
 
         return album
 
+    def __populateCover(self, album):
+        """
+        Populate the `coverPicture` field of the given album dict with its cover picture, and
+        its `coverUrl` field with the URL of this picture.
+        """
+        if 'picturesDetails' in album:
+            pictures = album.pop('picturesDetails')
+            album['coverPicture'] = pictures[album['cover']] if album['cover'] < len(pictures) else None
+        album['coverUrl'] = self.__pictureURL(album['_id'], album['cover'])
+        return album
+
+    @gen.coroutine
     def display(self):
         """
         Route: GET /api/album/display
-        Return the list of all albums of the database.
-        If the parameter `albumId` is defined, only this album will be returned,
+        If the parameter `albumId` is defined, this album will be returned with all its pictures,
         alongside with available face detection annotations.
+        The parameters `page` and `perPage` can be defined to only retrieve face detection
+        annotations for a page of pictures of the album (default is all pictures).
+        Otherwise, returns a page of the list of albums, most recent first, as an object
+        {albums, page, total, next}. Albums are returned without their pictures, with the
+        `coverPicture` and `coverUrl` fields describing their cover instead.
+        The parameters `page` (default 0) and `perPage` (default is
+        `Conf['data']['albums']['listPageSize']`, 0 for all albums) select the page.
+        The random and starred albums are prepended to the first page.
         """
         albumId = self.get_argument('albumId', default=None)
 
         if albumId is None:
             start_t = time.time()
-            albums = model.getService('album').getAll(
-                returnList=True, orderBy={'creation': -1}, projection={
-                    'album': 1,
-                    'fullPath': 1,
-                    'picturesDetails': 1,
-                    'cover': 1,
-                    'name': 1,
-                    'display': 1,
-                    'picsNumber': 1,
-                    'starredNumber': 1,
-                    'creation': 1,
-                    'lastDisplay': 1,
-                    'lastStarred': 1,
-                    'averageWidth': 1,
-                    'averageHeight': 1,
-                    'tags': 1
-                })
+            page = int(self.get_argument('page', default=0))
+            perPage = int(self.get_argument('perPage', default=Conf['data']['albums']['listPageSize']))
+            albums, total = yield model.getAsyncService('album').getPage(page, perPage)
             logging.info("Retrieved %d albums in %s", len(albums), timeFormat(time.time() - start_t))
-            if not albums:
-                return self.write(json.dumps([]))
-            index, found = next(((i, x) for i, x in enumerate(albums) if x['fullPath'] == 'random'), (-1, False))
-            if not found:
-                albums.insert(0, model.getService('album').getById('random'))
-            else:
-                albums.pop(index)
-                albums.insert(0, found)
-            index, found = next(((i, x) for i, x in enumerate(albums) if x['fullPath'] == 'starred'), (-1, False))
-            if not found:
-                albums.insert(0, model.getService('album').getById('starred'))
-            else:
-                albums.pop(index)
-                albums.insert(0, found)
-            albums = [self.__populatePicturesURLs(a) for a in albums]
-            self.write(json.dumps(albums))
+            if page == 0 and total > 0:
+                # the random and starred albums are not stored, they are generated on demand
+                virtualAlbums = yield [
+                    model.getAsyncService('album').getById('starred'),
+                    model.getAsyncService('album').getById('random')
+                ]
+                albums = virtualAlbums + albums
+            self.write(json.dumps({
+                'albums': [self.__populateCover(a) for a in albums],
+                'page': page,
+                'total': total,
+                'next': page + 1 if perPage > 0 and (page + 1) * perPage < total else None
+            }))
         else:
-            album = model.getService('album').getById(albumId)
+            album = yield model.getAsyncService('album').getById(albumId)
             if album is None:
                 raise HTTPError(404, 'Not Found')
-            album = model.getService('album').extendAlbumWithFaces(album)
+            album = yield model.getAsyncService('album').extendAlbumWithFaces(
+                album, page=int(self.get_argument('page', default=0)),
+                perPage=int(self.get_argument('perPage', default=0)))
             album = self.__populatePicturesURLs(album)
             self.write(json.dumps(album))
 
+    @gen.coroutine
+    def pictures(self):
+        """
+        Route: GET /api/album/pictures
+        Returns a page of the pictures of the album given by the `albumId` parameter, alongside
+        with available face detection annotations, as an object {album, pictures, page, total, next},
+        where `album` is the album without its pictures. Only the requested page of pictures is loaded.
+        The parameters `page` (default 0) and `perPage` (default is
+        `Conf['data']['albums']['virtualAlbumSize']`, 0 for all pictures) select the page.
+        """
+        albumId = self.get_argument('albumId')
+        page = int(self.get_argument('page', default=0))
+        perPage = int(self.get_argument('perPage', default=Conf['data']['albums']['virtualAlbumSize']))
+
+        album, pictures, total = yield model.getAsyncService('album').getPicturesPage(albumId, page, perPage)
+        if album is None:
+            raise HTTPError(404, 'Not Found')
+        album['picturesDetails'] = pictures
+        yield model.getAsyncService('album').extendAlbumWithFaces(album)
+        self.__populatePicturesURLs(album, offset=page * perPage)
+        pictures = album.pop('picturesDetails')
+        self.write(json.dumps({
+            'album': album,
+            'pictures': pictures,
+            'page': page,
+            'total': total,
+            'next': page + 1 if perPage > 0 and (page + 1) * perPage < total else None
+        }))
+
+    @gen.coroutine
     def tag(self):
         """
         Route: POST /api/album/tag
@@ -103,12 +140,13 @@ class AlbumsHandler(RequestHandler):
         remove = self.get_argument('remove', default=False)
 
         if remove:
-            model.getService('album').removeTag(tagId, albumId=albumId)
+            yield model.getAsyncService('album').removeTag(tagId, albumId=albumId)
         else:
-            model.getService('album').addTag(albumId, tagId)
+            yield model.getAsyncService('album').addTag(albumId, tagId)
 
         self.write(json.dumps({"success": True}))
 
+    @gen.coroutine
     def star(self):
         """
         Route: POST /api/album/star
@@ -124,12 +162,13 @@ class AlbumsHandler(RequestHandler):
         logging.debug("PictureIDx=%d, albumId=%s, remove=%s" % (pictureIdx, albumId, str(remove)))
 
         if remove:
-            model.getService('album').removeStar(albumId, pictureIdx)
+            yield model.getAsyncService('album').removeStar(albumId, pictureIdx)
         else:
-            model.getService('album').addStar(albumId, pictureIdx)
+            yield model.getAsyncService('album').addStar(albumId, pictureIdx)
 
         self.write(json.dumps({"success": True}))
 
+    @gen.coroutine
     def cover(self):
         """
         Route: POST /api/album/cover
@@ -141,10 +180,11 @@ class AlbumsHandler(RequestHandler):
         albumId = self.get_argument('albumId')
         logging.debug("PictureIDx=%d, albumId=%s" % (pictureIdx, albumId))
 
-        model.getService('album').selectCover(albumId, pictureIdx)
+        yield model.getAsyncService('album').selectCover(albumId, pictureIdx)
 
         self.write(json.dumps({"success": True}))
 
+    @gen.coroutine
     def deletePic(self):
         """
         Route: DELETE /api/album/picture
@@ -156,28 +196,28 @@ class AlbumsHandler(RequestHandler):
         albumId = self.get_argument('albumId')
         pictureIdx = int(self.get_argument('pictureIdx'))
 
-        album = model.getService('album').getById(albumId)
-        album['fullPath'] = '%s%s' % (
-            Conf['data']['albums']['rootFolder'],
-            album['fullPath'])
+        album, picture = yield [
+            model.getAsyncService('album').getById(albumId, fields=['name', 'fullPath']),
+            model.getAsyncService('album').getPicture(albumId, pictureIdx)
+        ]
+        if album is None or picture is None:
+            raise HTTPError(404, 'Not Found')
         logging.warning("Deleting picture %s from album %s" % (pictureIdx, album['name']))
 
-        model.getService('album').removePicture(albumId, pictureIdx)
+        yield model.getAsyncService('album').removePicture(albumId, pictureIdx)
 
         try:
-            if albumId != 'random' and albumId != 'starred':
-                os.remove(album['fullPath'] + album['picturesDetails'][pictureIdx]['filename'])
-            else:
-                # the pictures array contains the fullpath
-                # (the physical album does not exist)
-                os.remove(album['picturesDetails'][pictureIdx]['filename'])
+            # the pictures of the virtual albums contain the path of their album
+            # relative to the root folder (the physical album does not exist)
+            os.remove(Conf['data']['albums']['rootFolder'] + model.getService('album').picturePath(album, picture))
         except Exception as e:
             logging.error("Unable to remove picture %s from album %s."
-                          % (album['name'], album['picturesDetails'][pictureIdx]))
+                          % (picture, album['name']))
             raise
 
         self.write(json.dumps({'success': True}))
 
+    @gen.coroutine
     def deleteAlbum(self):
         """
         Route: DELETE /api/album/album
@@ -186,15 +226,15 @@ class AlbumsHandler(RequestHandler):
         This requires the parameter 'album' to be defined.
         """
         albumId = self.get_argument('albumId')
-        album = model.getService('album').getById(albumId)
+        album = yield model.getAsyncService('album').getById(albumId, fields=['name', 'fullPath'])
         album['fullPath'] = '%s%s' % (
             Conf['data']['albums']['rootFolder'],
             album['fullPath'])
         logging.warning("Deleting album %s" % (album['name']))
-        if albumId == 'starred' or albumId == 'random':
+        if model.getService('album').isVirtual(albumId):
             raise Exception("Unable to delete the %s album!" % albumId)
 
-        model.getService('album').deleteById(albumId)
+        yield model.getAsyncService('album').deleteById(albumId)
         try:
             shutil.rmtree(album['fullPath'])
         except Exception as e:
@@ -203,6 +243,7 @@ class AlbumsHandler(RequestHandler):
 
         self.write(json.dumps({'success': True}))
 
+    @gen.coroutine
     def migrate(self):
         albums = model.getService('album').getAll()
         toRemove = 'Photos\\'
@@ -214,18 +255,22 @@ class AlbumsHandler(RequestHandler):
                     'fullPath', album['fullPath'][len(toRemove):])
         self.write("OK")
 
+    @gen.coroutine
     def get(self, resource):
         """
         This will handle the GET requests to the /api/album/* route
         """
         avail_resources = {
             'display': self.display,
+            'pictures': self.pictures,
             'migrate': self.migrate
         }
         if resource in avail_resources:
-            return avail_resources[resource]()
+            yield avail_resources[resource]()
+            return
         raise HTTPError(404, "Not Found: %s" % resource)
 
+    @gen.coroutine
     def post(self, resource):
         """
         This will handle the post requests to the /api/album/* route
@@ -236,9 +281,11 @@ class AlbumsHandler(RequestHandler):
             'cover': self.cover
         }
         if resource in avail_resources:
-            return avail_resources[resource]()
+            yield avail_resources[resource]()
+            return
         raise HTTPError(404, "Not Found: %s" % resource)
 
+    @gen.coroutine
     def delete(self, resource):
         """
         This will handle the DELETE requests to the /api/album/* route
@@ -248,5 +295,6 @@ class AlbumsHandler(RequestHandler):
             'picture': self.deletePic
         }
         if resource in avail_resources:
-            return avail_resources[resource]()
+            yield avail_resources[resource]()
+            return
         raise HTTPError(404, "Not Found: %s" % resource)
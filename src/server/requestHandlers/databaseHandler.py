@@ -0,0 +1,84 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import json
+
+from tornado.web import RequestHandler, HTTPError
+
+from server import model, memory
+from server.services import instrumentation
+
+
+class DatabaseHandler(RequestHandler):
+    """
+    Handle requests related to the maintenance of the database
+    """
+    def backupStatus(self):
+        """
+        Route: GET /api/db/backup
+        Returns the status of the backups of the database: state of the backup thread,
+        date of the next dump, details of the last dump and of the last error, and list
+        of the available dumps.
+        """
+        backups = model.getBackups()
+        if backups is None:
+            return self.write(json.dumps({'state': 'disabled'}))
+        self.write(json.dumps(backups.status()))
+
+    def backup(self):
+        """
+        Route: POST /api/db/backup
+        Start a dump of the database without waiting for the backup delay to expire.
+        Returns the status of the backups.
+        """
+        backups = model.getBackups()
+        if backups is None:
+            raise HTTPError(409, 'Backups are not started')
+        backups.request()
+        self.write(json.dumps(backups.status()))
+
+    def cacheStats(self):
+        """
+        Route: GET /api/db/cache
+        Returns the statistics of the in-memory caches, by namespace: number of hits, misses,
+        loads (and the total time spent loading), evictions and expirations, current number of entries and size.
+        """
+        self.write(json.dumps(memory.getStats()))
+
+    def queryStats(self):
+        """
+        Route: GET /api/db/stats
+        Returns the statistics of the calls to the methods of the services since the start of the server
+        (or the last reset): number of calls, total, average and maximum duration, and for each method
+        the queries it ran, grouped by shape (see `server.services.instrumentation`).
+        """
+        self.write(json.dumps(instrumentation.getStats()))
+
+    def resetQueryStats(self):
+        """
+        Route: POST /api/db/stats
+        Reset the statistics of the services, returns the statistics before the reset.
+        """
+        stats = instrumentation.getStats()
+        instrumentation.resetStats()
+        self.write(json.dumps(stats))
+
+    def get(self, resource):
+        resources = {
+            'backup': self.backupStatus,
+            'cache': self.cacheStats,
+            'stats': self.queryStats
+        }
+        if resource in resources:
+            return resources[resource]()
+        raise HTTPError(404, 'Not Found')
+
+    def post(self, resource):
+        resources = {
+            'backup': self.backup,
+            'stats': self.resetQueryStats
+        }
+        if resource in resources:
+            return resources[resource]()
+        raise HTTPError(404, 'Not Found')
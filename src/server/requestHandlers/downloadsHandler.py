@@ -7,18 +7,99 @@ import re
 import random
 import json
 import time
-from threading import Thread
+import datetime
+import email.utils
+import uuid
 import io
 import logging
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 
+from tornado import gen
 from tornado.web import RequestHandler, HTTPError, asynchronous
+from tornado.ioloop import IOLoop
+from tornado.iostream import StreamClosedError
 from server import model, memory
 from tools.utils import sizeFormat
+from tools import imageCache
+from tools.imageCache import ImageVariantCache
 from tools.analyzer import MinividGenerator
 from tools.workspace import Workspace
 from conf import Conf
 
+# number of bytes of a video read and sent at once
+STREAM_CHUNK_SIZE = 1024 * 1024
+# maximum number of ranges of a request, the whole file is sent to requests with more ranges
+MAX_RANGES = 16
+# threads reading the videos being streamed and the images
+STREAM_WORKERS = 4
+# max-age (in seconds) of the versioned snapshots (a year, the maximum allowed)
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+# max-age (in seconds) of the frames of the minivids
+MINIVID_MAX_AGE = 24 * 60 * 60
+
+_readers = ThreadPoolExecutor(max_workers=STREAM_WORKERS)
+
+
+def _readChunk(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+def _readFile(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+def parseHTTPDate(value):
+    """
+    Returns the timestamp of the given HTTP date, None if it is not a valid date.
+    """
+    date = email.utils.parsedate_tz(value)
+    return email.utils.mktime_tz(date) if date is not None else None
+
+
+def parseRanges(header, size):
+    """
+    Parse the `Range` header of a request for a file of `size` bytes. Returns the sorted list of the
+    requested ranges as (start, end) tuples (end excluded), overlapping and adjacent ranges being merged,
+    an empty list if none of the ranges is satisfiable, or None if the header is invalid or has too many
+    ranges (the whole file should be sent).
+    """
+    unit, _, specs = header.partition('=')
+    if unit.strip() != 'bytes':
+        return None
+    ranges = []
+    specs = specs.split(',')
+    if len(specs) > MAX_RANGES:
+        return None
+    for spec in specs:
+        first, sep, last = spec.strip().partition('-')
+        if sep != '-':
+            return None
+        try:
+            if first == '':
+                # suffix range: the last `last` bytes
+                start, end = max(0, size - int(last)), size
+                if int(last) == 0:
+                    continue
+            else:
+                start = int(first)
+                end = size if last == '' else min(size, int(last) + 1)
+                if last != '' and int(last) < start:
+                    return None
+        except ValueError:
+            return None
+        if start < end:
+            ranges.append((start, end))
+    merged = []
+    for start, end in sorted(ranges):
+        if len(merged) > 0 and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
 
 class DownloadsHandler(RequestHandler):
     """Handle requests related to the videos, snapshots, etc.."""
@@ -87,171 +168,279 @@ class DownloadsHandler(RequestHandler):
 
         self._workspace = Workspace()
 
+    def _sendPicture(self, picPath):
+        try:
+            with open(picPath, 'rb') as p:
+                buf = p.read()
+        except:
+            logging.error("The picture: %s cannot be found." % picPath)
+            raise HTTPError(404, 'Not Found')
+
+        self.set_header('Content-Type', self.picMimeType[picPath.split('.')[-1].lower()])
+        self.set_header('Content-Length', len(buf))
+        self.write(buf)
+        self.finish()
+
+    def _onVariantGenerated(self, future, picPath):
+        """
+        Called on the IOLoop thread once the resized variant of the given picture is available.
+        """
+        try:
+            buf = future.result()
+        except Exception as e:
+            logging.error("Unable to generate resized variant of picture: %s", picPath)
+            logging.exception(e)
+            buf = None
+        if buf is None:
+            # no smaller variant could be generated, send the original picture instead
+            try:
+                return self._sendPicture(picPath)
+            except HTTPError as e:
+                return self.send_error(e.status_code)
+        self.set_header('Content-Type', 'image/jpeg')
+        self.set_header('Content-Length', len(buf))
+        self.write(buf)
+        self.finish()
+
     def downloadAlbum(self, albumId, picNum):
         """
         Writes back to the client the picture number `picNum` of the album given by id.
+        If the parameter `w` is given, a resized variant of the picture at least as wide
+        as the requested width will be sent instead (unless the original picture is smaller).
+        Variants are generated on a pool of worker threads and cached on disk.
+        Pictures are served with a strong ETag computed without reading the picture,
+        so that revalidation requests never read nor send the picture again.
         """
         picNumber = int(picNum)
-        album = model.getService('album').getById(albumId)
-        album['fullPath'] = '%s%s' % (
-            Conf['data']['albums']['rootFolder'],
-            album['fullPath'])
-        if picNumber > len(album['picturesDetails']):
-            logging.error("Album has only %d pictures!" % len(album['picturesDetails']))
+        width = self.get_argument('w', default=None)
+        variantWidth = None
+        if width is not None:
+            if not width.isdigit() or int(width) <= 0:
+                raise HTTPError(400, "Bad Request: invalid width %s" % width)
+            variantWidth = imageCache.getInstance().variantWidth(int(width))
+
+        # only the requested picture is loaded, not the whole album
+        picture = model.getService('album').getPicture(albumId, picNumber)
+        if picture is None:
+            logging.error("Album %s has no picture nb %d!" % (albumId, picNumber))
             raise HTTPError(404, "Not Found")
 
-        if albumId == 'random' or albumId == 'starred':
+        if model.getService('album').isVirtual(albumId):
             if picNumber > 0:
                 # the first picture is the icon, full exact path does not need to be reconstructed
-                picPath = Conf['data']['albums']['rootFolder'] + album['picturesDetails'][picNumber]['filename']  # path already included
+                picPath = Conf['data']['albums']['rootFolder'] + picture['filename']  # path already included
             else:
-                picPath = album['picturesDetails'][picNumber]['filename']
+                picPath = picture['filename']
         else:
-            picPath = album['fullPath'] + album['picturesDetails'][picNumber]['filename']
+            album = model.getService('album').getById(albumId, fields=['fullPath'])
+            picPath = Conf['data']['albums']['rootFolder'] + album['fullPath'] + picture['filename']
 
         try:
-            with open(picPath, 'rb') as p:
-                buf = p.read()
-        except:
+            etag = ImageVariantCache.etag(picPath, variantWidth)
+        except OSError:
             logging.error("The picture: %s cannot be found." % picPath)
             raise HTTPError(404, 'Not Found')
+        self.set_header('Etag', '"%s"' % etag)
+        self.set_header('Cache-Control', 'no-cache')
+        if self.check_etag_header():
+            self.set_status(304)
+            return self.finish()
 
-        self.set_header('Content-Type', self.picMimeType[picPath.split('.')[-1].lower()])
-        self.set_header('Content-Length', len(buf))
-        self.write(buf)
-        self.finish()
+        if variantWidth is None:
+            return self._sendPicture(picPath)
 
-    def downloadSnapshot(self, videoId, ssNumber):
+        IOLoop.current().add_future(
+            imageCache.getInstance().getVariant(picPath, variantWidth, etag),
+            lambda future: self._onVariantGenerated(future, picPath))
+
+    @gen.coroutine
+    def _snapshots(self, videoId):
         """
-        Write back to the client the snapshot number `ssnumber`
-        of the video given by id
+        Returns the tuple (folder, version) of the snapshots of the given video, the folder
+        having a trailing separator (see `VideoService.getSnapshotsInfo`).
         """
-        logging.debug("Downloading snapshot #%s on video %s" % (ssNumber, videoId))
-        ssNumber = int(ssNumber) + 1  # base 1
-        video = model.getService('video').getById(videoId)
-        if video is None:
+        snapshots = yield model.getAsyncService('video').getSnapshotsInfo(videoId)
+        if snapshots is None:
             raise HTTPError(404, 'Video Not Found: ' + videoId)
-        video['snapshotsFolder'] = '%s%s' % (
-            Conf['data']['videos']['rootFolder'],
-            video['snapshotsFolder'])
-        ssFolder = video['snapshotsFolder']
-        # ensuretrailing slash
+        ssFolder = '%s%s' % (Conf['data']['videos']['rootFolder'], snapshots['snapshotsFolder'])
+        # ensure trailing slash
         if ssFolder[-1] != os.sep:
             ssFolder = ssFolder + os.sep
-        # compute snapshot path
-        if ssNumber < 10:
-            snapshotPath = ssFolder + 'thumb00%d.png' % ssNumber
-        elif ssNumber < 100:
-            snapshotPath = ssFolder + 'thumb0%d.png' % ssNumber
-        else:
-            snapshotPath = ssFolder + 'thumb%d.png' % ssNumber
+        return ssFolder, snapshots['snapshotsVersion']
 
+    @gen.coroutine
+    def _sendImage(self, picPath, cacheControl):
+        """
+        Send the given png image with a strong ETag, answering revalidation requests without
+        reading the image. The most recently sent images are kept in memory, up to
+        `Conf['server']['imageCacheSize']` MB.
+        """
         try:
-            with open(snapshotPath, 'rb') as p:
-                buf = p.read()
-        except:
-            logging.error("The picture: %s cannot be found." % snapshotPath)
+            etag = ImageVariantCache.etag(picPath)
+        except OSError:
+            logging.error("The picture: %s cannot be found." % picPath)
             raise HTTPError(404, 'Not Found')
+        self.set_header('Etag', '"%s"' % etag)
+        self.set_header('Cache-Control', cacheControl)
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+
+        # the ETag changes with the image, regenerated images are never read from the cache
+        cache = memory.getCache('images', maxSize=Conf['server']['imageCacheSize'] * 1024 ** 2, sizeOf=len)
+        buf = cache.get(etag)
+        if buf is None:
+            try:
+                buf = yield _readers.submit(_readFile, picPath)
+            except IOError:
+                logging.error("The picture: %s cannot be found." % picPath)
+                raise HTTPError(404, 'Not Found')
+            cache.set(etag, buf)
 
         self.set_header('Content-Type', self.picMimeType['png'])
         self.set_header('Content-Length', len(buf))
-        self.set_header('Cache-Control', 'no-cache, must-revalidate')
         self.write(buf)
-        self.finish()
 
-    def downloadMinivid(self, videoId, frameNumber):
+    @gen.coroutine
+    def downloadSnapshot(self, videoId, ssNumber):
         """
         Write back to the client the snapshot number `ssnumber`
-        of the video given by id
+        of the video given by id.
+        Snapshot URLs hold the version of the snapshots of the video as parameter `v` (see
+        `vidsHandler.populateMissingData`), the version being incremented each time the snapshots
+        change: snapshots of the current version are cached by the clients without revalidation.
+        """
+        logging.debug("Downloading snapshot #%s on video %s" % (ssNumber, videoId))
+        ssNumber = int(ssNumber) + 1  # base 1
+        ssFolder, version = yield self._snapshots(videoId)
+        snapshotPath = ssFolder + 'thumb%03d.png' % ssNumber
+        # requests for an outdated version get the current snapshot, which must not be cached under the old URL
+        if self.get_argument('v', default=None) == str(version):
+            cacheControl = 'public, max-age=%d, immutable' % IMMUTABLE_MAX_AGE
+        else:
+            cacheControl = 'no-cache'
+        yield self._sendImage(snapshotPath, cacheControl)
+
+    @gen.coroutine
+    def downloadMinivid(self, videoId, frameNumber):
+        """
+        Write back to the client the frame number `frameNumber`
+        of the minivid of the video given by id.
+        Minivid frames are generated once, they are cached by the clients for `MINIVID_MAX_AGE` seconds.
         """
         logging.debug("Downloading minivid frame #%s on video %s" % (frameNumber, videoId))
         frameNumber = int(frameNumber) + 1  # base 1
-        video = model.getService('video').getById(videoId)
-        video['snapshotsFolder'] = '%s%s' % (
-            Conf['data']['videos']['rootFolder'],
-            video['snapshotsFolder'])
-        ssFolder = MinividGenerator.buildMinividFolderPath(self._workspace, video['snapshotsFolder'])
+        snapshotsFolder, _ = yield self._snapshots(videoId)
+        ssFolder = MinividGenerator.buildMinividFolderPath(self._workspace, snapshotsFolder)
         # ensure trailing slash
         if ssFolder[-1] != os.sep:
             ssFolder = ssFolder + os.sep
-        # compute snapshot path
-        if frameNumber < 10:
-            snapshotPath = ssFolder + 'minivid000%d.png' % frameNumber
-        elif frameNumber < 100:
-            snapshotPath = ssFolder + 'minivid00%d.png' % frameNumber
-        elif frameNumber < 1000:
-            snapshotPath = ssFolder + 'minivid0%d.png' % frameNumber
-        else:
-            snapshotPath = ssFolder + 'minivid%d.png' % frameNumber
+        snapshotPath = ssFolder + 'minivid%04d.png' % frameNumber
+        yield self._sendImage(snapshotPath, 'max-age=%d' % MINIVID_MAX_AGE)
 
+    @gen.coroutine
+    def downloadVideo(self, videoId):
+        """
+        Stream the file of the video given by id. Range requests are honored, with a single range (206)
+        or several ones (206, multipart/byteranges), so that seeking in the player only downloads
+        the requested part of the file. Conditional requests (`If-None-Match`, `If-Modified-Since`,
+        `If-Range`) are checked against an ETag and the modification date of the file.
+        The file is read on a pool of threads by chunks of `STREAM_CHUNK_SIZE` bytes, and each chunk is
+        flushed to the client before the next one is read.
+        """
+        video = yield model.getAsyncService('video').getById(videoId, ['path', 'name'])
+        if video is None:
+            raise HTTPError(404, 'Video Not Found: ' + videoId)
+        videoPath = os.path.normpath('%s%s' % (Conf['data']['videos']['rootFolder'], video['path']))
         try:
-            with open(snapshotPath, 'rb') as p:
-                buf = p.read()
-        except:
-            logging.error("The picture: %s cannot be found." % snapshotPath)
+            stat = os.stat(videoPath)
+        except OSError:
+            logging.error("The video: %s cannot be found." % videoPath)
             raise HTTPError(404, 'Not Found')
+        size = stat.st_size
+        videoName = os.path.basename(videoPath)
+        contentType = self.videoMimeType.get(videoName.split('.')[-1].lower(), 'application/octet-stream')
+        etag = '"%x-%x"' % (size, int(stat.st_mtime * 1000))
 
-        self.set_header('Content-Type', self.picMimeType['png'])
-        self.set_header('Content-Length', len(buf))
-        self.set_header('Cache-Control', 'no-cache, must-revalidate')
-        self.write(buf)
-        self.finish()
+        self.set_header('Accept-Ranges', 'bytes')
+        self.set_header('Etag', etag)
+        self.set_header('Last-Modified', datetime.datetime.utcfromtimestamp(int(stat.st_mtime)))
+        self.set_header('Cache-Control', 'no-cache')
+        self.set_header('Content-Disposition', 'attachment; filename=' + videoName)
+        if self.request.headers.get('If-None-Match') is not None:
+            if self.check_etag_header():
+                self.set_status(304)
+                return
+        elif self.request.headers.get('If-Modified-Since') is not None:
+            since = parseHTTPDate(self.request.headers['If-Modified-Since'])
+            if since is not None and int(stat.st_mtime) <= since:
+                self.set_status(304)
+                return
 
-    def downloadVideo(self, videoId):
-        logging.info("Will download video with id=%s" % videoId)
-        # todo, add a better way to do this, in its dedicated function
-        def asyncDownload(videoPath):
-            videoPath = videoPath.replace('/', '\\')
-            logging.info("Starting download of: %s" % videoPath)
-            videoName = os.path.basename(videoPath)
-            buf_size = 1024 * 1024
-            self.set_header('Content-Type', self.videoMimeType[videoName.split('.')[-1].lower()])
-            self.set_header('Content-Disposition', 'attachment; filename=' + videoName)
-            self.set_header('Content-Length', os.path.getsize(videoPath))
-            self.set_header('Expires', 0)
-            self.set_header('Accept-Ranges', 'bytes')
-            i = 0
-            total_len = 0
-            with open(videoPath, 'rb') as f:
-                while True:
-                    i += 1
-                    data = f.read(buf_size)
-                    if len(data) < buf_size:
-                        logging.error("Read %s instead of %s" % (sizeFormat(len(data)), sizeFormat(buf_size)))
-                    total_len += len(data)
-                    logging.debug("Chunk: %d [%s]" % (i, sizeFormat(total_len)))
-                    if not data:
-                        data = f.read(buf_size)
-                        if not data:
-                            break
-                    self.write(data)
-                    self.flush()
-            logging.debug("Total size should be %s" % (sizeFormat(total_len)))
-            logging.debug("Size is expected to be: %s" % (sizeFormat(os.path.getsize(videoPath))))
-            self.finish()
-        # get the path for this video.
-        video = model.getService('video').getById(videoId, ['path', 'name'])
-        video['path'] = '%s%s' % (
-            Conf['data']['videos']['rootFolder'],
-            video['path'])
-        # check that the file exist
-        try:
-            with open(video['path'], 'r') as f:
-                logging.info("The video %s does exist!" % video['path']);
-        except IOError:
-            logging.error("The video: %s cannot be found." % video['path'])
-            raise HTTPError(404, 'Not Found')
-        # increment 'seen' counter
-        model.getService('video').increment(videoId, 'seen')
-        # perform asynchronous download
-        Thread(target=asyncDownload, name="Downloader-%s" % video['name'], args=[video['path']]).start()
+        ranges = None
+        ifRange = self.request.headers.get('If-Range')
+        if 'Range' in self.request.headers and (
+                ifRange is None or ifRange == etag or parseHTTPDate(ifRange) == int(stat.st_mtime)):
+            ranges = parseRanges(self.request.headers['Range'], size)
+        if ranges is not None and len(ranges) == 0:
+            self.set_status(416)
+            self.set_header('Content-Range', 'bytes */%d' % size)
+            return
+
+        # the video is counted as seen when it is played from the beginning, not on each seek
+        if ranges is None or ranges[0][0] == 0:
+            model.getService('video').incrementBuffered(videoId, 'seen')
+
+        parts = []
+        if ranges is None:
+            self.set_header('Content-Type', contentType)
+            self.set_header('Content-Length', size)
+            parts.append((b'', 0, size))
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.set_status(206)
+            self.set_header('Content-Type', contentType)
+            self.set_header('Content-Range', 'bytes %d-%d/%d' % (start, end - 1, size))
+            self.set_header('Content-Length', end - start)
+            parts.append((b'', start, end))
+        else:
+            boundary = uuid.uuid4().hex
+            self.set_status(206)
+            self.set_header('Content-Type', 'multipart/byteranges; boundary=%s' % boundary)
+            for idx, (start, end) in enumerate(ranges):
+                header = '%s--%s\r\nContent-Type: %s\r\nContent-Range: bytes %d-%d/%d\r\n\r\n' % (
+                    '\r\n' if idx > 0 else '', boundary, contentType, start, end - 1, size)
+                parts.append((header.encode('ascii'), start, end))
+            parts.append((('\r\n--%s--\r\n' % boundary).encode('ascii'), 0, 0))
+            self.set_header('Content-Length', sum(len(header) + end - start for header, start, end in parts))
+
+        logging.info("Streaming %s (%s)" % (videoPath, ', '.join(
+            '%s-%s' % (sizeFormat(start), sizeFormat(end)) for _, start, end in parts if end > start)))
+        with open(videoPath, 'rb') as f:
+            try:
+                for header, start, end in parts:
+                    if len(header) > 0:
+                        self.write(header)
+                    offset = start
+                    while offset < end:
+                        data = yield _readers.submit(_readChunk, f, offset, min(STREAM_CHUNK_SIZE, end - offset))
+                        if len(data) == 0:
+                            raise HTTPError(500, 'Unexpected end of file: %s' % videoPath)
+                        offset += len(data)
+                        self.write(data)
+                        # wait for the chunk to be sent before reading the next one
+                        yield self.flush()
+                yield self.flush()
+            except StreamClosedError:
+                logging.debug("Streaming of %s interrupted by the client" % videoPath)
 
     @asynchronous
     def get(self, *resId):
         """
         Download a resource, route: /download/<resType>/<resId>
         This function is asynchronous to avoid that the request handler call
-        the finish function while another thread is serving the download.
+        the finish function while the download is being served.
+        The request is finished when the returned future (if any) resolves.
         """
-        self._downloadFunctions[self._resType](*resId)
+        return self._downloadFunctions[self._resType](*resId)
 
@@ -8,6 +8,7 @@ import random
 import json
 import time
 
+from tornado import gen
 from tornado.web import RequestHandler, HTTPError
 
 from server import model, memory
@@ -16,6 +17,7 @@ from conf import Conf
 
 class TagsHandler(RequestHandler):
     """Handle requests related to the tags"""
+    @gen.coroutine
     def create(self):
         """
         Route: POST /api/tag/create
@@ -37,41 +39,38 @@ class TagsHandler(RequestHandler):
         elif home == 'true':
             home = True
 
-        _id = model.getService('tag').insert(
+        _id = yield model.getAsyncService('tag').insert(
             name, value, _id=None, relation=relation,
             autotag=autotag, home=home)
-        inserted = model.getService('tag').getById(_id)
+        inserted = yield model.getAsyncService('tag').getById(_id)
         inserted['name'] = inserted['name'].title()
         inserted['value'] = inserted['value'].title()
         self.write(json.dumps(inserted))
 
+    @gen.coroutine
     def delete(self):
         """
         Route: POST /api/tag/delete
         Delete a tag. Requires the parameter `tagId` to be set.
         """
         tagId = self.get_argument('tagId')
-        model.getService('tag').deleteById(tagId)
-        model.getService('video').removeTag(tagId)
-        model.getService('album').removeTag(tagId)
+        yield model.getAsyncService('tag').deleteById(tagId)
+        yield [
+            model.getAsyncService('video').removeTag(tagId),
+            model.getAsyncService('album').removeTag(tagId)
+        ]
 
         self.write('{"success": true}')
 
     def __count_usage(self, tags):
         """
-        Count the number of videos that holds each tags.
+        Count the number of videos and albums that holds each tags.
         The result will be added to each tag as a field named 'usage'.
         """
         for tag in tags:
-            _, count = model.getService('video').find({
-                'tags': [{'$value': tag['_id']}]
-            }, returnCount=True)
-            tag['usage'] = count
-            _, count = model.getService('album').find({
-                'tags': [tag['_id']]
-            }, returnCount=True)
-            tag['usage'] += count
+            tag['usage'] = tag.get('videoUsage', 0) + tag.get('albumUsage', 0)
 
+    @gen.coroutine
     def get(self):
         """
         Route: POST /api/tag/get
@@ -85,7 +84,7 @@ class TagsHandler(RequestHandler):
         if usage =='false':
             usage = False
         if tagId is None:
-            tagsG = model.getService('tag').getAll(returnList=False, orderBy={'name': 1, 'value': 1})
+            tagsG = yield model.getAsyncService('tag').getAll(returnList=True, orderBy={'name': 1, 'value': 1})
             tags = []
             for tag in tagsG:
                 tag['name'] = tag['name'].title()
@@ -95,13 +94,14 @@ class TagsHandler(RequestHandler):
                 self.__count_usage(tags)
             self.write(json.dumps(tags))
         else:
-            tag = model.getService('tag').getById(tagId)
+            tag = yield model.getAsyncService('tag').getById(tagId)
             tag['name'] = tag['name'].title()
             tag['value'] = tag['value'].title()
             if usage:
                 self.__count_usage([tag])
             self.write(json.dumps(tag))
 
+    @gen.coroutine
     def edit(self):
         """
         Route: POST /api/tag/edit
@@ -122,14 +122,15 @@ class TagsHandler(RequestHandler):
             elif value == 'true':
                 value = True
 
-        model.getService('tag').set(tagId, field, value)
-        res = model.getService('tag').getById(tagId)
+        yield model.getAsyncService('tag').set(tagId, field, value)
+        res = yield model.getAsyncService('tag').getById(tagId)
         res['name'] = res['name'].title()
         res['value'] = res['value'].title()
         if usage:
             self.__count_usage([res])
         self.write(json.dumps(res))
 
+    @gen.coroutine
     def post(self, resource):
         resources = {
             'edit': self.edit,
@@ -138,5 +139,6 @@ class TagsHandler(RequestHandler):
             'create': self.create
         }
         if resource in resources:
-            return resources[resource]()
+            yield resources[resource]()
+            return
         raise HTTPError(404, 'Not Found')
@@ -14,6 +14,7 @@ from pprint import pformat
 from threading import Thread
 import subprocess
 
+from tornado import gen
 from tornado.web import RequestHandler, HTTPError
 
 from server import model, memory
@@ -24,7 +25,7 @@ from tools.utils import timeFormat, sizeFormat, dateFormat
 def populateMissingData(video):
         """
         Will populate the `snapshots` field of the given video dict
-        with valid URLs.
+        with valid URLs, holding the version of the snapshots.
         The `thumbnail` field will also be populated with the url of
         a thumbnail, selecting randomly one of the snapshots if necessary.
         """
@@ -37,7 +38,7 @@ def populateMissingData(video):
         snapshotsBaseURL += "%s/" % str(video['_id'])
         # for each file in the snapshots folder
         video['snapshots'] = {
-            i: snapshotsBaseURL + str(i)
+            i: '%s%d?v=%d' % (snapshotsBaseURL, i, video.get('snapshotsVersion', 0))
             for i in range(int(video['nbSnapshots']))
         }
 
@@ -57,13 +58,6 @@ def populateMissingData(video):
         for field in ['creation', 'lastDisplay', 'lastSeen', 'lastFavorite', 'lastTagged', 'lastToWatch']:
             video["%s_str" % field] = dateFormat(video.get(field, 0))
 
-        for field in ['displayHistory', 'favoriteHistory', 'seenHistory', 'taggedHistory']:
-            video["%s_str" % field] = []
-            if field not in video:
-                video[field] = []
-            for item in video[field]:
-                video["%s_str" % field].append(dateFormat(item))
-
         video['snapshotsFolder'] = '%s%s' % (
             Conf['data']['videos']['rootFolder'],
             video['snapshotsFolder'])
@@ -78,12 +72,13 @@ class VidsHandler(RequestHandler):
     def __populateMissingData(self, video):
         """
         Will populate the `snapshots` field of the given video dict
-        with valid URLs.
+        with valid URLs, holding the version of the snapshots.
         The `thumbnail` field will also be populated with the url of
         a thumbnail, selecting randomly one of the snapshots if necessary.
         """
         return populateMissingData(video)
 
+    @gen.coroutine
     def openFolder(self):
         """
         Route: GET /api/video/folder
@@ -92,17 +87,18 @@ class VidsHandler(RequestHandler):
         The function returns nothing.
         """
         vidId = self.get_argument('videoId')
-        video = model.getService('video').getById(vidId, fields=['path'])
+        video = yield model.getAsyncService('video').getById(vidId, fields=['path'])
 
         video['path'] = '%s%s' % (
             Conf['data']['videos']['rootFolder'],
             video['path'])
 
         # increment 'seen' counter
-        model.getService('video').increment(vidId, 'seen')
+        model.getService('video').incrementBuffered(vidId, 'seen')
 
         subprocess.Popen(r'explorer /select,"%s"' % video['path'])
 
+    @gen.coroutine
     def getRelated(self):
         """
         Route: GET /api/video/related
@@ -115,38 +111,25 @@ class VidsHandler(RequestHandler):
         """
         videoId = self.get_argument('videoId')
         nbRelated = int(self.get_argument('nbRelated', default=5))
-        video = model.getService('video').getById(videoId)
+        video = yield model.getAsyncService('video').getById(videoId)
         logging.debug("Getting %d videos related to: %s" % (nbRelated, pformat(video)))
 
-        relationTags = {t['_id']: t for t in model.getService('tag').getRelationTags()}
-
-        candidates = model.getService('video').find({
-            'type': 'any',
-            'video': [],
-            'tags': [{'$value': t, '$negated': False} for t in video['tags'] if t in relationTags]
-        }, generator=False)
-
-        logging.debug("Found %d candidates! Selecting the most related ones." % len(candidates))
-        # compute the score for each video
-        for cid, vid in enumerate(candidates):
-            # ignore current video (score stay at 0)
-            if str(vid['_id']) == video['_id']:
-                vid['relatedByScore'] = -1
-                continue
-            vid['relatedByScore'] = 0
-            for tag in vid['tags']:
-                if tag in video['tags'] and tag in relationTags:
-                    vid['relatedByScore'] += 1
-
-        # sort by descendant score
-        candidates = sorted(candidates, key=lambda v: v['relatedByScore'], reverse=True)
-        # select the top N, or all candidates except the last one, as this is the current video
-        selected = range(min(nbRelated, len(candidates) - 1))
+        relationTags = yield model.getAsyncService('tag').getRelationTags()
+        relationTags = {t['_id']: t for t in relationTags}
+
+        # score the videos sharing relation tags with this one using the tag index,
+        # then only load the selected ones
+        related = yield model.getAsyncService('video').getRelated(
+            videoId, [t for t in video['tags'] if t in relationTags], nbRelated)
+        logging.debug("Selected %d related videos: %s" % (len(related), pformat(related)))
+        scores = dict(related)
+        selected = yield model.getAsyncService('video').getByIds([_id for _id, score in related])
+        selected = sorted(selected, key=lambda v: scores[v['_id']], reverse=True)
 
         # populate snapshots
-        logging.debug("Populating snapshots of video: %s" % pformat(selected))
-        selected = [self.__populateMissingData(
-            candidates[x]) for x in selected if candidates[x]['_id'] != video['_id']]
+        for v in selected:
+            v['relatedByScore'] = scores[v['_id']]
+            self.__populateMissingData(v)
         # get full tags involvet in the relation
         tags = {t['_id']: t for _, t in relationTags.items() if t['_id'] in video['tags']}
 
@@ -157,10 +140,11 @@ class VidsHandler(RequestHandler):
                             set(video['tags']) & set(v['tags']) if tid in tags]
 
         # add tags to video
-        model.getService('tag').populate(selected)
+        yield model.getAsyncService('tag').populate(selected)
 
         self.write(json.dumps(selected, default=lambda obj: str(obj)))
 
+    @gen.coroutine
     def getSingleVid(self):
         """
         Route: GET /api/video/display
@@ -169,15 +153,36 @@ class VidsHandler(RequestHandler):
         This require the body parameter `videoId` defined.
         """
         videoId = self.get_argument('videoId')
-        video = model.getService('video').getById(videoId)
+        video = yield model.getAsyncService('video').getById(videoId)
         video = self.__populateMissingData(video)
 
         # update 'display' counter
-        model.getService('video').increment(video['_id'], 'display')
-        model.getService('tag').populate([video])
+        model.getService('video').incrementBuffered(video['_id'], 'display')
+        yield model.getAsyncService('tag').populate([video])
 
         self.write(json.dumps(video))
 
+    @gen.coroutine
+    def getHistory(self):
+        """
+        Route: GET /api/video/history
+        Will write back to the client a JSON object {<event>: [timestamps]} containing
+        the history of the events ('display', 'seen', 'favorite', 'toWatch', 'tagged')
+        related to a single video.
+        This require the parameter `videoId` defined.
+        The parameters `since` and `until` (timestamps) can be set to only retrieve
+        the events that happened during this period of time.
+        """
+        videoId = self.get_argument('videoId')
+        since = self.get_argument('since', default=None)
+        until = self.get_argument('until', default=None)
+        history = yield model.getAsyncService('video').getHistory(
+            videoId,
+            since=float(since) if since is not None else None,
+            until=float(until) if until is not None else None)
+        self.write(json.dumps(history))
+
+    @gen.coroutine
     def getByCrit(self):
         """
         Route: GET /api/video/filter
@@ -189,6 +194,8 @@ class VidsHandler(RequestHandler):
         VideoService.find class method.
         This requires the parameter `criteria` to be defined.
         The `page` parameter can be defined as well, 0 will be used by default
+        The `token` parameter can be set to the `next` token returned along with
+        the previous page, to avoid skipping all the videos of the previous pages.
         """
         try:
             criteria = json.loads(self.get_argument('criteria', default='{}'))
@@ -196,23 +203,30 @@ class VidsHandler(RequestHandler):
             logging.error("Unable to decode json object: %s" % self.get_argument('criteria', default='{}'))
             criteria = {}
         page = int(self.get_argument('page', default=0))
+        token = self.get_argument('token', default=None)
         perpage = Conf['data']['videos']['displayPerPage'];
         logging.debug("Getting page %d by crit: %s" % (page, str(criteria)))
 
-        videos, count = model.getService('video').find(criteria, page, perpage, returnCount=True)
+        videos, count = yield model.getAsyncService('video').find(
+            criteria, page, perpage, generator=False, returnCount=True, token=token)
+        nextToken = None
+        if len(videos) == perpage and (page + 1) * perpage < count:
+            nextToken = model.getService('video').pageToken(criteria, page, videos[-1])
         videos = [self.__populateMissingData(vid) for vid in videos]
 
         # update 'display' counter
-        model.getService('video').increment([v['_id'] for v in videos], 'display')
+        model.getService('video').incrementBuffered([v['_id'] for v in videos], 'display')
 
-        model.getService('tag').populate(videos)
+        yield model.getAsyncService('tag').populate(videos)
 
         self.write(json.dumps({
             'videos': videos,
             'page': page,
-            'count': count
+            'count': count,
+            'next': nextToken
         }, default=lambda obj: str(obj)))
 
+    @gen.coroutine
     def tag(self):
         """
         Route: POST /api/video/tag
@@ -226,12 +240,13 @@ class VidsHandler(RequestHandler):
         remove = self.get_argument('remove', default=False)
 
         if remove:
-            model.getService('video').removeTag(tagId, videoId=videoId)
+            yield model.getAsyncService('video').removeTag(tagId, videoId=videoId)
         else:
-            model.getService('video').addTag(videoId, tagId)
+            yield model.getAsyncService('video').addTag(videoId, tagId)
 
         self.write(json.dumps({"success": True}))
 
+    @gen.coroutine
     def update(self):
         """
         Route: POST /api/video/update
@@ -261,10 +276,11 @@ class VidsHandler(RequestHandler):
         if field == 'thumbnail' and not isinstance(value, int):
             logging.error("Video %s's thumbnail has been set to a non-integer value!" % (value))
 
-        model.getService('video').set(videoId, field, value)
+        yield model.getAsyncService('video').set(videoId, field, value)
 
         self.write(json.dumps({"success": True}))
 
+    @gen.coroutine
     def increment(self):
         """
         Route: POST /api/video/increment
@@ -275,18 +291,20 @@ class VidsHandler(RequestHandler):
         videoId = self.get_argument('videoId')
         field = self.get_argument('field')
 
-        model.getService('video').increment(videoId, field)
+        yield model.getAsyncService('video').increment(videoId, field)
 
         self.write(json.dumps({"success": True}))
 
+    @gen.coroutine
     def toWatch(self):
         """
         Route: POST /api/video/towatch
         This will mark the given video as to be watched.
         Requires the parameter `videoId` to be defined.
         """
-        model.getService('video').set(self.get_argument('videoId'), 'toWatch', True)
+        yield model.getAsyncService('video').set(self.get_argument('videoId'), 'toWatch', True)
 
+    @gen.coroutine
     def play(self):
         """
         Route: GET /api/video/play
@@ -314,7 +332,7 @@ try to enable the `playVideosVLC` option and fill in the VLC binary path to fix
 
         # get the path for this video.
         videoId = self.get_argument('videoId')
-        video = model.getService('video').getById(videoId, ['path', 'name'])
+        video = yield model.getAsyncService('video').getById(videoId, ['path', 'name'])
         video['path'] = '%s%s' % (
             Conf['data']['videos']['rootFolder'],
             video['path'])
@@ -327,11 +345,12 @@ try to enable the `playVideosVLC` option and fill in the VLC binary path to fix
             logging.error("The video: %s cannot be found." % video['path'])
             raise HTTPError(404, 'Not Found')
         # increment 'seen' counter
-        model.getService('video').increment(videoId, 'seen')
+        model.getService('video').incrementBuffered(videoId, 'seen')
         # perform asynchronous playing of the video
         Thread(target=asyncPlay, name="Player-%s" % video['name'], args=[video['path']]).start()
         self.write(json.dumps({'success': True}))
 
+    @gen.coroutine
     def removeThumbnail(self):
         """
         Route: POST /api/video/thumbnail/remove
@@ -344,7 +363,7 @@ try to enable the `playVideosVLC` option and fill in the VLC binary path to fix
         videoId = self.get_argument('videoId')
         pos = int(self.get_argument('position')) + 1  #base 0 to base1
         logging.info("Removing thumbnail: %d" % pos)
-        video = model.getService('video').getById(videoId, fields=['snapshotsFolder', 'nbSnapshots', 'thumbnail'])
+        video = yield model.getAsyncService('video').getById(videoId, fields=['snapshotsFolder', 'nbSnapshots', 'thumbnail'])
         video['snapshotsFolder'] = '%s%s' % (
             Conf['data']['videos']['rootFolder'],
             video['snapshotsFolder'])
@@ -355,14 +374,15 @@ try to enable the `playVideosVLC` option and fill in the VLC binary path to fix
             newName = os.path.join(video['snapshotsFolder'], 'thumb%03d.png' % (x - 1))
             logging.info("Renaming from '" + oldName + '" to "' + newName + '"')
             os.rename(oldName, newName)
-        model.getService('video').increment(videoId, 'nbSnapshots', -1)
+        yield model.getAsyncService('video').increment(videoId, 'nbSnapshots', -1)
+        # the following snapshots have moved, the cached ones are outdated
+        yield model.getAsyncService('video').increment(videoId, 'snapshotsVersion')
         if video['thumbnail'] is not None and pos <= video['thumbnail']:
-            model.getService('video').increment(videoId, 'thumbnail', -1)
-        self.write(json.dumps(
-            populateMissingData(
-                model.getService('video').getById(videoId)),
-            default=lambda obj: str(obj)))
+            yield model.getAsyncService('video').increment(videoId, 'thumbnail', -1)
+        video = yield model.getAsyncService('video').getById(videoId)
+        self.write(json.dumps(populateMissingData(video), default=lambda obj: str(obj)))
 
+    @gen.coroutine
     def regenerateThumbnail(self):
         """
         Route: POST /api/video/thumbnails/regenerate
@@ -378,11 +398,11 @@ try to enable the `playVideosVLC` option and fill in the VLC binary path to fix
         """
         existing_worker = memory.getVal('thumbnail-generator')
         if existing_worker is not None and existing_worker.isAlive():
-            video = model.getService('video').getById(existing_worker.name, fields=['name'])
+            video = yield model.getAsyncService('video').getById(existing_worker.name, fields=['name'])
             raise Exception("A generation is still in progress for video: %s" % video['name'])
 
         videoId = self.get_argument('videoId')
-        video = model.getService('video').getById(videoId)
+        video = yield model.getAsyncService('video').getById(videoId)
         video['path'] = '%s%s' % (
             Conf['data']['videos']['rootFolder'],
             video['path'])
@@ -414,7 +434,8 @@ Attempting to generate thumbnails anyways..." % video['snapshotsFolder'])
             logging.warning("Unable to create thumbnails folder: %s. \
 Attempting to generate thumbnails anyways..." % video['snapshotsFolder'])
 
-        model.getService('video').set(videoId, 'nbSnapshots', 0)
+        yield model.getAsyncService('video').set(videoId, 'nbSnapshots', 0)
+        yield model.getAsyncService('video').increment(videoId, 'snapshotsVersion')
         video['nbSnapshots'] = 0
 
         def asyncThumbGen(data):
@@ -430,6 +451,8 @@ Attempting to generate thumbnails anyways..." % video['snapshotsFolder'])
                 logging.warning("Couldn't read thumbnails in folder: %s" % (video['snapshotsFolder']))
                 thumbnails = []
             model.getService('video').set(videoId, 'nbSnapshots', len(thumbnails))
+            # snapshots downloaded during the generation may be incomplete
+            model.getService('video').increment(videoId, 'snapshotsVersion')
 
         worker = Thread(target=asyncThumbGen, name=videoId, args=[data])
         worker.start()
@@ -438,6 +461,7 @@ Attempting to generate thumbnails anyways..." % video['snapshotsFolder'])
 
         self.write(json.dumps(populateMissingData(video)))
 
+    @gen.coroutine
     def generationProgress(self):
         """
         Route: GET /api/video/thumbnails/generationProgress
@@ -451,19 +475,20 @@ Attempting to generate thumbnails anyways..." % video['snapshotsFolder'])
         if worker is None or worker.name != videoId:
             raise Exception("Generation hasn't been started yet.")
 
-        video = model.getService('video').getById(videoId)
+        video = yield model.getAsyncService('video').getById(videoId)
         video['snapshotsFolder'] = '%s%s' % (
             Conf['data']['videos']['rootFolder'],
             video['snapshotsFolder'])
 
         video['generationFinished'] = not worker.isAlive()
         thumbnails = os.listdir(video['snapshotsFolder'])
-        model.getService('video').set(videoId, 'nbSnapshots', len(thumbnails))
+        yield model.getAsyncService('video').set(videoId, 'nbSnapshots', len(thumbnails))
 
         video['nbSnapshots'] = len(thumbnails)
 
         self.write(json.dumps(populateMissingData(video)))
 
+    @gen.coroutine
     def migrate(self):
         # videos = model.getService('video').getAll()
         # toRemove = 'C:\\wamp\\www\\Vice\\webroot\\archives\\'
@@ -479,6 +504,7 @@ Attempting to generate thumbnails anyways..." % video['snapshotsFolder'])
         #             'path', vid['path'][len(toRemove):])
         self.write("KO")
 
+    @gen.coroutine
     def get(self, resource):
         """
         This will handle the GET requests to the /api/video/* route
@@ -486,6 +512,7 @@ Attempting to generate thumbnails anyways..." % video['snapshotsFolder'])
         avail_resources = {
             'display': self.getSingleVid,
             'filter': self.getByCrit,
+            'history': self.getHistory,
             'related': self.getRelated,
             'play': self.play,
             'thumbnails/generationProgress': self.generationProgress,
@@ -493,9 +520,11 @@ Attempting to generate thumbnails anyways..." % video['snapshotsFolder'])
             'migrate': self.migrate,
         }
         if resource in avail_resources:
-            return avail_resources[resource]()
+            yield avail_resources[resource]()
+            return
         raise HTTPError(404, "Not Found: %s" % resource)
 
+    @gen.coroutine
     def post(self, resource):
         """
         This will handle the POST requests to the /api/video/* route
@@ -508,16 +537,18 @@ Attempting to generate thumbnails anyways..." % video['snapshotsFolder'])
             'thumbnails/remove': self.removeThumbnail
         }
         if resource in avail_resources:
-            return avail_resources[resource]()
+            yield avail_resources[resource]()
+            return
         raise HTTPError(404, "Not Found: %s" % resource)
 
+    @gen.coroutine
     def delete(self, videoId):
         """
         Route: DELETE /api/video/<videoId>
         Remove any file related to the given video ID.
         This include the video itself, the snapshots of this video and the db record.
         """
-        video = model.getService('video').getById(videoId)
+        video = yield model.getAsyncService('video').getById(videoId)
         video['snapshotsFolder'] = '%s%s' % (
             Conf['data']['videos']['rootFolder'],
             video['snapshotsFolder'])
@@ -535,6 +566,6 @@ Attempting to generate thumbnails anyways..." % video['snapshotsFolder'])
 
         os.remove(video['path'])
 
-        model.getService('video').deleteById(videoId)
+        yield model.getAsyncService('video').deleteById(videoId)
 
         self.write(json.dumps({'success': True}))
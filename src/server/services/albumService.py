@@ -6,13 +6,13 @@ import logging
 import time
 import random
 import os
-import json
-from tqdm import tqdm
 
-from pymongo import DESCENDING, ASCENDING
+from pymongo import DESCENDING
 from bson.objectid import ObjectId
 
 from conf import Conf
+from server import faceStore, memory
+from server.nameIndex import NameIndex
 from server.services.baseService import Service
 from tools.utils import extends, timeFormat
 from tools.analyzer.analyzers import AlbumAnalyzer
@@ -26,6 +26,8 @@ Schema:
                       WARNING: the 'data.albums.rootFolder' prefix won't be included
     * picturesDetails:array list of pictures in this albums, where each picture is an object
                             with the shape {filename, display, starred, analyzerVersion, width, height}
+                            NOTE: the pictures are stored in the pictures collection (see PictureService),
+                            this field is only populated on the albums returned by `getById`
     * cover:int index of the picture to be used as cover for this album.
     * name:string display name for this album
     * display:int number of times this album has been shown to the client
@@ -39,22 +41,57 @@ Schema:
     * tags:list of tags attached to this album
 """
 
+# maximum value of the seeds of the random and starred albums
+MAX_SEED = 2 ** 40
+# number of pages of the random and starred albums kept in memory
+VIRTUAL_ALBUMS_CACHE_SIZE = 16
+
+
+def parseVirtualId(albumId):
+    """
+    Parse the id of the random or the starred album, of the form `<kind>` (page 0 with the current seed)
+    or `<kind>-<seed>-<page>`. Returns the tuple (kind, seed, page), or None for regular albums.
+    """
+    parts = str(albumId).split('-')
+    if parts[0] not in ['random', 'starred']:
+        return None
+    if len(parts) == 1:
+        return parts[0], None, 0
+    if len(parts) != 3:
+        return None
+    try:
+        return parts[0], int(parts[1]), int(parts[2])
+    except ValueError:
+        return None
+
 
 class AlbumService(Service):
     """
     Provides helper functions related to the Albums collection
     of the database.
     """
-    def __init__(self, db):
+    TAG_USAGE_FIELD = 'albumUsage'
+
+    # fields of the pictures returned in the `picturesDetails` field of the albums
+    PICTURE_FIELDS = ['filename', 'display', 'starred', 'analyzerVersion', 'width', 'height']
+
+    def __init__(self, db, pictures):
         super(AlbumService, self).__init__(db, 'albums')
+        self._pictures = pictures
+        self._nameIndex = NameIndex(self._collection)
+        # current seed of the random and starred albums
+        self._seeds = {}
+        # these albums used to be stored in the collection
+        self._collection.remove({'fullPath': {'$in': ['random', 'starred']}})
         self._collection.ensure_index(
             [('creation', DESCENDING)], name="album_creation_idx")
+        # pictures used to be stored in an array of the album documents
+        self._pictures.migrateAlbums(self._collection)
 
     def schema(self):
         return {
             'album':True,
             'fullPath': True,
-            'picturesDetails': True,
             'cover':True,
             'name':True,
             'display':True,
@@ -100,12 +137,11 @@ class AlbumService(Service):
         post = self.schema()
         post['album'] = album
         post['fullPath'] = fullPath
-        post['picturesDetails'] = picturesDetails
         post['cover'] = cover
         post['name'] = name
         post['display'] = display
         post['picsNumber'] = picsNumber
-        post['starredNumber'] = 0
+        post['starredNumber'] = len([pic for pic in picturesDetails if pic.get('starred')])
         post['creation'] = creation
         post['lastDisplay'] = lastDisplay
         post['lastStarred'] = lastStarred
@@ -116,19 +152,41 @@ class AlbumService(Service):
         if _id is not None:
             post['_id'] = ObjectId(_id)
         _id = self._collection.insert(self.validate(post))
+        self._pictures.insertMany(_id, picturesDetails)
+        self._nameIndex.add(_id, name)
+        self._incrementTagUsage(tags)
+        self._invalidateVirtualAlbums()
         return str(_id)
 
+    def deleteById(self, _id):
+        album = self._collection.find_one({'_id': ObjectId(_id)}, {'tags': True})
+        res = super(AlbumService, self).deleteById(_id)
+        self._pictures.deleteAlbum(_id)
+        if album is not None:
+            self._incrementTagUsage(album['tags'], -1)
+        self._invalidateVirtualAlbums()
+        return res
+
     def addTag(self, _id, tagId):
         logging.debug("Pushing tag %s to album %s" % (tagId, _id))
-        self._collection.update(
-            {'_id': ObjectId(_id)},
+        # only match the album if it doesn't hold the tag yet, to know whether to count the new usage
+        res = self._collection.update(
+            {'_id': ObjectId(_id), 'tags': {'$ne': tagId}},
             {'$addToSet': {'tags': tagId}})
+        if res['n'] > 0:
+            self._incrementTagUsage([tagId])
 
     def removeTag(self, tagId, albumId=None):
+        """
+        Remove the given tag from the given album, or from all the albums holding it
+        if `albumId` is not given (the tag is being deleted, its usage counter is not maintained).
+        """
         if albumId is not None:
-            self._collection.update(
-                {'_id': ObjectId(albumId)},
+            res = self._collection.update(
+                {'_id': ObjectId(albumId), 'tags': tagId},
                 {'$pull': {'tags': tagId}})
+            if res['n'] > 0:
+                self._incrementTagUsage([tagId], -1)
         else:
             self._collection.update(
                 {'tags': {'$in': [tagId]}},
@@ -153,276 +211,294 @@ class AlbumService(Service):
         """
         When a picture get starred or deleted from the 'random' or
         'starred' album, we need to find the right album it belongs to.
-        To get it, use the path of the picture, as each album has a unique
-        `fullPath`.
+        The pictures of these albums keep the id of their album and their index in it.
         Returns a tuple (realAlbumId, realPictureIdx)
         """
         if pictureIdx == 0:
             raise Exception("The picture nb %d does not belong to any album!" % pictureIdx)
         # get starred or random album document
-        album = self.getById(albumId)
-        # find fullPath
-        picPath = album['picturesDetails'][pictureIdx]['filename']
-        fullPath = os.path.dirname(picPath) + os.path.sep
-        logging.debug("Picture belongs to album with fullPath: %s" % fullPath)
-        # find album
-        realAlbum = self.getByPath(fullPath)
-        # find real picture index in the real album
-        realPicIdx = None
-        try:
-            realPicIdx = next(idx for idx, pic in enumerate(realAlbum['picturesDetails'])
-                              if pic['filename'] == os.path.basename(picPath))
-        except StopIteration:
-            logging.warning("Couldn't determine belonging album of picture: %s", picPath)
-            pass
-
-        logging.debug("Picture is number %d in album %s" % (realPicIdx, realAlbum['_id']))
-        return realAlbum['_id'], realPicIdx
+        picture = self.getById(albumId)['picturesDetails'][pictureIdx]
+        logging.debug("Picture is number %d in album %s" % (picture['pictureIdx'], picture['albumId']))
+        return picture['albumId'], picture['pictureIdx']
 
     def selectCover(self, albumId, pictureIdx):
-        if albumId == 'random' or albumId == 'starred':
-            album = self.getById(albumId, keepRealId=True)
-            albumId = album['_id']
+        if self.isVirtual(albumId):
+            logging.warning("The cover of the %s album can't be changed" % albumId)
+            return
         logging.debug("New cover picture: %d" % pictureIdx)
         self._collection.update(
             {'_id': ObjectId(albumId)},
             {'$set': {'cover': pictureIdx}})
 
     def addStar(self, albumId, pictureIdx):
-        if albumId == 'random' or albumId == 'starred':
+        if self.isVirtual(albumId):
             return self.addStar(
                 *self.__findBelongingAlbum(albumId, pictureIdx))
         logging.debug("New starred picture: %d" % (pictureIdx))
-        self._collection.update(
-            {'_id': ObjectId(albumId)},
-            {'$set': {'picturesDetails.%d.starred' % pictureIdx: True},
-             '$inc': {'starredNumber': 1}})
+        if self._pictures.setStarred(albumId, pictureIdx, True):
+            self._collection.update(
+                {'_id': ObjectId(albumId)},
+                {'$inc': {'starredNumber': 1}})
+            self._invalidateVirtualAlbums()
 
     def removeStar(self, albumId, pictureIdx):
-        if albumId == 'random' or albumId == 'starred':
+        if self.isVirtual(albumId):
             return self.removeStar(
                 *self.__findBelongingAlbum(albumId, pictureIdx))
         logging.debug("Removing star from picture: %d" % (pictureIdx))
-        self._collection.update(
-            {'_id': ObjectId(albumId)},
-            {'$set': {'picturesDetails.%d.starred' % pictureIdx: False},
-             '$inc': {'starredNumber': -1}})
+        if self._pictures.setStarred(albumId, pictureIdx, False):
+            self._collection.update(
+                {'_id': ObjectId(albumId)},
+                {'$inc': {'starredNumber': -1}})
+            self._invalidateVirtualAlbums()
 
     def removePicture(self, albumId, pictureIdx):
-        if albumId == 'random' or albumId == 'starred':
-            # do not return, we will remove the picture from the 'random' or 'starred'
-            # album AND from the belonging album
-            self.removePicture(
+        if self.isVirtual(albumId):
+            # remove the picture from the belonging album, the random and starred albums
+            # will be regenerated without it
+            return self.removePicture(
                 *self.__findBelongingAlbum(albumId, pictureIdx))
 
-        album = self.getById(albumId, fields=['_id', 'name', 'picturesDetails', 'cover'], keepRealId=True)
+        album = self.getById(albumId, fields=['_id', 'name', 'fullPath', 'cover'])
         logging.debug('deleting picture %s from album %s' % (str(pictureIdx), album['_id']))
 
         if album['cover'] > pictureIdx:
             album['cover'] -= 1
 
+        picture = self._pictures.remove(albumId, pictureIdx)
+        if picture is None:
+            logging.warning("Album %s has no picture nb %d" % (album['_id'], pictureIdx))
+            return
+        faceStore.delete([self.picturePath(album, picture)])
         self._collection.update(
-            # in case of 'random' or 'starred' album, the real album id
-            # is different than the given parameter `albumId`
             {'_id': ObjectId(album['_id'])},
-            {'$pull': {'picturesDetails': album['picturesDetails'][pictureIdx]},
-             '$inc': {
+            {'$inc': {
                  'picsNumber': -1,
-                 'starredNumber': -1
+                 'starredNumber': -1 if picture.get('starred') else 0
              },
              '$set': {
                 'cover': album['cover']
             }})
+        self._invalidateVirtualAlbums()
 
     def addPicture(self, albumId, picture, width, height):
-        if albumId == 'random' or albumId == 'starred':
+        if self.isVirtual(albumId):
             raise Exception("Add picture should not be called on %s album!" % albumId)
-        self._collection.update({
-                '_id': ObjectId(albumId)
-            }, {
-                '$push': { 'picturesDetails': {
-                    'filename': picture,
-                    'width': width,
-                    'height': height,
-                    'analyzerVersion': None,
-                    'starred': False,
-                    'display': 0
-                } },
-                '$inc': {'picsNumber': 1}
-            })
+        self._pictures.insert(albumId, picture, width, height)
+        self._collection.update(
+            {'_id': ObjectId(albumId)},
+            {'$inc': {'picsNumber': 1}})
+        self._invalidateVirtualAlbums()
 
-    def getById(self, _id, keepRealId=False, *args, **kwargs):
+    def setPictures(self, albumId, pictures):
+        """
+        Replace all the pictures of the given album.
+        """
+        if self.isVirtual(albumId):
+            raise Exception("Set pictures should not be called on %s album!" % albumId)
+        self._pictures.deleteAlbum(albumId)
+        self._pictures.insertMany(albumId, pictures)
+        self._collection.update(
+            {'_id': ObjectId(albumId)},
+            {'$set': {
+                'picsNumber': len(pictures),
+                'starredNumber': len([pic for pic in pictures if pic.get('starred')])
+            }})
+        self._invalidateVirtualAlbums()
+
+    def hasPicture(self, albumId, filename):
+        """
+        Returns True if the given album holds a picture with the given filename.
+        """
+        return self._pictures.exists(albumId, filename)
+
+    def getPicture(self, albumId, pictureIdx):
+        """
+        Returns the picture number `pictureIdx` of the given album (with the same shape as the items of
+        `picturesDetails`), without loading the other pictures of the album. Returns None if there is no such picture.
+        """
+        if self.isVirtual(albumId):
+            pictures = self.getById(albumId)['picturesDetails']
+            return pictures[pictureIdx] if 0 <= pictureIdx < len(pictures) else None
+        return self._pictures.getPicture(albumId, pictureIdx)
+
+    def isVirtual(self, albumId):
+        """
+        Returns True if the given album id is the id of the 'random' or the 'starred' album.
+        """
+        return parseVirtualId(albumId) is not None
+
+    def getById(self, _id, fields=None):
         """
         Return a document specific to this id.
-        If the _id is 'random123456random123456', a random album will be returned instead
+        If the _id is the id of the random or the starred album, the virtual album will be returned
+        instead (see `getVirtualAlbum`).
         _id is the _id of the document
-        fields is the list of fields to be returned (all by default)
+        fields is the list of fields to be returned (all by default). The pictures of the album
+        are only loaded from the pictures collection if `picturesDetails` is requested.
         """
-        if _id != 'random' and _id != 'starred':
-            ret = super(AlbumService, self).getById(_id, *args, **kwargs)
-            if ret is not None and 'fullPath' in ret and \
-                    (ret['fullPath'] == 'random' or \
-                     ret['fullPath'] == 'starred'):
-                raise Exception("Album _id: %s is the %s album with the wrong id"
-                                % (_id, ret['fullPath']))
-            return ret
-        album = self._collection.find_one({'fullPath': _id})
-        if album is not None and not keepRealId:
-            album['_id'] = _id
-        if album is None:
-            if _id == 'random':
-                album = self.createRandomAlbum()
-            elif _id == 'starred':
-                album = self.createStarredAlbum()
-            self._collection.insert(self.validate(album))
-        if not keepRealId:
-            album['_id'] = _id
-        return album
-
-    def getAll(self, *args, **kwargs):
-        kwargs['returnList'] = True
-        ret = super(AlbumService, self).getAll(*args, **kwargs)
-        for i, alb in enumerate(ret):
-            if 'fullPath' in alb and alb['fullPath'] == 'random':
-                ret[i]['_id'] = 'random'
-            if 'fullPath' in alb and alb['fullPath'] == 'starred':
-                ret[i]['_id'] = 'starred'
+        virtual = parseVirtualId(_id)
+        if virtual is not None:
+            return self.getVirtualAlbum(*virtual)
+        withPictures = fields is None or 'picturesDetails' in fields
+        if fields is not None:
+            fields = [field for field in fields if field != 'picturesDetails']
+        ret = super(AlbumService, self).getById(_id, fields)
+        if ret is not None and withPictures:
+            ret['picturesDetails'] = self._pictures.getByAlbum(_id, fields=self.PICTURE_FIELDS)
         return ret
 
-    def resetRandomAlbum(self, replace=False):
-        album = self._collection.find_one({'fullPath': 'random'})
-        if album is not None and not replace:
-            return
+    def getPage(self, page=0, perPage=0):
+        """
+        Returns the tuple (albums, total) where `albums` is the given page of albums, most recent first,
+        without their pictures but with the `coverPicture` field holding their cover picture,
+        and `total` the number of albums. The covers of the page are retrieved with a single query.
+        """
+        cursor = self._collection.find({}, {
+            field: True for field in self.schema()
+        }).sort('creation', DESCENDING)
+        total = cursor.count()
+        if perPage > 0:
+            cursor.skip(page * perPage).limit(perPage)
+        albums = [album for album in cursor]
+        covers = self._pictures.getCovers(albums, fields=self.PICTURE_FIELDS)
+        for album in albums:
+            album['coverPicture'] = covers.get(album['_id'])
+        return albums, total
 
-        self._collection.remove({'fullPath': 'random'})
-        album = self.createRandomAlbum()
-        self._collection.insert(self.validate(album))
+    def getPicturesPage(self, albumId, page=0, perPage=0):
+        """
+        Returns the tuple (album, pictures, total) where `album` is the given album without its pictures,
+        `pictures` the given page of its pictures and `total` the number of pictures in the album.
+        Returns (None, [], 0) if the album does not exist.
+        """
+        if self.isVirtual(albumId):
+            album = self.getById(albumId)
+            pictures = album.pop('picturesDetails')
+            total = len(pictures)
+            if perPage > 0:
+                pictures = pictures[page * perPage:(page + 1) * perPage]
+            return album, pictures, total
+        album = self.getById(albumId, fields=list(self.schema()))
+        if album is None:
+            return None, [], 0
+        pictures = self._pictures.getByAlbum(albumId, page, perPage, fields=self.PICTURE_FIELDS)
+        return album, pictures, self._pictures.countByAlbum(albumId)
 
-    def createRandomAlbum(self):
-        logging.warning("Creating new random album!")
-        start = time.time()
-        albums = self.getAll(returnList=True)
-        random.seed()
-        random_album = {
-            'album': 'Random',
-            'fullPath': 'random',
-            'picturesDetails': [],
-            'cover': 0,
-            'name': 'Random',
-            'display': 0,  # sum of all albums display value
-            'picsNumber': 0,  # sum of all picsNumber values
-            'starredNumber': 0,  # sum of all starredNumber values
-            'creation': 0,  # min of creation values
-            'lastDisplay': 0,  # max of lastDisplay values
-            'lastStarred': 0,  # max of lastStarred values
-            'averageWidth': 0,  # average of all albums
-            'averageHeight': 0,  # average of all albums
-            'tags': [],  # no tags
-        }
-        if len(albums) == 0:
-            random_album['picturesDetails'] = [{'filename': os.path.join(*((Conf['server']['assetsPath'] + 'custom/img/question-mark.png').split('/')))}]
-            return random_album
-
-        random_album['display'] = sum((album['display'] for album in albums))
-        random_album['creation'] = time.time()
-        random_album['lastDisplay'] = max((album['lastDisplay'] for album in albums))
-        random_album['lastStarred'] = max((album['lastStarred'] for album in albums))
-        random_album['averageWidth'] = sum((album['averageWidth'] for album in albums)) / len(albums)
-        random_album['averageHeight'] = sum((album['averageHeight'] for album in albums)) / len(albums)
-
-        random_album['picturesDetails'] = []
-        for album in albums:
-            if album['fullPath'] == 'starred' or album['fullPath'] == 'random':
-                continue
-            for pic in album['picturesDetails']:
-                random_album['picturesDetails'].append({
-                    'filename': album['fullPath'] + pic['filename'],
-                    'starred': True,
-                    'width': pic.get('width'),
-                    'height': pic.get('height'),
-                    'analyzerVersion': pic.get('analyzerVersion')
-                })
-
-        random_album['picsNumber'] = len(random_album['picturesDetails'])
-        random_album['starredNumber'] = sum(1 if pic.get('starred', False) else 0 for pic in random_album['picturesDetails'])
-
-        random.shuffle(random_album['picturesDetails'])
-        random_album['picturesDetails'] = [
-            {'filename': os.path.join(*((Conf['server']['assetsPath'] + 'custom/img/question-mark.png').split('/')))}
-        ] + random_album['picturesDetails']
-        logging.info("Random album generated in %s" % timeFormat(time.time() - start))
-        return random_album
+    def resetRandomAlbum(self, replace=False):
+        """
+        Select a new order for the pictures of the random album.
+        If `replace` is False, the current order is kept if there is one.
+        """
+        if replace or 'random' not in self._seeds:
+            self._seeds['random'] = random.randint(0, MAX_SEED)
 
     def resetStarredAlbum(self, replace=False):
-        album = self._collection.find_one({'fullPath': 'starred'})
-        if album is not None and not replace:
-            return
-
-        self._collection.remove({'fullPath': 'starred'})
+        """
+        Select a new order for the pictures of the starred album.
+        If `replace` is False, the current order is kept if there is one.
+        """
+        if replace or 'starred' not in self._seeds:
+            self._seeds['starred'] = random.randint(0, MAX_SEED)
 
-        album = self.createStarredAlbum()
-        self._collection.insert(self.validate(album))
+    def getVirtualAlbum(self, kind, seed=None, page=0):
+        """
+        Returns the page number `page` of the 'random' (all pictures) or 'starred' (starred pictures)
+        album, made of `Conf['data']['albums']['virtualAlbumSize']` pictures of all albums
+        taken in a pseudo-random order given by the seed (the current seed by default, see
+        `resetRandomAlbum` and `resetStarredAlbum`).
+        The pictures are selected by an aggregation pipeline on the pictures collection,
+        only the requested page is retrieved (see `PictureService.getShuffled`).
+        The `_id` of the returned album identifies the seed and the page, so that pictures can be
+        retrieved by index later on, and the `next` field is the id of the next page if any.
+        As in regular albums, the first picture is the icon of the album.
+        """
+        if seed is None:
+            if kind == 'random':
+                self.resetRandomAlbum()
+            else:
+                self.resetStarredAlbum()
+            seed = self._seeds[kind]
+        return self._generateVirtualAlbum(kind, seed, page)
 
-    def createStarredAlbum(self):
-        logging.warning("Creating new starred album!")
+    @memory.memoize('virtualAlbums', maxSize=VIRTUAL_ALBUMS_CACHE_SIZE, copyResults=True)
+    def _generateVirtualAlbum(self, kind, seed, page):
+        """
+        Generate the given page of a virtual album (see `getVirtualAlbum`). The recently
+        generated pages are kept in memory until the albums change.
+        """
         start = time.time()
-        albums = self.getAll(returnList=True)
-        random.seed()
-        starred_album = {
-            'album': 'Starred',
-            'fullPath': 'starred',
-            'picturesDetails': [],
+        perPage = Conf['data']['albums']['virtualAlbumSize']
+        icon = os.path.join(*((Conf['server']['assetsPath'] + 'custom/img/%s' % (
+            'question-mark.png' if kind == 'random' else 'star-red.png')).split('/')))
+        album = {
+            '_id': '%s-%d-%d' % (kind, seed, page),
+            'album': kind.title(),
+            'fullPath': kind,
+            'name': kind.title(),
             'cover': 0,
-            'name': 'Starred',
+            'seed': seed,
+            'page': page,
+            'next': None,
             'display': 0,  # sum of all albums display value
-            'picsNumber': 0,  # sum of all picsNumber values
-            'starredNumber': 0,  # sum of all picsNumber values
-            'creation': 0,  # min of creation values
+            'picsNumber': 0,  # number of pictures in the virtual album (all pages)
+            'starredNumber': 0,  # sum of all starredNumber values
+            'creation': time.time(),
             'lastDisplay': 0,  # max of lastDisplay values
             'lastStarred': 0,  # max of lastStarred values
             'averageWidth': 0,  # average of all albums
             'averageHeight': 0,  # average of all albums
             'tags': [],  # no tags
+            'picturesDetails': [{
+                'filename': icon,
+                'starred': kind == 'starred',
+                'width': 0,
+                'height': 0,
+                'analyzerVersion': None,
+                'albumId': None,
+                'pictureIdx': None
+            }]
         }
-        if len(albums) == 0:
-            starred_album['picturesDetails'] = [{'filename': os.path.join(*((Conf['server']['assetsPath'] + 'custom/img/star-red.png').split('/')))}]
-            return starred_album
+        stats = self._collection.aggregate([
+            {'$match': {'fullPath': {'$nin': ['random', 'starred']}}},
+            {'$group': {
+                '_id': None,
+                'display': {'$sum': '$display'},
+                'picsNumber': {'$sum': '$picsNumber'},
+                'starredNumber': {'$sum': '$starredNumber'},
+                'lastDisplay': {'$max': '$lastDisplay'},
+                'lastStarred': {'$max': '$lastStarred'},
+                'averageWidth': {'$avg': '$averageWidth'},
+                'averageHeight': {'$avg': '$averageHeight'}
+            }}
+        ], cursor={})
+        for stat in stats:
+            for field in ['display', 'starredNumber', 'lastDisplay', 'lastStarred', 'averageWidth', 'averageHeight']:
+                album[field] = stat[field] or 0
+            album['picsNumber'] = stat['starredNumber' if kind == 'starred' else 'picsNumber'] or 0
+
+        for pic in self._pictures.getShuffled(seed, page, perPage, starred=kind == 'starred'):
+            album['picturesDetails'].append({
+                'filename': pic['fullPath'] + pic['filename'],
+                'starred': pic.get('starred', False),
+                'width': pic.get('width'),
+                'height': pic.get('height'),
+                'analyzerVersion': pic.get('analyzerVersion'),
+                'albumId': pic['albumId'],
+                'pictureIdx': pic['idx']
+            })
+        if (page + 1) * perPage < album['picsNumber']:
+            album['next'] = '%s-%d-%d' % (kind, seed, page + 1)
+        logging.info("%s album (seed=%d, page %d) generated in %s"
+                     % (album['name'], seed, page, timeFormat(time.time() - start)))
+        return album
 
-        starred_album['display'] = sum((album['display'] for album in albums))
-        starred_album['creation'] = time.time()
-        starred_album['lastDisplay'] = max((album['lastDisplay'] for album in albums))
-        starred_album['lastStarred'] = max((album['lastStarred'] for album in albums))
-        starred_album['averageWidth'] = sum((album['averageWidth'] for album in albums)) / len(albums)
-        starred_album['averageHeight'] = sum((album['averageHeight'] for album in albums)) / len(albums)
+    def _invalidateVirtualAlbums(self):
+        self._generateVirtualAlbum.clear()
 
-        for album in albums:
-            if album['fullPath'] == 'starred' or album['fullPath'] == 'random':
-                continue
-            for pic in album['picturesDetails']:
-                if pic.get('starred', False):
-                    starred_album['picturesDetails'].append({
-                        'filename': (album['fullPath'] + pic['filename']),
-                        'starred': True,
-                        'width': pic.get('width'),
-                        'height': pic.get('height'),
-                        'analyzerVersion': pic.get('analyzerVersion')
-                    })
-
-        random.shuffle(starred_album['picturesDetails'])
-
-        starred_album['picturesDetails'] = [{
-            'filename': os.path.join(*((Conf['server']['assetsPath'] + 'custom/img/star-red.png').split('/'))),
-            'starred': True,
-            'width': 0,
-            'height': 0,
-            'analyzerVersion': None
-        }] + starred_album['picturesDetails']
-
-        starred_album['picsNumber'] = len(starred_album['picturesDetails'])
-        starred_album['starredNumber'] = len(starred_album['picturesDetails'])
-        logging.info("Starred album generated in %s" % timeFormat(time.time() - start))
-
-        return starred_album
+    def _afterBulkWrite(self, ops, chunk):
+        super(AlbumService, self)._afterBulkWrite(ops, chunk)
+        self._invalidateVirtualAlbums()
 
     def find(self, criteria, page=0, item_per_page=0, generator=True, returnCount=False):
         """
@@ -442,6 +518,10 @@ class AlbumService(Service):
                     continue
                 if key == 'name':
                     mongo_filtre[key] = {'$regex': '.*' + '.*'.join(val.split(' ')) + '.*', '$options': 'is'}
+                    # restrict the regexp to the candidates found in the name index
+                    candidates = self._nameIndex.search(val)
+                    if candidates is not None:
+                        mongo_filtre['_id'] = {'$in': [ObjectId(c) for c in candidates]}
                     continue
                 if filtre['$comparator'] == '>':
                     mongo_filtre[key] = {'$gte': val}
@@ -486,102 +566,83 @@ class AlbumService(Service):
 
     def getUnanalyzedAlbums(self, version):
         """
-        Returns the list of pictures that haven't been analyzed.
-        Each picture will be a dict of the shape {albumId, pictureIdx, path}
+        Returns a generator over the albums holding pictures that haven't been analyzed,
+        with the shape {_id, name, picturesDetails}, where `picturesDetails` only holds
+        the pictures to analyze. Each picture will be a dict of the shape
+        {albumId, pictureIdx, path, filename, version, albumName}.
+        See `PictureService.getUnanalyzed`.
         """
-        albums = self.getAll(orderBy={'creation': -1})
-        res = [
-            {
+        for album in self._pictures.getUnanalyzed(version):
+            yield {
                 '_id': album['_id'],
                 'name': album['name'],
                 'picturesDetails': [
                     {
                         'albumId': album['_id'],
-                        'pictureIdx': picIdx,
+                        'pictureIdx': pic['idx'],
                         'path': album['fullPath'] + pic['filename'],
                         'filename': pic['filename'],
                         'version': pic.get('analyzerVersion'),
                         'albumName': album['name']
                     }
-                    for picIdx, pic in enumerate(album['picturesDetails'])
-                    if pic.get('analyzerVersion') != version
+                    for pic in album['pictures']
                 ]
             }
-            for album in albums if album['fullPath'] not in ['starred', 'random']
-        ]
-        return [album for album in res if len(album['picturesDetails']) > 0]
 
 
     # does not actuially save the face annotation as this account for too much data for storing in db
     def setPictureAnalysis(self, albumId, picIdx, version):
-        self._collection.update(
-            {'_id': ObjectId(albumId)},
-            {'$set': {
-                'picturesDetails.%d.analyzerVersion' % picIdx: version,
-            }})
+        self._pictures.setAnalysis([{'albumId': albumId, 'pictureIdx': picIdx}], version)
 
-    def saveAlbumAnalysis(self, album, result):
-        analysisPath = Conf['data']['albums']['rootFolder'] + album['fullPath'] + 'analysis.json'
-        with open(analysisPath) as f:
-            json.dump(result, f)
+    def setPicturesAnalysis(self, pictures, version):
+        """
+        Bulk version of `setPictureAnalysis`.
+        `pictures` is expected to be a list of dicts with the shape `{albumId, pictureIdx}`
+        (as returned by `getUnanalyzedAlbums`).
+        """
+        self._pictures.setAnalysis(pictures, version)
+
+    def picturePath(self, album, picture):
+        """
+        Returns the path of the given picture of the given album, relative to the albums root folder.
+        """
+        # special case random and starred albums, the picture filename contains the album path
+        if album['fullPath'] in ['starred', 'random']:
+            return picture['filename']
+        return album['fullPath'] + picture['filename']
 
     # picture details are extended after being loaded with analysis information
-    def extendAlbumWithFaces(self, album):
-        albumFaces = None
-        analysisPath = Conf['data']['albums']['rootFolder'] + album['fullPath'] + 'analysis.json'
-        try:
-            with open(analysisPath) as f:
-                albumFaces = json.load(f)
-                if len(albumFaces) != len(album['picturesDetails']):
-                    albumFaces = None
-        except:
-            pass
-
-        # speed up random album face retrieval
-        allfaces = {}
-        cachePath = Conf['data']['albums']['rootFolder'] + 'allfaces.json'
-        if album['fullPath'] == 'random':
-            try:
-                with open(cachePath) as f:
-                    allfaces = json.load(f)
-            except:
-                pass
-
-        for idx, picture in enumerate(tqdm(album['picturesDetails'], desc="[Populating faces")):
-            if picture['filename'] in allfaces:
-                picture['faces'] = allfaces[picture['filename']]
-            if albumFaces is not None:
-                picture['faces'] = albumFaces[idx]['faces']
-            else:
-                picPath = Conf['data']['albums']['rootFolder'] + \
-                    album['fullPath'] + picture['filename']
-                # special case random and starred albums, the picture filename contains the album path
-                if album['fullPath'] in ['starred', 'random']:
-                    picPath = Conf['data']['albums']['rootFolder'] + \
-                        picture['filename']
-                try:
-                    picture['faces'] = AlbumAnalyzer.checkCache(picPath)['faces']
-                except Exception as e:
-                    logging.warn("Unable to retrieve any face data for picture: %s",
-                                 picPath)
-                    picture['faces'] = {}
-
-            if album['fullPath'] == 'random':
-                allfaces[picture['filename']] = picture['faces']
-
-        if album['fullPath'] == 'random':
+    def extendAlbumWithFaces(self, album, page=0, perPage=0):
+        """
+        Populate the `faces` field of the pictures of the given album with the face annotations
+        found in the face store. If `perPage` is set, only the pictures of the given page are extended.
+        Annotations are retrieved with a single query to the face store. Pictures analyzed before the
+        face store existed are looked up in the annotator cache once, then saved in the face store.
+        """
+        pictures = album['picturesDetails']
+        if perPage > 0:
+            pictures = pictures[page * perPage:(page + 1) * perPage]
+        paths = [self.picturePath(album, picture) for picture in pictures]
+        faces = faceStore.get(paths)
+
+        backfill = []
+        for path in paths:
+            if path in faces:
+                continue
             try:
-                with open(cachePath) as f:
-                    json.dump(allfaces, f)
-            except:
-                pass
+                faces[path] = AlbumAnalyzer.checkCache(
+                    Conf['data']['albums']['rootFolder'] + path)['faces']
+                backfill.append((path, faces[path]))
+            except Exception as e:
+                logging.debug("Unable to retrieve any face data for picture: %s", path)
+        if len(backfill) > 0:
+            logging.info("Moving face annotations of %d pictures to the face store", len(backfill))
+            faceStore.put(backfill)
+
+        for path, picture in zip(paths, pictures):
+            picture['faces'] = faces.get(path, {})
 
         return album
 
     def setPictureDim(self, albumId, picIdx, width, height):
-        self._collection.update(
-            {'_id': ObjectId(albumId)},
-            {'$set': {
-                'picturesDetails.%d.width' % picIdx: width,
-                'picturesDetails.%d.height' % picIdx: height,
-            }})
+        self._pictures.setDim(albumId, picIdx, width, height)
@@ -5,21 +5,192 @@ from pprint import pformat
 import logging
 
 from bson.objectid import ObjectId
+from pymongo import InsertOne, UpdateOne, UpdateMany, DeleteOne, DeleteMany
+from pymongo.errors import BulkWriteError
 from tqdm import tqdm
 
 from conf import Conf
+from server.services import instrumentation
 
 class ModelException(Exception):
     pass
 
+# counters of the bulk write results, {<name in the result of `Bulk`>: <name in the result of `bulk_write`>}
+BULK_COUNTERS = {
+    'inserted': 'nInserted',
+    'matched': 'nMatched',
+    'modified': 'nModified',
+    'removed': 'nRemoved',
+    'upserted': 'nUpserted'
+}
+
+
+class Bulk(object):
+    """
+    Batch of write operations on the collection of a service (see `Service.bulk`).
+    Inserts, updates and deletes are validated against the schema of the service when they are
+    queued, then written with unordered `bulk_write`s of `chunkSize` operations: operations of
+    a chunk may be applied in any order, and a failed operation doesn't prevent the others
+    from being applied. Pending operations are written when the chunk is full, when `flush`
+    is called, and when leaving the `with` block:
+
+        with model.getService('video').bulk() as bulk:
+            for vid in vids:
+                bulk.set(vid['_id'], 'fileSize', size(vid))
+        print(bulk.result())
+
+    Operations that failed are reported in `errors`, they don't raise.
+    """
+    def __init__(self, service, chunkSize=None):
+        super(Bulk, self).__init__()
+        self._service = service
+        self._chunkSize = chunkSize or Conf['data']['bulkChunkSize']
+        # pending operations, [(operation, description, callback)]
+        self._pending = []
+        # number of operations queued so far, gives the index of the operations in the errors
+        self._queued = 0
+        self._counters = {name: 0 for name in BULK_COUNTERS}
+        # failed operations: [{index, op, code, errmsg}]
+        self.errors = []
+        # data gathered by the callbacks of the operations of the chunk being written,
+        # given to `Service._afterBulkWrite` so that it is written once per chunk
+        self.chunk = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if excType is not None:
+            logging.warning("Discarding %d pending operations on collection %s after an error"
+                            % (len(self._pending), self._service._collection.name))
+            self._pending = []
+            return False
+        self.flush()
+        return False
+
+    def _select(self, select):
+        """
+        `select` is either an id or a query.
+        """
+        if isinstance(select, dict):
+            return select
+        return {'_id': select if isinstance(select, ObjectId) else ObjectId(select)}
+
+    def _queue(self, op, description, onSuccess):
+        self._pending.append((op, description, onSuccess))
+        self._queued += 1
+        if len(self._pending) >= self._chunkSize:
+            self.flush()
+
+    def insert(self, doc, onSuccess=None):
+        """
+        Queue the insertion of the given document, validated against the schema.
+        `onSuccess` is called with no argument once the document has been inserted.
+        Returns the id of the document (generated if it doesn't have one).
+        """
+        self._service.validate(doc)
+        if '_id' not in doc:
+            doc['_id'] = ObjectId()
+        callbacks = [onSuccess] if onSuccess is not None else []
+        if 'name' in doc and self._service._nameIndex is not None:
+            # the version of the names is incremented once per chunk (see `Service._afterBulkWrite`)
+            callbacks.append(lambda: self._service._nameIndex.add(doc['_id'], doc['name'], touch=False))
+        self._queue(InsertOne(doc), 'insert %s' % doc['_id'],
+                    (lambda: [callback() for callback in callbacks]) if len(callbacks) > 0 else None)
+        return doc['_id']
+
+    def update(self, select, update, multi=False, upsert=False, onSuccess=None):
+        """
+        Queue the update of the document of the given id, or of the documents matching the given query
+        (the first one only unless `multi` is True). `update` is made of update operators ('$set', '$inc'...),
+        the updated fields are validated against the schema.
+        `onSuccess` is called with no argument once the update has been applied.
+        """
+        if len(update) == 0 or any(not operator.startswith('$') for operator in update):
+            raise ModelException("Bulk updates only accept update operators, got: %s" % list(update))
+        for fields in update.values():
+            self._service.validate({field.split('.')[0]: True for field in fields}, strict=False)
+        select = self._select(select)
+        op = (UpdateMany if multi else UpdateOne)(select, update, upsert=upsert)
+        self._queue(op, 'update %s' % select, onSuccess)
+
+    def set(self, _id, field, value):
+        """
+        Queue the update of the given field of the document of the given id (see `Service.set`).
+        """
+        onSuccess = None
+        if field == 'name' and self._service._nameIndex is not None:
+            onSuccess = lambda: self._service._nameIndex.add(_id, value, touch=False)
+        self.update(_id, {'$set': {field: value}}, onSuccess=onSuccess)
+
+    def delete(self, select, multi=False, onSuccess=None):
+        """
+        Queue the deletion of the document of the given id, or of the documents matching the given query
+        (the first one only unless `multi` is True).
+        """
+        select = self._select(select)
+        op = (DeleteMany if multi else DeleteOne)(select)
+        self._queue(op, 'delete %s' % select, onSuccess)
+
+    def flush(self):
+        """
+        Write the pending operations.
+        """
+        if len(self._pending) == 0:
+            return
+        pending = self._pending
+        self._pending = []
+        first = self._queued - len(pending)
+        try:
+            res = self._service._collection.bulk_write([op for op, _, _ in pending], ordered=False).bulk_api_result
+        except BulkWriteError as e:
+            res = e.details
+        failed = set()
+        for error in res.get('writeErrors', []):
+            failed.add(error['index'])
+            self.errors.append({
+                'index': first + error['index'],
+                'op': pending[error['index']][1],
+                'code': error.get('code'),
+                'errmsg': error.get('errmsg')
+            })
+            logging.warning("Bulk operation #%d on collection %s failed (%s): %s"
+                            % (first + error['index'], self._service._collection.name,
+                               pending[error['index']][1], error.get('errmsg')))
+        for name, counter in BULK_COUNTERS.items():
+            self._counters[name] += res.get(counter, 0)
+        self.chunk = {}
+        for idx, (op, _, onSuccess) in enumerate(pending):
+            if onSuccess is not None and idx not in failed:
+                onSuccess()
+        self._service._afterBulkWrite([op for op, _, _ in pending], self.chunk)
+
+    def result(self):
+        """
+        Returns the number of operations queued, of documents inserted, matched, modified, removed
+        and upserted, and the list of the failed operations.
+        """
+        return dict(self._counters, operations=self._queued, errors=self.errors)
+
+
 class Service(object):
     """
     Base class of any service, provide some abstraction of common functions
     """
+    # name of the usage counter of the tags collection that counts the documents
+    # of this collection holding each tag (None if the documents of this collection can't be tagged)
+    TAG_USAGE_FIELD = None
+
     def __init__(self, db, collection):
         super(Service, self).__init__()
         self._db = db
         self._collection = self._db[collection]
+        if Conf['data']['instrumentation']['enabled']:
+            # record the duration and the queries of the calls to the methods of the service
+            instrumentation.instrument(self)
+        # index of the `name` field of the documents (see server.nameIndex), kept up to date
+        # by `set` and `deleteById` if the service defines one
+        self._nameIndex = None
 
     def schema(self):
         """
@@ -112,8 +283,74 @@ class Service(object):
             cur = self._collection.find(query)
         if cursor:
             return cur
-        return [t for t in cursor]
+        return [t for t in cur]
+
+
+    def _incrementTagUsage(self, tagIds, val=1):
+        """
+        Increment (or decrement if `val` is negative) the usage counter of the given tags
+        by `val` for the documents of this collection.
+        """
+        ids = []
+        for tagId in tagIds:
+            try:
+                ids.append(ObjectId(tagId))
+            except:
+                logging.error("TagId: %s seems to not be a valid objectId" % tagId)
+        if len(ids) == 0:
+            return
+        self._db['tags'].update(
+            {'_id': {'$in': ids}},
+            {'$inc': {self.TAG_USAGE_FIELD: val}},
+            multi=True)
+
+    def _incrementTagUsageMany(self, usage):
+        """
+        Increment the usage counter of several tags by different values, in a single bulk write.
+        `usage` is a dict {tagId: <value to add to the counter>}.
+        """
+        ops = []
+        for tagId, val in usage.items():
+            try:
+                ops.append(UpdateOne({'_id': ObjectId(tagId)}, {'$inc': {self.TAG_USAGE_FIELD: val}}))
+            except:
+                logging.error("TagId: %s seems to not be a valid objectId" % tagId)
+        if len(ops) == 0:
+            return
+        self._db['tags'].bulk_write(ops, ordered=False)
+
+    def bulk(self, chunkSize=None):
+        """
+        Returns a new batch of write operations on the collection (see `Bulk`), written in
+        chunks of `chunkSize` operations (`Conf['data']['bulkChunkSize']` by default).
+        """
+        return Bulk(self, chunkSize)
+
+    def _afterBulkWrite(self, ops, chunk):
+        """
+        Called once the given operations of a bulk have been written, to refresh what the service
+        keeps in memory about the documents of its collection. `chunk` holds the data gathered by
+        the callbacks of the operations that succeeded (see `Bulk.chunk`). The denormalized data
+        (such as the usage counters of the tags) is not maintained by bulk updates and deletes.
+        The name index is only rebuilt when a delete or an update touching the names was written.
+        """
+        if self._nameIndex is not None:
+            if any(self._changesName(op) for op in ops):
+                self._nameIndex.clear()
+            elif any(isinstance(op, InsertOne) for op in ops):
+                self._nameIndex.touch()
 
+    @staticmethod
+    def _changesName(op):
+        """
+        Returns True if the given bulk operation may change or remove the name of existing documents.
+        """
+        if isinstance(op, (DeleteOne, DeleteMany)):
+            return True
+        if isinstance(op, (UpdateOne, UpdateMany)):
+            return any(field.split('.')[0] == 'name' or (operator == '$rename' and value.split('.')[0] == 'name')
+                       for operator, fields in op._doc.items() for field, value in fields.items())
+        return False
 
     def getOverallCount(self):
         return self._collection.count()
@@ -122,10 +359,14 @@ class Service(object):
         """
         Warning: will delete ALL the documents in this collection
         """
+        if self._nameIndex is not None:
+            self._nameIndex.clear()
         return self._collection.remove({})
 
     def deleteById(self, _id):
         logging.info("removing by id: %s" % _id)
+        if self._nameIndex is not None:
+            self._nameIndex.remove(_id)
         return self._collection.remove({'_id': ObjectId(_id)})
 
     def getAll(self, page=0, perPage=0, returnList=True, orderBy=None, projection=None):
@@ -168,3 +409,7 @@ class Service(object):
         update['$set'] = update.get('$set', {})
         update['$set'][field] = value
         self._collection.update(select, update, multi=True)
+        if field == 'name' and self._nameIndex is not None:
+            for i in (_id if isinstance(_id, list) else [_id]):
+                self._nameIndex.add(i, value, touch=False)
+            self._nameIndex.touch()
@@ -0,0 +1,119 @@
+# -*- coding: utf8 -*-
+from __future__ import unicode_literals
+
+import logging
+import time
+from threading import Thread, Event, Lock
+
+from bson.objectid import ObjectId
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+
+class CounterBuffer(Thread):
+    """
+    Write-behind buffer of the counters of the videos (number of displays, of times seen...).
+    Increments are aggregated in memory and written to the database in a single bulk update
+    every `interval` seconds, so that requests reading videos don't wait for these writes.
+    Increments made during the last `interval` seconds are lost if the process is killed
+    without calling `stop`. Increments that could not be written are kept for the next flush.
+    """
+    def __init__(self, collection, history, timestamps, interval=5):
+        """
+        * `collection`: collection of the videos
+        * `history`: HistoryService where the events are recorded
+        * `timestamps`: dict {<counter>: <field holding the timestamp of its last increment>}
+        * `interval`: maximum delay (in seconds) before an increment is written to the database
+        """
+        super(CounterBuffer, self).__init__(name='CounterBuffer')
+        self.daemon = True
+        self._collection = collection
+        self._history = history
+        self._timestamps = timestamps
+        self._interval = interval
+        self._lock = Lock()
+        self._stop_event = Event()
+        # {(videoId, counter): [timestamps of the increments]}
+        self._pending = {}
+
+    def add(self, videoIds, counter):
+        """
+        Increment by one the given counter of each of the given videos.
+        """
+        t = time.time()
+        with self._lock:
+            for videoId in videoIds:
+                self._pending.setdefault((str(videoId), counter), []).append(t)
+            stopped = self._stop_event.is_set()
+            if not stopped and not self.is_alive():
+                self.start()
+        if stopped:
+            # no more periodic flushes, write through
+            self.flush()
+
+    def flush(self):
+        """
+        Write all the pending increments to the database.
+        """
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+        if len(pending) == 0:
+            return
+        keys = list(pending.keys())
+        ops = []
+        for videoId, counter in keys:
+            timestamps = pending[(videoId, counter)]
+            update = {'$inc': {counter: len(timestamps)}}
+            if counter in self._timestamps:
+                update['$max'] = {self._timestamps[counter]: timestamps[-1]}
+            if counter == 'seen':
+                update['$set'] = {'toWatch': False}
+            ops.append(UpdateOne({'_id': ObjectId(videoId)}, update))
+        try:
+            self._collection.bulk_write(ops, ordered=False)
+        except Exception as e:
+            # the increments that were not written are put back in the buffer, to be retried
+            # at the next flush (all of them, unless the database tells which ones failed)
+            if isinstance(e, BulkWriteError):
+                failed = [keys[error['index']] for error in e.details.get('writeErrors', [])]
+            else:
+                failed = keys
+            failed = set(failed)
+            self._requeue({key: pending[key] for key in failed})
+            logging.error("Unable to save %d video counters, they will be retried", len(failed))
+            logging.exception(e)
+            pending = {key: timestamps for key, timestamps in pending.items() if key not in failed}
+            if len(pending) == 0:
+                return
+        try:
+            self._history.recordEvents([
+                (videoId, counter, timestamps)
+                for (videoId, counter), timestamps in pending.items()])
+            logging.debug("Flushed %d video counters", len(pending))
+        except Exception as e:
+            logging.error("Unable to record %d video events in the history", len(pending))
+            logging.exception(e)
+
+    def _requeue(self, pending):
+        """
+        Put back the given increments, that could not be written, in the buffer.
+        """
+        with self._lock:
+            for key, timestamps in pending.items():
+                # increments made since the flush started are more recent
+                self._pending[key] = timestamps + self._pending.get(key, [])
+
+    def stop(self):
+        """
+        Stop the periodic flushes and write the pending increments to the database.
+        """
+        with self._lock:
+            self._stop_event.set()
+        if self.is_alive():
+            self.join()
+        self.flush()
+
+    def run(self):
+        while not self._stop_event.wait(self._interval):
+            self.flush()
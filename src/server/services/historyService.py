@@ -0,0 +1,149 @@
+# -*- coding: utf8 -*-
+from __future__ import unicode_literals
+
+import logging
+import time
+
+from bson.objectid import ObjectId
+from pymongo import ASCENDING, UpdateOne
+from tqdm import tqdm
+
+from server.services.baseService import Service
+
+"""
+Schema:
+    * _id:string id of the bucket
+    * videoId:string id of the video these events relate to
+    * bucket:int timestamp of the beginning of the period of time covered by this bucket
+    * count:int total number of events recorded in this bucket
+    * events:dict {<event>: array<float>} timestamps of the events of each type that
+                  happened during the period of time covered by this bucket.
+                  Events are 'display', 'seen', 'favorite', 'toWatch' and 'tagged'.
+"""
+
+# duration of the period of time covered by each bucket, in seconds
+BUCKET_DURATION = 60 * 60 * 24
+EVENTS = ['display', 'seen', 'favorite', 'toWatch', 'tagged']
+
+# fields of the video documents that held the history of each event before it was moved to this collection
+LEGACY_FIELDS = {
+    'displayHistory': 'display',
+    'seenHistory': 'seen',
+    'favoriteHistory': 'favorite',
+    'toWatchHistory': 'toWatch',
+    'taggedHistory': 'tagged'
+}
+
+
+def bucketOf(t):
+    return int(t // BUCKET_DURATION * BUCKET_DURATION)
+
+
+class HistoryService(Service):
+    """
+    Provides helper functions related to the history collection of the database,
+    that records the timestamps of the events related to each video.
+    Events are grouped in one document per video and per period of time, so that
+    the video documents keep a constant size however popular the video is,
+    and histories are only read when they are displayed.
+    """
+    def __init__(self, db):
+        super(HistoryService, self).__init__(db, 'history')
+        self._collection.ensure_index(
+            [('videoId', ASCENDING), ('bucket', ASCENDING)],
+            name="history_video_bucket_uq_idx", unique=True)
+
+    def schema(self):
+        return {
+            'videoId': True,
+            'bucket': True,
+            'count': True,
+            'events': True
+        }
+
+    def _recordOp(self, videoId, event, timestamps):
+        return UpdateOne(
+            {'videoId': str(videoId), 'bucket': bucketOf(timestamps[0])},
+            {
+                '$push': {'events.%s' % event: {'$each': timestamps}},
+                '$inc': {'count': len(timestamps)}
+            },
+            upsert=True)
+
+    def record(self, videoIds, event, t=None):
+        """
+        Record an event that happened at time `t` (now by default) to each of the given videos.
+        `videoIds` can be a single id or a list of ids.
+        """
+        if not isinstance(videoIds, list):
+            videoIds = [videoIds]
+        if len(videoIds) == 0:
+            return
+        t = t or time.time()
+        self._collection.bulk_write(
+            [self._recordOp(videoId, event, [t]) for videoId in videoIds],
+            ordered=False)
+
+    def recordMany(self, videoId, event, timestamps):
+        """
+        Record several events of the same type to the given video.
+        """
+        self.recordEvents([(videoId, event, timestamps)])
+
+    def recordEvents(self, events):
+        """
+        Record events to several videos in a single bulk write.
+        `events` is expected to be an iterable of `(videoId, event, timestamps)` tuples.
+        """
+        ops = []
+        for videoId, event, timestamps in events:
+            buckets = {}
+            for t in timestamps:
+                buckets.setdefault(bucketOf(t), []).append(t)
+            ops += [self._recordOp(videoId, event, sorted(ts)) for ts in buckets.values()]
+        if len(ops) == 0:
+            return
+        self._collection.bulk_write(ops, ordered=False)
+
+    def getHistory(self, videoId, events=None, since=None, until=None):
+        """
+        Returns a dict {<event>: [timestamps]} of the events that happened to the given video,
+        optionally restricted to the given types of events and period of time.
+        """
+        events = events or EVENTS
+        query = {'videoId': str(videoId)}
+        if since is not None or until is not None:
+            query['bucket'] = {}
+            if since is not None:
+                query['bucket']['$gte'] = bucketOf(since)
+            if until is not None:
+                query['bucket']['$lte'] = bucketOf(until)
+        projection = {'events.%s' % event: True for event in events}
+        history = {event: [] for event in events}
+        for bucket in self._collection.find(query, projection).sort('bucket', ASCENDING):
+            for event, timestamps in bucket.get('events', {}).items():
+                history[event] += [
+                    t for t in timestamps
+                    if (since is None or t >= since) and (until is None or t <= until)]
+        return history
+
+    def deleteVideo(self, videoId):
+        return self._collection.remove({'videoId': str(videoId)}, multi=True)
+
+    def migrateVideos(self, videos):
+        """
+        Move the histories still stored as arrays in the given collection of videos
+        to this collection.
+        """
+        query = {'$or': [{field: {'$exists': True}} for field in LEGACY_FIELDS]}
+        nb = videos.find(query).count()
+        if nb == 0:
+            return
+        logging.info("Moving the history of %d videos to the history collection" % nb)
+        projection = {field: True for field in LEGACY_FIELDS}
+        for video in tqdm(videos.find(query, projection), total=nb, desc='[Migrating history'):
+            for field, event in LEGACY_FIELDS.items():
+                self.recordMany(video['_id'], event, video.get(field, []))
+            videos.update(
+                {'_id': ObjectId(video['_id'])},
+                {'$unset': {field: True for field in LEGACY_FIELDS}})
@@ -0,0 +1,357 @@
+# -*- coding: utf8 -*-
+from __future__ import unicode_literals
+
+import json
+import logging
+import time
+import types
+from functools import wraps
+from threading import Lock, local
+
+from conf import Conf
+from tools.utils import timeFormat
+
+# methods of the services that don't access the database
+IGNORED_METHODS = ['schema', 'requiredFields', 'validate', 'bulk']
+
+# name of the service method being run by the current thread (stack of the nested calls)
+_local = local()
+
+
+def _stack():
+    if not hasattr(_local, 'stack'):
+        _local.stack = []
+    return _local.stack
+
+
+def _currentMethod():
+    stack = _stack()
+    return stack[-1] if len(stack) > 0 else '(outside services)'
+
+
+def shape(query):
+    """
+    Returns the shape of the given query (filter, projection, update or aggregation pipeline): the query
+    where each value is replaced by 1, so that queries differing only by their values have the same shape.
+    """
+    if isinstance(query, dict):
+        return {key: shape(value) for key, value in query.items()}
+    if isinstance(query, (list, tuple)):
+        if any(isinstance(item, (dict, list, tuple)) for item in query):
+            return [shape(item) for item in query]
+        return ['...'] if len(query) > 0 else []
+    return 1
+
+
+def _count(res):
+    """
+    Number of documents affected by a write, given its result.
+    """
+    if isinstance(res, dict):
+        return res.get('n', 0)
+    if isinstance(res, list):
+        return len(res)
+    return 1 if res is not None else 0
+
+
+class QueryStats(object):
+    """
+    Statistics of the calls to the methods of the services and of the database queries they run,
+    aggregated by method, and for each method by query shape (see `shape`).
+    Queries taking more than `Conf['data']['instrumentation']['slowQueryThreshold']` seconds are
+    logged, with the explanation of the query by the database the first time a query shape is slow.
+    """
+    def __init__(self):
+        super(QueryStats, self).__init__()
+        self._lock = Lock()
+        # {method: {calls, time, maxTime, errors, queries: {query: {count, time, maxTime, docs, slow}}}}
+        self._methods = {}
+        self._start = time.time()
+
+    def _method(self, method):
+        if method not in self._methods:
+            self._methods[method] = {'calls': 0, 'time': 0.0, 'maxTime': 0.0, 'errors': 0, 'queries': {}}
+        return self._methods[method]
+
+    def recordCall(self, method, duration, error=False, count=True):
+        """
+        Record a call to the given method of a service. `count` is False when recording the time spent
+        iterating over the generator returned by the method.
+        """
+        with self._lock:
+            stats = self._method(method)
+            if count:
+                stats['calls'] += 1
+            stats['time'] += duration
+            stats['maxTime'] = max(stats['maxTime'], duration)
+            if error:
+                stats['errors'] += 1
+
+    def recordQuery(self, method, collection, op, query, duration, docs, explain=None):
+        """
+        Record a query run on the given collection by the given method. `explain` is a function
+        returning the explanation of the query by the database, called if the query is slow.
+        """
+        key = '%s.%s %s' % (collection.name, op, json.dumps(shape(query), sort_keys=True))
+        slow = duration >= Conf['data']['instrumentation']['slowQueryThreshold']
+        with self._lock:
+            queries = self._method(method)['queries']
+            if key not in queries:
+                queries[key] = {'count': 0, 'time': 0.0, 'maxTime': 0.0, 'docs': 0, 'slow': 0}
+            stats = queries[key]
+            stats['count'] += 1
+            stats['time'] += duration
+            stats['maxTime'] = max(stats['maxTime'], duration)
+            stats['docs'] += docs
+            firstSlow = slow and stats['slow'] == 0
+            if slow:
+                stats['slow'] += 1
+        if not slow:
+            return
+        logging.warning("Slow query (%s) in %s: %s (%d documents)" % (timeFormat(duration), method, key, docs))
+        if firstSlow and explain is not None:
+            try:
+                logging.warning("Explanation of the query: %s" % json.dumps(explain(), default=str))
+            except Exception as e:
+                logging.warning("Unable to explain the query: %s" % repr(e))
+
+    def get(self):
+        """
+        Returns the statistics, the methods and the queries being sorted by total time (descending).
+        """
+        with self._lock:
+            methods = []
+            for method, stats in self._methods.items():
+                queries = [dict(q, query=key, avgTime=q['time'] / q['count'])
+                           for key, q in stats['queries'].items()]
+                methods.append(dict(
+                    stats, method=method,
+                    avgTime=stats['time'] / stats['calls'] if stats['calls'] > 0 else None,
+                    docs=sum(q['docs'] for q in queries),
+                    queries=sorted(queries, key=lambda q: q['time'], reverse=True)))
+            return {
+                'since': self._start,
+                'slowQueryThreshold': Conf['data']['instrumentation']['slowQueryThreshold'],
+                'methods': sorted(methods, key=lambda m: m['time'], reverse=True)
+            }
+
+    def reset(self):
+        with self._lock:
+            self._methods = {}
+            self._start = time.time()
+
+# this module is a singleton
+_instance = None
+
+_lock = Lock()
+
+def getInstance():
+    global _instance
+    global _lock
+    if _instance is None:
+        with _lock:
+            # re-test the _instance value, avoiding the case where another
+            # thread did the initialization between the previous test and the
+            # lock
+            if _instance is None:
+                _instance = QueryStats()
+    return _instance
+
+def getStats():
+    return getInstance().get()
+
+def resetStats():
+    getInstance().reset()
+
+
+class InstrumentedCursor(object):
+    """
+    Wraps a cursor (or the iterator returned by `aggregate`), recording the query once all the documents
+    have been read. The query is attributed to the service method that created the cursor.
+    """
+    def __init__(self, cursor, collection, op, query, explain):
+        super(InstrumentedCursor, self).__init__()
+        self._cursor = cursor
+        self._collection = collection
+        self._op = op
+        self._query = query
+        self._explain = explain
+        self._method = _currentMethod()
+        self._time = 0.0
+        self._docs = 0
+        self._recorded = False
+
+    def __getattr__(self, attr):
+        value = getattr(self._cursor, attr)
+        if not callable(value):
+            return value
+
+        @wraps(value)
+        def chained(*args, **kwargs):
+            res = value(*args, **kwargs)
+            # sort, skip, limit... return the cursor itself
+            return self if res is self._cursor else res
+        return chained
+
+    def count(self, *args, **kwargs):
+        start = time.time()
+        res = self._cursor.count(*args, **kwargs)
+        getInstance().recordQuery(self._method, self._collection, 'count', self._query,
+                                  time.time() - start, 0, self._explain)
+        return res
+
+    def _record(self):
+        if not self._recorded:
+            self._recorded = True
+            getInstance().recordQuery(self._method, self._collection, self._op, self._query,
+                                      self._time, self._docs, self._explain)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.time()
+        try:
+            doc = next(self._cursor)
+        except StopIteration:
+            self._time += time.time() - start
+            self._record()
+            raise
+        self._time += time.time() - start
+        self._docs += 1
+        return doc
+
+    next = __next__
+
+    def __del__(self):
+        # the cursor was not read until the end
+        if self._docs > 0 or self._time > 0:
+            self._record()
+
+
+class InstrumentedCollection(object):
+    """
+    Wraps the collection of a service, recording the duration, the number of documents and the shape
+    of each query (see `QueryStats`). Attributes that are not queries are read from the collection.
+    """
+    def __init__(self, collection):
+        super(InstrumentedCollection, self).__init__()
+        self._collection = collection
+
+    def __getattr__(self, attr):
+        return getattr(self._collection, attr)
+
+    def _explainFind(self, spec):
+        return lambda: self._collection.find(spec).explain()
+
+    def _record(self, op, query, start, docs, explain=None):
+        getInstance().recordQuery(
+            _currentMethod(), self._collection, op, query, time.time() - start, docs, explain)
+
+    def find(self, spec=None, *args, **kwargs):
+        return InstrumentedCursor(self._collection.find(spec, *args, **kwargs),
+                                  self._collection, 'find', spec or {}, self._explainFind(spec))
+
+    def find_one(self, spec=None, *args, **kwargs):
+        start = time.time()
+        res = self._collection.find_one(spec, *args, **kwargs)
+        self._record('find_one', spec or {}, start, 1 if res is not None else 0, self._explainFind(spec))
+        return res
+
+    def find_one_and_delete(self, spec, *args, **kwargs):
+        start = time.time()
+        res = self._collection.find_one_and_delete(spec, *args, **kwargs)
+        self._record('find_one_and_delete', spec, start, 1 if res is not None else 0, self._explainFind(spec))
+        return res
+
+    def count(self, *args, **kwargs):
+        start = time.time()
+        res = self._collection.count(*args, **kwargs)
+        self._record('count', args[0] if len(args) > 0 else {}, start, 0)
+        return res
+
+    def aggregate(self, pipeline, *args, **kwargs):
+        explain = lambda: self._collection.database.command(
+            'aggregate', self._collection.name, pipeline=pipeline, explain=True)
+        return InstrumentedCursor(self._collection.aggregate(pipeline, *args, **kwargs),
+                                  self._collection, 'aggregate', pipeline, explain)
+
+    def insert(self, doc_or_docs, *args, **kwargs):
+        start = time.time()
+        res = self._collection.insert(doc_or_docs, *args, **kwargs)
+        self._record('insert', {}, start, _count(res))
+        return res
+
+    def update(self, spec, document, *args, **kwargs):
+        start = time.time()
+        res = self._collection.update(spec, document, *args, **kwargs)
+        self._record('update', {'filter': spec, 'update': document}, start, _count(res), self._explainFind(spec))
+        return res
+
+    def remove(self, spec=None, *args, **kwargs):
+        start = time.time()
+        res = self._collection.remove(spec, *args, **kwargs)
+        self._record('remove', spec or {}, start, _count(res), self._explainFind(spec))
+        return res
+
+    def bulk_write(self, requests, *args, **kwargs):
+        start = time.time()
+        try:
+            return self._collection.bulk_write(requests, *args, **kwargs)
+        finally:
+            self._record('bulk_write', {type(op).__name__: True for op in requests}, start, len(requests))
+
+
+def instrumentMethod(name, method):
+    """
+    Wraps the given method of a service, recording the duration of its calls under the given name.
+    The queries run by the method are attributed to it.
+    """
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        stack = _stack()
+        stack.append(name)
+        start = time.time()
+        error = True
+        try:
+            res = method(*args, **kwargs)
+            error = False
+        finally:
+            stack.pop()
+            getInstance().recordCall(name, time.time() - start, error)
+        if isinstance(res, types.GeneratorType):
+            return _instrumentGenerator(name, res)
+        return res
+    return wrapper
+
+
+def _instrumentGenerator(name, generator):
+    """
+    The queries run while iterating over a generator returned by a method are attributed to this method.
+    """
+    stack = _stack()
+    while True:
+        stack.append(name)
+        start = time.time()
+        try:
+            item = next(generator)
+        except StopIteration:
+            return
+        finally:
+            stack.pop()
+            getInstance().recordCall(name, time.time() - start, count=False)
+        yield item
+
+
+def instrument(service):
+    """
+    Instrument the given service: its collection is wrapped in an `InstrumentedCollection`
+    and its public methods are wrapped by `instrumentMethod`. To be called by the constructor
+    of the service, before the collection is given to other objects.
+    """
+    service._collection = InstrumentedCollection(service._collection)
+    for attr in dir(type(service)):
+        if attr.startswith('_') or attr in IGNORED_METHODS or not callable(getattr(type(service), attr)):
+            continue
+        setattr(service, attr, instrumentMethod(
+            '%s.%s' % (type(service).__name__, attr), getattr(service, attr)))
@@ -0,0 +1,296 @@
+# -*- coding: utf8 -*-
+from __future__ import unicode_literals
+
+import logging
+import random
+from threading import Lock
+
+from bson.objectid import ObjectId
+from bson.son import SON
+from pymongo import ASCENDING, DESCENDING, UpdateOne, InsertOne
+from tqdm import tqdm
+
+from server.services.baseService import Service
+from tools.utils import extends
+
+"""
+Schema:
+    * _id:string id of the picture
+    * albumId:ObjectId id of the album holding this picture
+    * idx:int position of the picture in the album
+    * filename:string name of the picture file, in the folder of the album
+    * width:int width of the picture
+    * height:int height of the picture
+    * starred:boolean True if the picture has been starred
+    * analyzerVersion:string version of the analyzer the faces of this picture have been detected with,
+                             None if the picture has not been analyzed yet
+    * display:int number of times this picture has been displayed
+    * rand:int random number attributed to the picture on insertion,
+               used to shuffle the pictures of the random and starred albums
+"""
+
+# modulus of the hash used to shuffle the pictures (2^31 - 1), also the exclusive upper bound of the `rand` field
+HASH_MODULUS = 2147483647
+
+
+class PictureService(Service):
+    """
+    Provides helper functions related to the pictures collection of the database.
+    The pictures of the albums are stored in their own documents instead of an array
+    of the album document, so that a picture can be starred, removed or analyzed without
+    rewriting the whole album, and queried across albums using indexes.
+    Ids of albums are returned as strings.
+    """
+    def __init__(self, db):
+        super(PictureService, self).__init__(db, 'pictures')
+        # the index of the pictures can't be unique: the pictures following a removed one
+        # are shifted by a single update, that goes through duplicated indexes
+        if 'picture_album_idx_uq_idx' in self._collection.index_information():
+            self._collection.drop_index('picture_album_idx_uq_idx')
+        self._collection.ensure_index(
+            [('albumId', ASCENDING), ('idx', ASCENDING)], name="picture_album_idx_idx")
+        self._collection.ensure_index(
+            [('analyzerVersion', ASCENDING)], name="picture_analyzerVersion_idx")
+        self._collection.ensure_index(
+            [('starred', DESCENDING)], name="picture_starred_idx")
+        # serializes the insertions and removals of pictures (of this process), that compute the indexes
+        # of the pictures from the indexes of the other pictures of the album
+        self._indexLock = Lock()
+
+    def schema(self):
+        return {
+            'albumId': True,
+            'idx': True,
+            'filename': True,
+            'width': True,
+            'height': True,
+            'starred': True,
+            'analyzerVersion': True,
+            'display': True,
+            'rand': True
+        }
+
+    @staticmethod
+    def _out(picture):
+        if picture is not None and 'albumId' in picture:
+            picture['albumId'] = str(picture['albumId'])
+        return picture
+
+    def _post(self, albumId, idx, picture):
+        return self.validate({
+            'albumId': ObjectId(albumId),
+            'idx': idx,
+            'filename': picture['filename'],
+            'width': picture.get('width'),
+            'height': picture.get('height'),
+            'starred': picture.get('starred', False),
+            'analyzerVersion': picture.get('analyzerVersion'),
+            'display': picture.get('display', 0),
+            'rand': random.randrange(HASH_MODULUS)
+        })
+
+    def insert(self, albumId, filename, width=None, height=None, starred=False, analyzerVersion=None):
+        """
+        Add a picture at the end of the given album. Returns the index of the picture in the album.
+        """
+        with self._indexLock:
+            last = self._collection.find_one(
+                {'albumId': ObjectId(albumId)}, {'idx': True}, sort=[('idx', DESCENDING)])
+            idx = last['idx'] + 1 if last is not None else 0
+            self._collection.insert(self._post(albumId, idx, {
+                'filename': filename,
+                'width': width,
+                'height': height,
+                'starred': starred,
+                'analyzerVersion': analyzerVersion
+            }))
+        return idx
+
+    def insertMany(self, albumId, pictures):
+        """
+        Insert the given pictures (dicts with at least a `filename` field) at the beginning of
+        the given album, which is expected to be empty.
+        """
+        if len(pictures) == 0:
+            return
+        self._collection.bulk_write([
+            InsertOne(self._post(albumId, idx, picture))
+            for idx, picture in enumerate(pictures)
+        ], ordered=False)
+
+    def getByAlbum(self, albumId, page=0, perPage=0, fields=None):
+        """
+        Returns the pictures of the given album, in order.
+        If `perPage` is set, only the given page of pictures is returned.
+        """
+        projection = self.validate({f: True for f in fields}, strict=False) if fields is not None else None
+        cursor = self._collection.find({'albumId': ObjectId(albumId)}, projection).sort('idx', ASCENDING)
+        if perPage > 0:
+            cursor.skip(page * perPage).limit(perPage)
+        return [self._out(pic) for pic in cursor]
+
+    def getCovers(self, albums, fields=None):
+        """
+        Returns a dict {albumId: picture} with the cover picture of each of the given albums
+        (dicts holding at least the `_id` and `cover` fields), retrieved with a single query.
+        """
+        if len(albums) == 0:
+            return {}
+        projection = self.validate({f: True for f in fields}, strict=False) if fields is not None else None
+        if projection is not None:
+            projection.update(albumId=True, idx=True)
+        cursor = self._collection.find({'$or': [
+            {'albumId': ObjectId(album['_id']), 'idx': album.get('cover', 0)}
+            for album in albums
+        ]}, projection)
+        return {pic['albumId']: pic for pic in (self._out(pic) for pic in cursor)}
+
+    def countByAlbum(self, albumId):
+        return self._collection.find({'albumId': ObjectId(albumId)}).count()
+
+    def getPicture(self, albumId, idx):
+        return self._out(self._collection.find_one({'albumId': ObjectId(albumId), 'idx': idx}))
+
+    def exists(self, albumId, filename):
+        return self._collection.find_one(
+            {'albumId': ObjectId(albumId), 'filename': filename}, {'_id': True}) is not None
+
+    def setStarred(self, albumId, idx, starred):
+        """
+        Star or unstar the given picture. Returns True if the picture has been modified.
+        """
+        res = self._collection.update(
+            {'albumId': ObjectId(albumId), 'idx': idx, 'starred': {'$ne': starred}},
+            {'$set': {'starred': starred}})
+        return res['n'] > 0
+
+    def setDim(self, albumId, idx, width, height):
+        self._collection.update(
+            {'albumId': ObjectId(albumId), 'idx': idx},
+            {'$set': {'width': width, 'height': height}})
+
+    def setAnalysis(self, pictures, version):
+        """
+        Save the analyzer version of the given pictures, expected to be a list of dicts
+        with the shape `{albumId, pictureIdx}`, in a single bulk write.
+        """
+        if len(pictures) == 0:
+            return
+        self._collection.bulk_write([
+            UpdateOne({'albumId': ObjectId(pic['albumId']), 'idx': pic['pictureIdx']},
+                      {'$set': {'analyzerVersion': version}})
+            for pic in pictures
+        ], ordered=False)
+
+    def remove(self, albumId, idx):
+        """
+        Remove the given picture from its album, and shift the index of the following pictures.
+        Returns the removed picture.
+        """
+        with self._indexLock:
+            picture = self._collection.find_one_and_delete({'albumId': ObjectId(albumId), 'idx': idx})
+            if picture is None:
+                return None
+            self._collection.update(
+                {'albumId': ObjectId(albumId), 'idx': {'$gt': idx}},
+                {'$inc': {'idx': -1}}, multi=True)
+        return self._out(picture)
+
+    def deleteAlbum(self, albumId):
+        return self._collection.remove({'albumId': ObjectId(albumId)}, multi=True)
+
+    def getUnanalyzed(self, version):
+        """
+        Returns a generator over the albums holding pictures that haven't been analyzed with
+        the given version of the analyzer yet, most recent albums first. Each album is a dict
+        {_id, name, fullPath, pictures}, where `pictures` is the list of its unanalyzed pictures
+        {idx, filename, analyzerVersion}, in order.
+        The selection, grouping and join with the albums are done by the database, using the index
+        on `analyzerVersion`: when all the pictures are analyzed, the query returns nothing.
+        Results are streamed from the cursor.
+        """
+        cursor = self._collection.aggregate([
+            {'$match': {'analyzerVersion': {'$ne': version}}},
+            {'$project': {'_id': False, 'albumId': True, 'idx': True, 'filename': True, 'analyzerVersion': True}},
+            {'$sort': SON([('albumId', ASCENDING), ('idx', ASCENDING)])},
+            {'$group': {
+                '_id': '$albumId',
+                'pictures': {'$push': {
+                    'idx': '$idx',
+                    'filename': '$filename',
+                    'analyzerVersion': '$analyzerVersion'
+                }}
+            }},
+            {'$lookup': {'from': 'albums', 'localField': '_id', 'foreignField': '_id', 'as': 'album'}},
+            {'$unwind': '$album'},
+            {'$project': {
+                'name': '$album.name',
+                'fullPath': '$album.fullPath',
+                'creation': '$album.creation',
+                'pictures': True
+            }},
+            {'$sort': {'creation': DESCENDING}}
+        ], allowDiskUse=True, cursor={})
+        for album in cursor:
+            album['_id'] = str(album['_id'])
+            yield album
+
+    def getShuffled(self, seed, page, perPage, starred=False):
+        """
+        Returns the given page of all the pictures (or only the starred ones), in a pseudo-random order
+        given by the seed: the same seed always gives the same order. Each picture is returned with
+        the `fullPath` of its album.
+        """
+        pipeline = []
+        if starred:
+            pipeline.append({'$match': {'starred': True}})
+        # seeded hash of the random number of each picture: a step of the Park-Miller generator
+        # followed by a non-linear mix. All the operations stay below 2^53 so that the computation
+        # is exact on doubles.
+        mixed = {'$mod': [
+            {'$add': [{'$multiply': [{'$ifNull': ['$rand', 0]}, 48271]}, seed % HASH_MODULUS]},
+            HASH_MODULUS]}
+        fields = {
+            'albumId': True,
+            'idx': True,
+            'filename': True,
+            'starred': True,
+            'width': True,
+            'height': True,
+            'analyzerVersion': True
+        }
+        pipeline += [
+            {'$project': extends({'mixed': mixed}, **fields)},
+            {'$project': extends({'key': {'$mod': [
+                {'$multiply': [
+                    '$mixed',
+                    {'$add': [{'$mod': ['$mixed', 65521]}, (seed // HASH_MODULUS) % 65521 + 1]}
+                ]},
+                HASH_MODULUS]}}, **fields)},
+            {'$sort': SON([('key', ASCENDING), ('_id', ASCENDING)])},
+            {'$skip': page * perPage},
+            {'$limit': perPage},
+            # only the pictures of the page are joined with their album
+            {'$lookup': {'from': 'albums', 'localField': 'albumId', 'foreignField': '_id', 'as': 'album'}},
+            {'$unwind': '$album'},
+            {'$project': extends({'_id': False, 'fullPath': '$album.fullPath'}, **fields)}
+        ]
+        cursor = self._collection.aggregate(pipeline, allowDiskUse=True, cursor={})
+        return [self._out(pic) for pic in cursor]
+
+    def migrateAlbums(self, albums):
+        """
+        Move the pictures still stored in the `picturesDetails` array of the documents of the given
+        collection of albums to this collection.
+        """
+        query = {'picturesDetails': {'$exists': True}}
+        nb = albums.find(query).count()
+        if nb == 0:
+            return
+        logging.info("Moving the pictures of %d albums to the pictures collection" % nb)
+        for album in tqdm(albums.find(query, {'picturesDetails': True}), total=nb, desc='[Migrating pictures'):
+            self.deleteAlbum(album['_id'])
+            self.insertMany(album['_id'], album['picturesDetails'])
+            albums.update(
+                {'_id': ObjectId(album['_id'])},
+                {'$unset': {'picturesDetails': True}})
@@ -3,6 +3,7 @@ from __future__ import unicode_literals
 
 from pprint import pformat
 import logging
+from threading import Lock
 
 from bson.objectid import ObjectId
 
@@ -18,15 +19,26 @@ Schema:
                      If the regexp does match the name of the video or the album,
                      this tag will be automatically added to the video or the album.
     * home:boolean state whether videos and pictures related to this tag should be displayed on the home page
+    * videoUsage:int number of videos holding this tag
+    * albumUsage:int number of albums holding this tag
 """
 
 class TagService(Service):
     """
     Provides helper functions related to the tags collection
     of the database.
+    Tags rarely change, so they are kept in a process-wide cache that is reloaded
+    whenever a tag is created, edited or deleted.
     """
     def __init__(self, db):
         super(TagService, self).__init__(db, 'tags')
+        self._cacheLock = Lock()
+        # incremented each time the tags change, the cache is reloaded if its version is outdated
+        self._version = 0
+        self._cache = None
+        # tags created before the usage counters were introduced don't have them yet
+        if self._collection.find_one({'videoUsage': {'$exists': False}}, {'_id': True}) is not None:
+            self.rebuildUsage()
 
     def schema(self):
         return {
@@ -34,10 +46,16 @@ class TagService(Service):
             'value': True,
             'relation': True,
             'autotag': True,
-            'home': True
+            'home': True,
+            'videoUsage': False,
+            'albumUsage': False
         }
 
-    def insert(self, name, value, _id=None, relation=False, autotag='', home=0):
+    def insert(self, name, value, _id=None, relation=False, autotag='', home=0, bulk=None):
+        """
+        Insert a new tag and returns its id. If `bulk` is given (see `Service.bulk`),
+        the insertion is queued in it instead.
+        """
         logging.debug("Saving new tag: %s - %s" % (name, value))
         post = self.schema()
         post['name'] = name
@@ -45,62 +63,154 @@ class TagService(Service):
         post['relation'] = True if relation else False
         post['autotag'] = autotag;
         post['home'] = home
+        post['videoUsage'] = 0
+        post['albumUsage'] = 0
         if _id is not None:
             if not isinstance(_id, ObjectId):
                 _id = ObjectId(_id)
             post['_id'] = _id
-        return self._collection.insert(self.validate(post))
+        if bulk is not None:
+            return bulk.insert(post)
+        res = self._collection.insert(self.validate(post))
+        self.invalidateCache()
+        return res
 
-    def populate(self, videos):
+    def set(self, _id, field, value, update=None, validate=True):
+        super(TagService, self).set(_id, field, value, update, validate)
+        self.invalidateCache()
+
+    def deleteById(self, _id):
+        res = super(TagService, self).deleteById(_id)
+        self.invalidateCache()
+        return res
+
+    def deleteAll(self):
+        res = super(TagService, self).deleteAll()
+        self.invalidateCache()
+        return res
+
+    def _afterBulkWrite(self, ops, chunk):
+        super(TagService, self)._afterBulkWrite(ops, chunk)
+        self.invalidateCache()
+
+    def rebuildUsage(self):
         """
-        For each video, will populate the `tags_list` field with a list of
-        tags object retrieved from the database, that match the tag ids found
-        in the `tags` field of each video.
+        Recompute the `videoUsage` and `albumUsage` counters of all the tags from
+        the tags attached to the videos and albums.
+        The counters are maintained when tagging and untagging videos and albums,
+        this is only useful to repair them.
         """
-        # collect all ids
-        tags = []
-        for video in videos:
-            for x in range(len(video['tags'])):
+        logging.info("Rebuilding tags usage counters")
+        self._collection.update(
+            {}, {'$set': {'videoUsage': 0, 'albumUsage': 0}}, multi=True)
+        for collection, field in [('videos', 'videoUsage'), ('albums', 'albumUsage')]:
+            cursor = self._db[collection].aggregate([
+                {'$project': {'tags': True}},
+                {'$unwind': '$tags'},
+                {'$group': {'_id': '$tags', 'count': {'$sum': 1}}}
+            ], cursor={})
+            for usage in cursor:
                 try:
-                    tags.append(ObjectId(video['tags'][x]))
+                    tagId = ObjectId(usage['_id'])
                 except:
-                    logging.error("TagId: %s (tag #%d) seems to not be a valid\
- objectId (video %s, id=%s)" % (video['tags'][x], x, video['filename'], video['_id']))
-        # retrieve objects from the collection
-        tags = self._collection.find({'_id': {'$in': tags}})
-        # index by id
-        tags = {tag['_id']: {
+                    logging.error("TagId: %s seems to not be a valid objectId (%d %s)"
+                                  % (usage['_id'], usage['count'], collection))
+                    continue
+                self._collection.update(
+                    {'_id': tagId}, {'$set': {field: usage['count']}})
+
+    def _loadCache(self):
+        """
+        Load all the tags from the database and index them the way they are looked up.
+        """
+        logging.debug("Loading tags cache (version %d)" % self._version)
+        cache = {
+            'version': self._version,
+            'byId': {},
+            'all': [],
+            'auto': [],
+            'home': [],
+            'relation': []
+        }
+        for tag in self._collection.find({}, {'videoUsage': False, 'albumUsage': False}):
+            cache['all'].append(tag)
+            # form of the tag used to populate the videos
+            cache['byId'][tag['_id']] = {
                 'name': tag['name'].title(),
                 'value': tag['value'].title(),
                 '_id': tag['_id'],
-                'relation': tag['relation']
-            } for tag in tags}
-        # make the replacement
-        default = lambda _id: {'name': 'Undefined', 'value': 'Undefined', '_id': _id, 'relation': 'Undefined'}
+                'relation': tag.get('relation')
+            }
+            # legacy tags may lack these fields
+            if tag.get('autotag', '') != '':
+                cache['auto'].append(tag)
+            if tag.get('home') is not False:
+                cache['home'].append(tag)
+            if tag.get('relation') is not False:
+                cache['relation'].append(tag)
+        return cache
+
+    def _getCache(self):
+        cache = self._cache
+        if cache is not None and cache['version'] == self._version:
+            return cache
+        with self._cacheLock:
+            if self._cache is None or self._cache['version'] != self._version:
+                self._cache = self._loadCache()
+            return self._cache
+
+    def invalidateCache(self):
+        """
+        Mark the tags cache as outdated, tags will be reloaded from the database
+        on the next lookup.
+        """
+        with self._cacheLock:
+            self._version += 1
+
+    def populate(self, videos):
+        """
+        For each video, will populate the `tags_list` field with a list of
+        tags object retrieved from the tags cache, that match the tag ids found
+        in the `tags` field of each video.
+        """
+        tags = self._getCache()['byId']
         for video in videos:
-            video['tags_list'] = [(tags[tid]) for tid in video['tags'] if tid in tags]
+            video['tags_list'] = [dict(tags[tid]) for tid in video['tags'] if tid in tags]
+
+    def getUsage(self, tagIds):
+        """
+        Returns a dict {tagId: {'videoUsage': int, 'albumUsage': int}} for each of the given tags.
+        Usage counters are not cached as they change every time a video or an album is tagged.
+        """
+        cur = self._collection.find(
+            {'_id': {'$in': [ObjectId(tagId) for tagId in tagIds]}},
+            {'videoUsage': True, 'albumUsage': True})
+        return {
+            tag['_id']: {
+                'videoUsage': tag.get('videoUsage', 0),
+                'albumUsage': tag.get('albumUsage', 0)
+            } for tag in cur}
+
+    def getTags(self):
+        """
+        Returns all the tags, without their usage counters.
+        """
+        return [dict(t) for t in self._getCache()['all']]
 
     def getAutoTags(self):
         """
         Returns all the tags that have an non-empty autotag field
         """
-        cur = self._collection.find({'autotag': {'$ne': ''}})
-        return [t for t in cur]
+        return [dict(t) for t in self._getCache()['auto']]
 
     def getHomeTags(self, returnList=False):
         """
         Returns all the tags that should be used to build the home page
         """
-        cur = self._collection.find({'home': {'$ne': False}})
-        if returnList:
-            return [t for t in cur]
-        return cur
+        return [dict(t) for t in self._getCache()['home']]
 
     def getRelationTags(self, returnList=False):
         """
-        Returns all the tags that should be used to build the home page
+        Returns all the tags that should be used to find related videos
         """
-        cur = self._collection.find({'relation': {'$ne': False}})
-        if returnList:
-            return [t for t in cur]
-        return cur
+        return [dict(t) for t in self._getCache()['relation']]
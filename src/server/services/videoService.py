@@ -2,13 +2,20 @@
 from __future__ import unicode_literals
 
 from pprint import pformat
+import base64
+import hashlib
 import logging
 import time
+from bson import json_util
 from bson.objectid import ObjectId
-from pymongo import DESCENDING, ASCENDING
+from pymongo import DESCENDING, ASCENDING, InsertOne
 from bson.son import SON
 
+from server import memory
 from server.services.baseService import Service
+from server.services.counterBuffer import CounterBuffer
+from server.nameIndex import NameIndex
+from server.tagIndex import TagIndex
 from conf import Conf
 from tools.utils import extends, dateFormat
 
@@ -29,6 +36,8 @@ Schema:
                              a snapshot visualization of the video.
                              WARNING: The path does not include  the video root prefix.
     * nbSnapshots:int number of snapshots for this video
+    * snapshotsVersion:int incremented each time the snapshots change, part of their URLs so that they
+                           can be cached by the clients (0 if missing)
     * thumbnail:string index of the snapshot that should be used as thumbnail.
                        if not set, a random snapshot will be used instead.
                        This thumbnail is expected to be found in the snapshot folder of the video
@@ -39,30 +48,44 @@ Schema:
     * fps:int number of frames per seconds for this video
     * creation:float timestamp of the creation of the video
     * lastTagged:float timestamp of the last time this video has been tagged
-    * tagHistory:array<float> timestamps of the times this video has been tagged
     * lastDisplay:float timestamp of the last time this video has been displayed
-    * displayHistory:array<float> timestamps of the times this video has been displayed
     * lastSeen:float timestamp of the last time this video has been downloaded or
                      marked as 'seen' by the user.
-    * seenHistory:array<float> timestamps of the times this video has been seen
     * lastFavorite:float timestamp of the last time this video has been marked favorite
-    * favoriteHistory:array<float> list of timestamp recording the times the video is marked as 'favorite'
     * lastToWatch:float timestamp of the last time this video has been marked as 'to see'
-    * toWatchHistory:array<float> list of timestamp recording the times a video is marked as 'to see'
     * analysis:dict automated video frames analysis results if performed. Structure:
                     `{gcv: {raw: [<gcv response for each frame],
                             pp: [<gcv response post-processed],
                             aggreg: {<aggregation of all frames' analyzis into a single object}}}`
 """
 
+# number of videos whose snapshots folder and version are kept in memory (see `getSnapshotsInfo`)
+SNAPSHOTS_CACHE_SIZE = 10000
+# maximum number of search criteria whose number of matching videos is kept in memory
+COUNTS_CACHE_SIZE = 1000
+
 
 class VideoService(Service):
     """
     Provides helper functions related to the videos collection
     of the database.
     """
-    def __init__(self, db):
+    TAG_USAGE_FIELD = 'videoUsage'
+
+    def __init__(self, db, history):
+        """
+        `history` is the HistoryService where the events related to the videos
+        (display, seen, favorite, ...) are recorded.
+        """
         super(VideoService, self).__init__(db, 'videos')
+        self._history = history
+        self._history.migrateVideos(self._collection)
+        self._counters = CounterBuffer(
+            self._collection, self._history,
+            {'seen': 'lastSeen', 'display': 'lastDisplay'},
+            interval=Conf['data']['videos']['counterFlushInterval'])
+        self._nameIndex = NameIndex(self._collection)
+        self._tagIndex = TagIndex(self._collection)
         self._collection.ensure_index(
             [('path', DESCENDING)],
             name="video_path_uq_idx", unique=True)
@@ -86,6 +109,8 @@ class VideoService(Service):
             [('lastSeen', DESCENDING)], name="video_lastSeen_idx")
         self._collection.ensure_index(
             [('lastFavorite', DESCENDING)], name="video_lastFavorite_idx")
+        self._collection.ensure_index(
+            [('tags', ASCENDING)], name="video_tags_idx")
 
     def schema(self):
         return {
@@ -100,6 +125,7 @@ class VideoService(Service):
             'tags': True,
             'snapshotsFolder': True,
             'nbSnapshots': True,
+            'snapshotsVersion': False,
             'thumbnail': True,
             'duration': True,
             'fileSize': True,
@@ -107,15 +133,10 @@ class VideoService(Service):
             'height': True,
             'fps': True,
             'creation': True,
-            'taggedHistory': False,
             'lastTagged': True,
-            'displayHistory': False,
             'lastDisplay': True,
-            'seenHistory': False,
             'lastSeen': True,
-            'favoriteHistory': False,
             'lastFavorite': True,
-            'toWatchHistory': False,
             'lastToWatch': True,
             'analysis': False
         }
@@ -126,9 +147,12 @@ class VideoService(Service):
                lastDisplay=0, lastSeen=0, lastFavorite=0, lastToWatch=0,
                thumbnail=None, tags=None, _id=None, nbSnapshots=0, fileSize=0,
                lastTagged=0, taggedHistory=None, displayHistory=None, seenHistory=None,
-               favoriteHistory=None, toWatchHistory=None):
+               favoriteHistory=None, toWatchHistory=None, bulk=None):
         """
-        Insert a new document and returns its id
+        Insert a new document and returns its id.
+        If `bulk` is given (see `Service.bulk`), the insertion is queued in it instead, the
+        tags usage and the history are recorded once per chunk of the bulk, for the documents
+        that have been written.
         """
         logging.debug("Saving new video: %s" % filename)
         if name is None:
@@ -158,22 +182,75 @@ class VideoService(Service):
         post['lastFavorite'] = lastFavorite
         post['lastToWatch'] = lastToWatch
         post['lastTagged'] = lastTagged
-        post['taggedHistory'] = taggedHistory or []
-        post['displayHistory'] = displayHistory or []
-        post['seenHistory'] = seenHistory or []
-        post['favoriteHistory'] = favoriteHistory or []
-        post['toWatchHistory'] = toWatchHistory or []
         post['toWatch'] = toWatch
         post['snapshotsFolder'] = snapshotsFolder
         post['nbSnapshots'] = nbSnapshots
+        post['snapshotsVersion'] = 0
         post['thumbnail'] = thumbnail
         post['fileSize'] = fileSize
         post['analysis'] = {}
         if _id is not None:
             post['_id'] = ObjectId(_id)
+
+        history = [('tagged', taggedHistory), ('display', displayHistory), ('seen', seenHistory),
+                   ('favorite', favoriteHistory), ('toWatch', toWatchHistory)]
+
+        if bulk is not None:
+            def inserted():
+                # written by `_afterBulkWrite` for the whole chunk
+                self._tagIndex.add(post['_id'], post['tags'])
+                usage = bulk.chunk.setdefault('tagUsage', {})
+                for tagId in post['tags']:
+                    usage[tagId] = usage.get(tagId, 0) + 1
+                bulk.chunk.setdefault('history', []).extend(
+                    (post['_id'], event, timestamps) for event, timestamps in history if timestamps)
+
+            _id = bulk.insert(post, onSuccess=inserted)
+            return str(_id)
         _id = self._collection.insert(self.validate(post))
+        self._countMatching.clear()
+        self._nameIndex.add(_id, post['name'])
+        self._tagIndex.add(_id, post['tags'])
+        self._incrementTagUsage(post['tags'])
+        self._history.recordEvents(
+            (_id, event, timestamps) for event, timestamps in history if timestamps)
         return str(_id)
 
+    def deleteById(self, _id):
+        video = self._collection.find_one({'_id': ObjectId(_id)}, {'tags': True})
+        res = super(VideoService, self).deleteById(_id)
+        self.getSnapshotsInfo.invalidate(str(_id))
+        self._countMatching.clear()
+        if video is not None:
+            self._incrementTagUsage(video['tags'], -1)
+            self._tagIndex.remove(_id, video['tags'])
+        self._history.deleteVideo(_id)
+        return res
+
+    def deleteAll(self):
+        """
+        Warning: will delete ALL the videos and their history
+        """
+        self._history.deleteAll()
+        self._tagIndex.clear()
+        self._countMatching.clear()
+        return super(VideoService, self).deleteAll()
+
+    def _afterBulkWrite(self, ops, chunk):
+        super(VideoService, self)._afterBulkWrite(ops, chunk)
+        self._countMatching.clear()
+        if any(not isinstance(op, InsertOne) for op in ops):
+            self._tagIndex.clear()
+        self._incrementTagUsageMany(chunk.get('tagUsage', {}))
+        self._history.recordEvents(chunk.get('history', []))
+
+    def getHistory(self, _id, events=None, since=None, until=None):
+        """
+        Returns a dict {<event>: [timestamps]} of the events that happened to the given video
+        (see HistoryService.getHistory).
+        """
+        return self._history.getHistory(_id, events, since, until)
+
     def increment(self, _id, field, val=1):
         """
         If _id is a list, it will be used as a list of video ids
@@ -190,25 +267,41 @@ class VideoService(Service):
             'favorite': 'lastFavorite',
             'toWatch': 'lastToWatch'
         }
-        corresp_history_record = {
-            'seen': 'seenHistory',
-            'display': 'displayHistory',
-            'favorite': 'favoriteHistory',
-            'toWatch': 'toWatchHistory'
-        }
         update = {
             '$inc': self.validate({field: val}, strict=False)
         }
         t = time.time()
         if field in corresp_ts_record:
             update['$set'] = {corresp_ts_record[field]: t}
-        if field in corresp_history_record:
-            update['$push'] = {corresp_history_record[field]: t}
         if field == 'seen':
             update['$set'] = update.get('$set', {})
             update['$set']['toWatch'] = False
 
         self._collection.update(select, update, multi=True)
+        if field in corresp_ts_record:
+            self._history.record(_id, field, t)
+        if field == 'snapshotsVersion':
+            for i in (_id if isinstance(_id, list) else [_id]):
+                self.getSnapshotsInfo.invalidate(str(i))
+
+    def incrementBuffered(self, _id, field):
+        """
+        Increment by one the counter `field` ('display' or 'seen') of the video given by id,
+        or of each video if `_id` is a list. Unlike `increment`, the change is not written
+        to the database right away but within `Conf['data']['videos']['counterFlushInterval']`
+        seconds, along with all the other buffered increments.
+        """
+        self._counters.add(_id if isinstance(_id, list) else [_id], field)
+
+    def flushCounters(self, stop=False):
+        """
+        Write the buffered counters increments to the database.
+        If stop is set to True, counters won't be buffered anymore.
+        """
+        if stop:
+            self._counters.stop()
+        else:
+            self._counters.flush()
 
     def set(self, _id, field, value):
         logging.debug('videoService.set(%s, %s, %s)', str(_id), str(field), str(value))
@@ -221,81 +314,112 @@ class VideoService(Service):
         corresp_ts_record = {
             'toWatch': 'lastToWatch'
         }
-        corresp_history_record = {
-            'toWatch': 'toWatchHistory'
-        }
 
         t = time.time()
         update = {}
         if field in corresp_ts_record:
             update['$set'] = {corresp_ts_record[field]: t}
-        if field in corresp_history_record:
-            update['$push'] = {corresp_history_record[field]: t}
 
         super(VideoService, self).set(_id, field, value, update)
+        if field in corresp_ts_record:
+            self._history.record(_id, field, t)
 
     def addTag(self, _id, tagId):
         logging.debug("Pushing tag %s to video %s" % (tagId, _id))
-        q = {'_id': ObjectId(_id)}
+        # only match the video if it doesn't hold the tag yet, to know whether to count the new usage
+        q = {'_id': ObjectId(_id), 'tags': {'$ne': tagId}}
         t = time.time()
-        self._collection.update(q, {
+        res = self._collection.update(q, {
             '$addToSet': {'tags': tagId},
-            '$set': {'lastTagged': t},
-            '$push': {'taggedHistory': t}
+            '$set': {'lastTagged': t}
         })
+        if res['n'] > 0:
+            self._incrementTagUsage([tagId])
+            self._tagIndex.add(_id, [tagId])
+            self._history.record(_id, 'tagged', t)
 
     def removeTag(self, tagId, videoId=None):
+        """
+        Remove the given tag from the given video, or from all the videos holding it
+        if `videoId` is not given (the tag is being deleted, its usage counter is not maintained).
+        """
         if videoId is not None:
-            self._collection.update(
-                {'_id': ObjectId(videoId)},
+            res = self._collection.update(
+                {'_id': ObjectId(videoId), 'tags': tagId},
                 {'$pull': {'tags': tagId}})
+            if res['n'] > 0:
+                self._incrementTagUsage([tagId], -1)
+                self._tagIndex.remove(videoId, [tagId])
         else:
             self._collection.update(
                 {'tags': {'$in': [tagId]}},
                 {'$pull': {'tags': tagId}},
                 multi=True)
+            self._tagIndex.removeTag(tagId)
+
+    def sampleByTag(self, tagId, n):
+        """
+        Returns (at most) `n` videos picked randomly by the database among the videos holding the given tag,
+        without loading the other ones.
+        """
+        cursor = self._collection.aggregate([
+            {'$match': {'tags': tagId}},
+            {'$sample': {'size': n}}
+        ], cursor={})
+        res = []
+        for video in cursor:
+            video['_id'] = str(video['_id'])
+            res.append(video)
+        return res
+
+    def getRelated(self, _id, tagIds, k):
+        """
+        Returns the list of the (at most) `k` tuples (videoId, score) of the videos sharing the most
+        of the given tags (expected to be tags of the given video), by decreasing score, where the score
+        is the number of these tags the video holds. The given video is not returned.
+        Only the posting lists of the given tags are read from the in-memory tag index.
+        """
+        return self._tagIndex.topOverlap(tagIds, k, exclude=_id)
 
     def getByPath(self, path):
         if Conf['data']['videos']['rootFolder'] in path:
             path = path[len(Conf['data']['videos']['rootFolder']):]
         return self._collection.find_one({'path': path})
 
-    def find(self, criteria, page=0, item_per_page=0, generator=True, returnCount=False, analyzed_only=False):
+    @memory.memoize('snapshots', maxSize=SNAPSHOTS_CACHE_SIZE)
+    def getSnapshotsInfo(self, _id):
         """
-        Retrieve videos from database, given the defined criteria.
-        If more than a defined number of items per page exist, the page
-        parameter can be specified to ask for the nth group of videos.
-        Criteria is expected to be an dict with the following structure: {
-            'type': <'any'|'all'>
-            'video': [  # filters related to the video itself.
-                {'$comparator': <'='|'<'|'>'>, $negated: True|False, <field>:<value>}, ...
-            ]
-            'tags': [   # tag filtering
-                {$negated: True|False, $value: <tag_id>}, ...
-            ],
-            sort: [[field, 1 | -1]]
-        }
-        The 'type' field allow to ask for all specified criteria to be present, or
-        to ask for any of the specified criteria to be present.
-        The 'video' list contains filters related to the fields of the video object,
-        and the 'tags' list contains filters related to the tags attached to the video.
-        The 'video' filters are dicts where keys are video property names, and value
-        is the expected value. The special '$comparator' key can be used if the value
-        is an integer.
-        The 'tags' filters are simple tag ids
-        The 'sort' field is an array with the structure [field, order]. Default is `['creation': -1]`
-        The generator parameter allow to ask for a generator or a fully generated list.
-        It count is set to true, the returned item is in a tuple along with the total number of
-        items matching this criteria.
-        If analyzed_only is set to true, only analyzer videos will be returned.
+        Returns the folder (without the video root prefix) and the version of the snapshots of the given
+        video, `{snapshotsFolder, snapshotsVersion}`, or None if there is no such video.
+        The result is kept in memory (invalidated when the version is incremented), so that
+        the video is not loaded each time one of its snapshots is downloaded.
         """
-        logging.debug("Building mongo criteria from criteria: %s" % pformat(criteria))
-
-        # apply default values to the criteria
-        criteria = extends(criteria, type='any', video=[], tags=[], sort=[])
-        if len(criteria['sort']) == 0 or criteria['sort'][0][0] != 'lastSeen':
-            criteria['sort'].append(['lastSeen', ASCENDING])
+        video = self._collection.find_one(
+            {'_id': ObjectId(_id)}, {'snapshotsFolder': True, 'snapshotsVersion': True})
+        if video is None:
+            return None
+        return {
+            'snapshotsFolder': video['snapshotsFolder'],
+            'snapshotsVersion': video.get('snapshotsVersion', 0)
+        }
 
+    def _sortKeys(self, sort):
+        """
+        Returns the complete list of sort keys [[field, order], ...] for the given requested sort,
+        always ending with `lastSeen` and `_id` so that the order of the videos is deterministic.
+        """
+        keys = [[field, int(order)] for field, order in sort]
+        if len(keys) == 0 or keys[0][0] != 'lastSeen':
+            keys.append(['lastSeen', ASCENDING])
+        if '_id' not in [field for field, order in keys]:
+            keys.append(['_id', DESCENDING])
+        return keys
+
+    def _mongoCriteria(self, criteria):
+        """
+        Build the mongo criteria matching the video and tags filters of the given criteria
+        (see `find`).
+        """
         mongo_criteria = []
         # video filter
         for filtre in criteria['video']:
@@ -315,6 +439,11 @@ class VideoService(Service):
                     mongo_filtre[key] = {'$regex': '.*' + '.*'.join(val.split(' ')) + '.*', '$options': 'is'}
                     if filtre['$negated']:
                         mongo_filtre[key] = {'$not': mongo_filtre[key]}
+                        continue
+                    # restrict the regexp to the candidates found in the name index
+                    candidates = self._nameIndex.search(val)
+                    if candidates is not None:
+                        mongo_filtre['_id'] = {'$in': [ObjectId(c) for c in candidates]}
                     continue
 
                 # convert our comparator to mongoDB comparison system
@@ -355,17 +484,112 @@ class VideoService(Service):
         else:
             logging.error("Unrecognized criteria type: %s" % criteria['type'])
 
+        return mongo_criteria
+
+    def pageToken(self, criteria, page, lastVideo):
+        """
+        Returns an opaque continuation token allowing to retrieve the page that follows
+        the page number `page` (whose last video is `lastVideo`) with `find`.
+        """
+        criteria = extends(criteria, type='any', video=[], tags=[], sort=[])
+        keys = self._sortKeys(criteria['sort'])
+        token = {
+            'page': page + 1,
+            'filter': self._criteriaFingerprint(criteria),
+            'sort': keys,
+            'after': [lastVideo.get(field) for field, order in keys]
+        }
+        return base64.urlsafe_b64encode(json_util.dumps(token).encode('utf8')).decode('ascii')
+
+    def _criteriaFingerprint(self, criteria):
+        mongo_criteria = self._mongoCriteria(criteria)
+        return hashlib.sha1(json_util.dumps(mongo_criteria, sort_keys=True).encode('utf8')).hexdigest()
+
+    def _keysetCriteria(self, criteria, keys, token, page):
+        """
+        Returns the mongo criteria matching the videos that come after the last video
+        of the previous page, given the continuation token of this page,
+        or None if the token can't be used for the requested page and sort.
+        """
+        try:
+            token = json_util.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf8'))
+        except Exception as e:
+            logging.warning("Invalid page token: %s" % repr(e))
+            return None
+        # the token is only valid for the page that follows the one it has been built from,
+        # with the same filters and sort
+        if token['page'] != page or token['sort'] != keys \
+                or token['filter'] != self._criteriaFingerprint(criteria):
+            return None
+        # ((k1 > v1) OR (k1 = v1 AND k2 > v2) OR ...), using < for descending keys
+        clauses = []
+        for idx, (field, order) in enumerate(keys):
+            value = token['after'][idx]
+            clause = {f: token['after'][i] for i, (f, o) in enumerate(keys[:idx])}
+            if value is None:
+                # null values come first in ascending order and last in descending order
+                if order == DESCENDING:
+                    continue
+                clause[field] = {'$ne': None}
+            elif order == ASCENDING:
+                clause[field] = {'$gt': value}
+            else:
+                # also match null values, that come after any other value in descending order
+                clause[field] = {'$not': {'$gte': value}}
+            clauses.append(clause)
+        return {'$or': clauses}
+
+    def find(self, criteria, page=0, item_per_page=0, generator=True, returnCount=False, analyzed_only=False,
+             token=None):
+        """
+        Retrieve videos from database, given the defined criteria.
+        If more than a defined number of items per page exist, the page
+        parameter can be specified to ask for the nth group of videos.
+        Criteria is expected to be an dict with the following structure: {
+            'type': <'any'|'all'>
+            'video': [  # filters related to the video itself.
+                {'$comparator': <'='|'<'|'>'>, $negated: True|False, <field>:<value>}, ...
+            ]
+            'tags': [   # tag filtering
+                {$negated: True|False, $value: <tag_id>}, ...
+            ],
+            sort: [[field, 1 | -1]]
+        }
+        The 'type' field allow to ask for all specified criteria to be present, or
+        to ask for any of the specified criteria to be present.
+        The 'video' list contains filters related to the fields of the video object,
+        and the 'tags' list contains filters related to the tags attached to the video.
+        The 'video' filters are dicts where keys are video property names, and value
+        is the expected value. The special '$comparator' key can be used if the value
+        is an integer.
+        The 'tags' filters are simple tag ids
+        The 'sort' field is an array with the structure [field, order]. Default is `['creation': -1]`
+        The generator parameter allow to ask for a generator or a fully generated list.
+        It count is set to true, the returned item is in a tuple along with the total number of
+        items matching this criteria (see `_countMatching`).
+        If analyzed_only is set to true, only analyzer videos will be returned.
+        The `token` parameter can be set to the continuation token returned by `pageToken`
+        for the previous page: the requested page will then start right after the last video
+        of the previous page instead of skipping all the videos of the previous pages.
+        """
+        logging.debug("Building mongo criteria from criteria: %s" % pformat(criteria))
+
+        # apply default values to the criteria
+        criteria = extends(criteria, type='any', video=[], tags=[], sort=[])
+        sortKeys = self._sortKeys(criteria['sort'])
+
+        mongo_criteria = self._mongoCriteria(criteria)
         logging.debug("Performing search criteria: \n%s" % pformat(mongo_criteria))
+        countKey = json_util.dumps(mongo_criteria, sort_keys=True) if returnCount else None
         mongo_criteria['$comment'] = "Built from: %s" % pformat(criteria)
 
-        foundId = False
-        for sort in criteria['sort']:
-            sort[1] = int(sort[1])
-            if sort[0] == '_id':
-                foundId = True
-
-        if not foundId:
-            criteria['sort'].append(['_id', -1])
+        keyset = None
+        if token is not None and page > 0 and item_per_page > 0:
+            keyset = self._keysetCriteria(criteria, sortKeys, token, page)
+        # the keyset criteria can be applied before the projection (and use the indexes)
+        # unless the videos are sorted on a computed field
+        keysetOnStoredFields = keyset is not None and \
+            all(field in self.schema() or field == '_id' for field, order in sortKeys)
 
         aggreg = [
             {'$match': mongo_criteria}
@@ -373,6 +597,9 @@ class VideoService(Service):
         if analyzed_only:
             aggreg.append({'$match': {'analysis.faceTime': {'$gt': 0}}})
 
+        if keysetOnStoredFields:
+            aggreg.append({'$match': keyset})
+
         aggreg.append({
             # note here: all the fields have to be specified...
             '$project':extends(
@@ -389,15 +616,18 @@ class VideoService(Service):
                 ]}
             )
         })
+        if keyset is not None and not keysetOnStoredFields:
+            aggreg.append({'$match': keyset})
         aggreg.append({
-            '$sort': SON(criteria['sort'])
+            '$sort': SON(sortKeys)
         })
 
-        if page > 0:
+        if page > 0 and keyset is None:
             aggreg.append({'$skip': page * item_per_page})
         if item_per_page > 0:
             aggreg.append({'$limit': item_per_page})
-        cursor = self._collection.aggregate(aggreg, cursor={})
+
+        cursor = self._collection.aggregate(aggreg, allowDiskUse=True, cursor={})
 
         # manage the generator parameter
         if generator:
@@ -407,13 +637,23 @@ class VideoService(Service):
 
         # manage the `returnCount` parameter
         if returnCount:
-            count = self._collection.aggregate([
-                {'$match': mongo_criteria},
-                {'$group': {'_id': None, 'count': {'$sum': 1}}}
-            ])
-            try:
-                count = next(count)['count']
-            except StopIteration:
-                count = 0
-            return ret, count
+            return ret, self._countMatching(countKey, analyzed_only)
         return ret
+
+    @memory.memoize('videoCounts', ttl=Conf['data']['videos']['countCacheDelay'], maxSize=COUNTS_CACHE_SIZE)
+    def _countMatching(self, query, analyzed_only=False):
+        """
+        Returns the number of videos matching the given query (serialized as extended JSON).
+        Counts are kept in memory, so that browsing the pages of a search only counts the matching videos
+        once: they are dropped when videos are inserted or deleted, and after
+        `Conf['data']['videos']['countCacheDelay']` seconds for the other changes.
+        """
+        aggreg = [{'$match': json_util.loads(query)}]
+        if analyzed_only:
+            aggreg.append({'$match': {'analysis.faceTime': {'$gt': 0}}})
+        aggreg.append({'$group': {'_id': None, 'count': {'$sum': 1}}})
+        count = self._collection.aggregate(aggreg, allowDiskUse=True, cursor={})
+        try:
+            return next(count)['count']
+        except StopIteration:
+            return 0
@@ -0,0 +1,111 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import bisect
+import heapq
+import logging
+import time
+from collections import Counter
+from threading import Lock
+
+from tools.utils import timeFormat
+
+
+class TagIndex(object):
+    """
+    In-memory inverted index of the `tags` field of the documents of a collection:
+    each tag id is mapped to the sorted list of ids of the documents holding it.
+    It is used to find the documents sharing the most tags with a given document by
+    reading only the posting lists of its tags, instead of loading all the candidate documents.
+    The index is built from the collection on the first lookup, and is then kept up to date
+    by the service owning the collection when documents are inserted, tagged, untagged or deleted.
+    """
+    def __init__(self, collection):
+        super(TagIndex, self).__init__()
+        self._collection = collection
+        self._lock = Lock()
+        # {tagId: sorted list of ids}
+        self._index = None
+
+    def _build(self):
+        start = time.time()
+        self._index = {}
+        nb = 0
+        for doc in self._collection.find({}, {'tags': True}):
+            nb += 1
+            for tagId in doc.get('tags', []):
+                self._index.setdefault(tagId, []).append(doc['_id'])
+        for ids in self._index.values():
+            ids.sort()
+        logging.info("Indexed tags of %d documents of collection %s in %s"
+                     % (nb, self._collection.name, timeFormat(time.time() - start)))
+
+    def _add(self, _id, tagId):
+        ids = self._index.setdefault(tagId, [])
+        pos = bisect.bisect_left(ids, _id)
+        if pos == len(ids) or ids[pos] != _id:
+            ids.insert(pos, _id)
+
+    def _remove(self, _id, tagId):
+        ids = self._index.get(tagId)
+        if ids is None:
+            return
+        pos = bisect.bisect_left(ids, _id)
+        if pos < len(ids) and ids[pos] == _id:
+            del ids[pos]
+        if len(ids) == 0:
+            del self._index[tagId]
+
+    def add(self, _id, tagIds):
+        """
+        Index the given tags of the document given by id.
+        """
+        _id = str(_id)
+        with self._lock:
+            if self._index is None:
+                return  # the tags will be read when the index gets built
+            for tagId in tagIds:
+                self._add(_id, tagId)
+
+    def remove(self, _id, tagIds):
+        """
+        Remove the given tags of the document given by id from the index.
+        """
+        _id = str(_id)
+        with self._lock:
+            if self._index is None:
+                return
+            for tagId in tagIds:
+                self._remove(_id, tagId)
+
+    def removeTag(self, tagId):
+        """
+        Remove the given tag from all the documents.
+        """
+        with self._lock:
+            if self._index is not None:
+                self._index.pop(tagId, None)
+
+    def clear(self):
+        """
+        Drop the index, it will be rebuilt from the collection on the next lookup.
+        """
+        with self._lock:
+            self._index = None
+
+    def topOverlap(self, tagIds, k, exclude=None):
+        """
+        Returns the list of the (at most) `k` tuples (id, score) of the documents holding the most
+        of the given tags, by decreasing score, where the score is the number of these tags
+        the document holds. The document given by the `exclude` id is left out.
+        """
+        with self._lock:
+            if self._index is None:
+                self._build()
+            scores = Counter()
+            for tagId in set(tagIds):
+                scores.update(self._index.get(tagId, []))
+        if exclude is not None:
+            scores.pop(str(exclude), None)
+        return heapq.nlargest(k, scores.items(), key=lambda item: item[1])
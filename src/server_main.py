@@ -16,7 +16,7 @@ from tornado.ioloop import IOLoop
 from conf import Conf
 from config.termColors import cPrint, ICyan
 import log
-from server.model import Model
+from server.model import getInstance, getService
 from server.requestHandlers.assetsHandler import AssetsHandler, minifiedCleanUp
 from server.requestHandlers.templatesHandler import TemplatesHandler
 from server.requestHandlers.defaultHandler import DefaultHandler
@@ -28,6 +28,7 @@ from server.requestHandlers.dbUpdateHandler import DbUpdateHandler
 from server.requestHandlers.notificationHandler import NotificationHandler
 from server.requestHandlers.serverActionHandler import ServerActionHandler
 from server.requestHandlers.homeHandler import HomeHandler
+from server.requestHandlers.databaseHandler import DatabaseHandler
 from server.requestHandlers.analyzeSocketHandler import AnalyzeSocketHandler
 from server.requestHandlers.dbUpdateSocketHandler import DbUpdateSocketHandler
 from server.requestHandlers.compileSocketHandler import CompileSocketHandler
@@ -90,6 +91,8 @@ class Server(Thread):
         ioloop = tornado.ioloop.IOLoop.instance()
         ioloop.add_callback(lambda x: x.stop(), ioloop)
         logging.info("Requested tornado server to stop.")
+        # write the buffered video counters before exiting
+        getService('video').flushCounters(stop=True)
 
     def log(self, handler):
         import ipdb; ipdb.set_trace()
@@ -113,7 +116,7 @@ class Server(Thread):
         # create model, that hold services for database collection
         # and memory, a wrapper object over the manipulation of the shared
         # persistent memory between queries
-        model = Model()
+        model = getInstance()
 
         # define server settings and server routes
         server_settings = {
@@ -136,6 +139,7 @@ class Server(Thread):
             (r"/api/tag/([a-zA-Z0-9_.-]+)/?", TagsHandler),
             (r"/api/notify/([a-zA-Z0-9_.-]+)/?", NotificationHandler),
             (r"/api/home/([a-zA-Z0-9_.-]+)/?", HomeHandler),
+            (r"/api/db/([a-zA-Z0-9_.-]+)/?", DatabaseHandler),
             (r"/subscribe/db/update/?", DbUpdateSocketHandler),
             (r"/subscribe/video/analyze/?", AnalyzeSocketHandler),
             (r"/subscribe/video/compile/?", CompileSocketHandler),
@@ -159,6 +163,9 @@ class Server(Thread):
         # cleanup minified assets
         minifiedCleanUp()
 
+        # back up the database in the background once the server is running
+        tornado.ioloop.IOLoop.instance().add_callback(model.startBackups)
+
         if self._onReady is not None:
             self._onReady()
         # start listening
@@ -167,6 +174,7 @@ class Server(Thread):
         except KeyboardInterrupt:
             logging.info("Stopping server...")
 
+        getService('video').flushCounters(stop=True)
         model.disconnect()
 
 if __name__ == '__main__':
@@ -33,6 +33,8 @@ class Analyzer(Thread):
     progression to the client.
     """
     __version__ = '0.1.0'
+    # number of post-processed frames between two partial aggregation dumps
+    AGGREGATION_PERSIST_INTERVAL = 500
     def __init__(self, videoId, videoPath, snapshotsFolder,
                  progressCb=None, async=True, force=False,
                  annotator='dfl-mt', videoDuration=0, autoCleanup=False):
@@ -80,6 +82,8 @@ class Analyzer(Thread):
             * `aggregation`: data will contain a dict describing the result of the aggregation of all annotated frames.
                 This includes the time face ratio, pixel face ratio, time eye ratio, number of pictured humans,
                 mapping of tags / web entities to the number time google actually mentionned it, etc..
+            * `aggregation_partial`: data will contain the aggregation of the frames post-processed so far.
+                Sent every `AGGREGATION_PERSIST_INTERVAL` frames during the post-processing step.
         * `data`: actual data being sent
         """
         super(Analyzer, self).__init__()
@@ -167,14 +171,15 @@ class Analyzer(Thread):
         if self._stopped():
             return
 
-        ppResults = self._postProcessAnalyzis(results)
+        aggregator = AnalysisAggregator(self._start_t)
+        self._postProcessAnalyzis(results, aggregator)
 
         progressBar.set_description('[Analysis Step: Analysis Aggregation')
         progressBar.update()
         if self._stopped():
             return
 
-        aggregate = self._aggregateAnalyzis(ppResults)
+        aggregate = self._aggregateAnalyzis(aggregator)
 
         if self._autoCleanup:
             progressBar.set_description('[Analysis Step: Temporary Data Cleanup')
@@ -339,60 +344,109 @@ class Analyzer(Thread):
 
         return results
 
-    def _postProcessAnalyzis(self, results):
+    def _aggregationDump(self, partial=False):
+        return os.path.join(self._snapshotsFolder, "%s-analysis_%s_aggreg%s.json" % (
+            os.path.basename(self._minividFolder), self._annotator,
+            '_partial' if partial else ''))
+
+    def _persistPartialAggregation(self, aggregator):
+        """
+        Dump the aggregation of the frames post-processed so far on disk
+        and report it to the client.
+        """
+        partialAggreg = aggregator.snapshot(Analyzer.__version__)
+        try:
+            with open(self._aggregationDump(partial=True), 'w') as f:
+                json.dump(partialAggreg, f)
+        except IOError as e:
+            logging.warning("Unable to dump partial aggregation: %s", repr(e))
+        self.progress(dataType='aggregation_partial', data=partialAggreg)
+
+    def _postProcessAnalyzis(self, results, aggregator):
+        """
+        Post-process the given raw results. Each post-processed frame is added to
+        the given `aggregator` as soon as it is available.
+        Post-processed frames are not kept in memory: they are written to the cache file
+        as they come, which is only kept if all the frames have been post-processed.
+        """
         logging.info("Performing analysis post-processing of %d frames", len(results))
         jsonDump = os.path.join(self._snapshotsFolder, "%s-analysis_%s_pp.json" % (
             os.path.basename(self._minividFolder), self._annotator))
         if not self._force and os.path.exists(jsonDump):
             try:
                 with open(jsonDump, 'r') as f:
-                    results = json.load(f)
-                    if len(results) > 0:
+                    ppResults = json.load(f)
+                    if len(ppResults) > 0:
                         logging.info(
                             "Post-processed annotation results found - analysis skipped (set force=true): %s",
                             jsonDump)
                         self._pushAllAnalysisProgress(
-                            'annotation', results, 'Minivid analysis post-processing, frame #%d')
-                        return results
+                            'annotation', ppResults, 'Minivid analysis post-processing, frame #%d')
+                        aggregator.update(ppResults)
+                        return
             except:
                 pass
         processor = AnalysisPostProcessor(results)
-        ppResults = []
-        # breaking the generator chain here - holding all results in memory shouldn't be an issue
-        # also we need the full list to dump it on disk before passing to the post-processing step
-
-        for i, res in enumerate(processor()):
-            if self._stopped():
-                return ppResults  # don't save the cache if process was interrupted
-
-            ppResults.append(res)
-            self.progress(
-                dataType='annotation', data=res, frame_number=i,
-                step='Minivid analysis post-processing, frame #%d' % (len(ppResults)),
-                file=res['name'])
-
-        if len(ppResults) > 0 and len(ppResults) == len(results) and not self._stopped():
-            with open(jsonDump, 'w') as f:
-                json.dump(ppResults, f)
-        return ppResults
+        tmpDump = jsonDump + '.tmp'
+        try:
+            dumpFile = open(tmpDump, 'w')
+            dumpFile.write('[')
+        except IOError as e:
+            logging.warning("Unable to dump post-processed frames: %s", repr(e))
+            dumpFile = None
 
-    def _aggregateAnalyzis(self, results):
-        logging.debug("Performing aggregation from analysis of %d frames" % len(results))
-        jsonDump = os.path.join(self._snapshotsFolder, "%s-analysis_%s_aggreg.json" % (
-            os.path.basename(self._minividFolder), self._annotator))
+        nbFrames = 0
+        try:
+            for i, res in enumerate(processor()):
+                if self._stopped():
+                    return  # don't save the cache if process was interrupted
+
+                if dumpFile is not None:
+                    if nbFrames > 0:
+                        dumpFile.write(',')
+                    json.dump(res, dumpFile)
+                nbFrames += 1
+                aggregator.add(res)
+                self.progress(
+                    dataType='annotation', data=res, frame_number=i,
+                    step='Minivid analysis post-processing, frame #%d' % nbFrames,
+                    file=res['name'])
+                if aggregator.nbFrames % self.AGGREGATION_PERSIST_INTERVAL == 0:
+                    self._persistPartialAggregation(aggregator)
+
+            if dumpFile is not None:
+                dumpFile.write(']')
+        finally:
+            if dumpFile is not None:
+                dumpFile.close()
+                # don't dump if we don't have the full resultset!
+                if nbFrames > 0 and nbFrames == len(results) and not self._stopped():
+                    os.replace(tmpDump, jsonDump)
+                else:
+                    os.remove(tmpDump)
+
+    def _aggregateAnalyzis(self, aggregator):
+        """
+        Finalize the aggregation computed while post-processing frames.
+        """
+        logging.debug("Performing aggregation from analysis of %d frames" % aggregator.nbFrames)
+        jsonDump = self._aggregationDump()
         if not self._force and os.path.exists(jsonDump):
             try:
                 with open(jsonDump, 'r') as f:
                     results = json.load(f)
-                    if len(results.items()) > 0:
+                    if len(results.items()) > 0 and not results.get('partial', False):
                         logging.info(
                             "Aggregated annotation results found - analysis skipped (set force=true): %s",
                             jsonDump)
                         return results
             except:
                 pass
-        aggregator = AnalysisAggregator(results, self._start_t)
         aggregResults = aggregator(Analyzer.__version__)
         with open(jsonDump, 'w') as f:
             json.dump(aggregResults, f)
+        try:
+            os.remove(self._aggregationDump(partial=True))
+        except (IOError, OSError):
+            pass
         return aggregResults
@@ -40,12 +40,13 @@ Annotators = {
 
 class AlbumAnalyzer(object):
     __version__ = '0.0.8'
-    def __init__(self, imgPaths, annotator, progress=None):
+    def __init__(self, imgPaths, annotator, progress=None, dedupThreshold=None):
         super(AlbumAnalyzer, self).__init__()
         self._imgPaths = imgPaths
         self.annotator = annotator
         self.annotatorInstance = None
         self.progress = progress
+        self.dedupThreshold = dedupThreshold
 
     def stop(self):
         self.annotatorInstance.stop()
@@ -66,7 +67,8 @@ class AlbumAnalyzer(object):
         Only *.png files will be processed (minivid generator is expected to generate png files)
         Call `len(analyzer)` to get the number of items expected to be generated in advance.
         """
-        self.annotatorInstance = BatchImageAnnotator(self._imgPaths, self.progress)
+        self.annotatorInstance = BatchImageAnnotator(
+            self._imgPaths, self.progress, dedupThreshold=self.dedupThreshold)
         for result in self.annotatorInstance():
             yield result
 
@@ -79,12 +81,16 @@ class MinividAnalyzer(AlbumAnalyzer):
     """
     Use a `BatchImageAnnotator` instance to annotate each frame of the minivid
     that is expected to be generated already
+    Consecutive frames that are visually identical will only be annotated once
+    (see `Conf['data']['videos']['dedupThreshold']`)
     """
     def __init__(self, minividFolder, annotator, progress):
         imgPaths = [os.path.join(minividFolder, img)
                         for img in os.listdir(minividFolder)
                         if img.endswith('.png')]
-        super(MinividAnalyzer, self).__init__(imgPaths, annotator, progress)
+        super(MinividAnalyzer, self).__init__(
+            imgPaths, annotator, progress,
+            dedupThreshold=Conf['data']['videos'].get('dedupThreshold'))
 
 class AnalysisPostProcessor(object):
     """
@@ -418,32 +424,103 @@ class AnalysisPostProcessor(object):
 
 class AnalysisAggregator(object):
     """
-    Aggregates all frame analysis results into a single object with the following properties:
+    Aggregates frame analysis results into a single object with the following properties:
     * `averageFaceRatio`: average ratio between detected covering face surface and image size
     * `faceTime`: number of frames holding a face
     * `faceTimeProp`: proportion of frames holding a face
+    * `dedupFrames`: number of frames whose annotation was copied from the previous frame
+    * `dedupRatio`: proportion of deduplicated frames
+    * `faces`: statistics for each identified face, indexed by face id
+        (`nbFrames`, `firstFrame`, `lastFrame`, `averageConfidence`)
+    * `faceRatioHistogram`: number of frames for each face ratio bucket
+        (`HISTOGRAM_BINS` buckets of equal size over [0, 1], larger ratios fall in the last one)
+    * `facesPerFrameHistogram`: number of frames holding 0, 1, 2... faces
+        (up to `MAX_FACES_PER_FRAME`, frames holding more faces fall in the last bucket)
+    * `partial`: True if more frames are expected to be aggregated
     * ...
+    The aggregation is computed online: frames are added one by one as they are post-processed
+    using `add`, and `snapshot` can be called at any time to retrieve the current aggregate.
     """
-    def __init__(self, results, start_t):
+    HISTOGRAM_BINS = 10
+    MAX_FACES_PER_FRAME = 5
+
+    def __init__(self, start_t):
         super(AnalysisAggregator, self).__init__()
-        self._results = results
         self._start_t = start_t
+        self.nbFrames = 0
+        self._sumFaceRatio = 0.0
+        self._faceTime = 0
+        self._dedupFrames = 0
+        self._faces = {}
+        self._faceRatioHistogram = [0] * self.HISTOGRAM_BINS
+        self._facesPerFrameHistogram = [0] * (self.MAX_FACES_PER_FRAME + 1)
+
+    def add(self, itm):
+        """
+        Aggregate a single post-processed frame
+        """
+        frameNumber = self.nbFrames
+        self.nbFrames += 1
+        self._sumFaceRatio += itm['faceRatio']
+        self._faceTime += 1 if len(itm['faces']) > 0 else 0
+        self._dedupFrames += 1 if itm.get('deduplicated', False) else 0
+
+        bucket = int(itm['faceRatio'] * self.HISTOGRAM_BINS)
+        self._faceRatioHistogram[min(bucket, self.HISTOGRAM_BINS - 1)] += 1
+        self._facesPerFrameHistogram[min(len(itm['faces']), self.MAX_FACES_PER_FRAME)] += 1
+
+        for face in itm['faces']:
+            # mongodb requires string keys
+            faceId = str(face.get('id'))
+            if faceId not in self._faces:
+                self._faces[faceId] = {
+                    'nbFrames': 0, 'firstFrame': frameNumber, 'lastFrame': frameNumber,
+                    'sumConfidence': 0.0}
+            stats = self._faces[faceId]
+            stats['nbFrames'] += 1
+            stats['lastFrame'] = frameNumber
+            stats['sumConfidence'] += face.get(
+                'altered_detection_confidence', face.get('detection_confidence', 0))
+
+    def update(self, results):
+        """
+        Aggregate each frame of the given iterable
+        """
+        for itm in results:
+            self.add(itm)
 
-    def __call__(self, version):
-        if len(self._results) == 0:
-            raise Exception('No result to aggregate!')
-        logging.info("Aggregating %d results..." % len(self._results))
-
-        sums = [0, 0]
-        for itm in tqdm(self._results, desc="[Aggregating results"):
-            sums[0] += itm['faceRatio']
-            sums[1] += 1.0 if len(itm['faces']) > 0 else 0.0
-
+    def snapshot(self, version, partial=True):
+        """
+        Returns the aggregation of all frames added so far.
+        """
+        nbFrames = self.nbFrames or 1  # avoid division by zero on empty partial snapshots
         return {
             '__version__': version,
-            'averageFaceRatio': float(sums[0]) / len(self._results) * 100,
-            'faceTime': sums[1],
-            'faceTimeProp': float(sums[1]) / len(self._results) * 100,
+            'averageFaceRatio': float(self._sumFaceRatio) / nbFrames * 100,
+            'faceTime': self._faceTime,
+            'faceTimeProp': float(self._faceTime) / nbFrames * 100,
+            'dedupFrames': self._dedupFrames,
+            'dedupRatio': float(self._dedupFrames) / nbFrames * 100,
+            'faces': {
+                faceId: {
+                    'nbFrames': stats['nbFrames'],
+                    'firstFrame': stats['firstFrame'],
+                    'lastFrame': stats['lastFrame'],
+                    'averageConfidence': stats['sumConfidence'] / stats['nbFrames']
+                } for faceId, stats in self._faces.items()
+            },
+            'faceRatioHistogram': list(self._faceRatioHistogram),
+            'facesPerFrameHistogram': list(self._facesPerFrameHistogram),
             'duration': time.time() - self._start_t,
-            'nbFrames': len(self._results)
+            'nbFrames': self.nbFrames,
+            'partial': partial
         }
+
+    def __call__(self, version):
+        """
+        Returns the final aggregation of all frames added.
+        """
+        if self.nbFrames == 0:
+            raise Exception('No result to aggregate!')
+        logging.info("Aggregated %d results." % self.nbFrames)
+        return self.snapshot(version, partial=False)
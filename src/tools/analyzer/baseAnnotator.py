@@ -3,6 +3,7 @@
 from __future__ import unicode_literals
 
 from collections import deque
+import copy
 import logging
 import time
 import os
@@ -12,6 +13,7 @@ import math
 from datetime import datetime
 from tqdm import tqdm
 import re
+from PIL import Image
 
 from conf import Conf
 from tools.utils import extends
@@ -41,6 +43,29 @@ def checkCache(imagePath, annotator):
             raise ValueError("Empty cache")
         return cacheData
 
+def perceptualHash(imagePath, hashSize=8):
+    """
+    Compute a difference hash (dHash) of the given image: the image is downscaled to a
+    `(hashSize + 1) x hashSize` grayscale thumbnail and each bit of the hash tells whether
+    a pixel is brighter than its right neighbour.
+    Returns a tuple `(hash, size)` where `hash` is an int of `hashSize ** 2` bits
+    and `size` the dimensions of the original image.
+    """
+    with Image.open(imagePath) as image:
+        size = image.size
+        thumb = image.convert('L').resize((hashSize + 1, hashSize), Image.ANTIALIAS)
+        pixels = list(thumb.getdata())
+    value = 0
+    for row in range(hashSize):
+        for col in range(hashSize):
+            left = pixels[row * (hashSize + 1) + col]
+            right = pixels[row * (hashSize + 1) + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value, size
+
+def hammingDistance(hashA, hashB):
+    return bin(hashA ^ hashB).count('1')
+
 class BaseAnnotator(object):
     supportReportingProgress = False
     """
@@ -48,7 +73,13 @@ class BaseAnnotator(object):
     as well as utility methods such as caching and batching.
     This doesn't perform any analysis on its own.
     """
-    def __init__(self, name, batchSize, imgPaths, progress=None):
+    def __init__(self, name, batchSize, imgPaths, progress=None, dedupThreshold=None):
+        """
+        If `dedupThreshold` is set, the perceptual hash of each frame will be compared to the one of
+        the previous frame. When the hamming distance between the two is lower than or equal to
+        this threshold, the frame isn't submitted to the annotator and the annotation of the
+        previous frame is re-used instead (marked with `deduplicated=True`).
+        """
         super(BaseAnnotator, self).__init__()
         self.imgPaths = list(sorted(set(imgPaths), key=extract_image_num))  # don't query the same image twice
         self.BATCH_SIZE = batchSize
@@ -58,6 +89,11 @@ class BaseAnnotator(object):
         self.resultCache = {}
         self.lastProgressCall = time.time()
         self._stopped = False
+        self.dedupThreshold = dedupThreshold
+        # path and (lazily computed) perceptual hash of the last frame processed
+        self._previousFrame = None
+        # full annotation of the last frame yielded, source of deduplicated frames across batches
+        self._previousResult = None
 
     # overridable
     def stop(self):
@@ -93,6 +129,45 @@ class BaseAnnotator(object):
 
         return serializedData
 
+    def _frameHash(self, frame):
+        """
+        Returns the perceptual hash of the given frame descriptor `{path, hash}`,
+        computing it only the first time it is needed.
+        """
+        if frame['hash'] is None:
+            frame['hash'] = perceptualHash(frame['path'])
+        return frame['hash']
+
+    def _isDuplicate(self, imagePath):
+        """
+        Returns True if the given image is perceptually identical to the previous frame,
+        in which case its annotation can be copied from the previous one.
+        Deduplication is disabled unless `dedupThreshold` has been set.
+        """
+        previous = self._previousFrame
+        self._previousFrame = {'path': imagePath, 'hash': None}
+        if self.dedupThreshold is None or previous is None:
+            return False
+        try:
+            previousHash, previousSize = self._frameHash(previous)
+            currentHash, currentSize = self._frameHash(self._previousFrame)
+        except (IOError, ValueError) as e:
+            logging.debug("Unable to compute perceptual hash: %s", repr(e))
+            return False
+        # annotations hold pixel coordinates, never re-use them across different sizes
+        return previousSize == currentSize and \
+            hammingDistance(previousHash, currentHash) <= self.dedupThreshold
+
+    def _duplicateAnnotation(self, previous, imagePath):
+        """
+        Build the annotation of a deduplicated frame from the annotation of the previous frame.
+        """
+        extensionKeys = ['analyzeTs', 'analyzeDate', 'analyzeDuration', 'path', 'name']
+        annotation = {k: copy.deepcopy(v) for k, v in previous.items() if k not in extensionKeys}
+        annotation['deduplicated'] = True
+        annotation['duplicateOf'] = previous['name']
+        return self._extendAnnotation(annotation, imagePath, 0)
+
     def _extendAnnotation(self, annotation, imagePath, duration):
         if 'name' in annotation or 'path' in annotation:
             return annotation  # already extended (might come from cache)
@@ -132,11 +207,13 @@ class BaseAnnotator(object):
         """
         start_batch = time.time()
 
-        # list of image paths annotated (not cached) in this batch
+        # list of image paths annotated (not cached nor deduplicated) in this batch
         currentBatch = []
-        # list of all images processed in this batch (cached and annotated)
+        # list of all images processed in this batch (cached, deduplicated and annotated)
         fullBatch = []
-        # {<imagePath>: {'data': <cached data, if available>, 'index': <response index, otherwise>, 'frame': <frame number>}}
+        # {<imagePath>: {'data': <cached data, if available>, 'index': <response index, otherwise>,
+        #                'duplicate': <True if the annotation is copied from the previous frame>,
+        #                'frame': <frame number>}}
         self.resultCache = {}
 
         while len(self.imgPaths) > 0 and len(fullBatch) < self.BATCH_SIZE:
@@ -147,14 +224,23 @@ class BaseAnnotator(object):
                 data = self._checkCache(imagePath)
                 self.resultCache[imagePath] = {'data': data, 'frame': self.frameNumber}
                 self._progress(imagePath, data)
+                self._previousFrame = {'path': imagePath, 'hash': None}
             except (IOError, ValueError):
                 #  cache doesn't exist
-                self.resultCache[imagePath] = {'index': len(currentBatch), 'frame': self.frameNumber}
-                currentBatch.append(imagePath)
+                if self._isDuplicate(imagePath):
+                    self.resultCache[imagePath] = {'duplicate': True, 'frame': self.frameNumber}
+                else:
+                    self.resultCache[imagePath] = {'index': len(currentBatch), 'frame': self.frameNumber}
+                    currentBatch.append(imagePath)
 
             self.frameNumber += 1
 
+        nbDuplicates = sum(1 for imagePath in fullBatch if 'duplicate' in self.resultCache[imagePath])
+        if nbDuplicates > 0:
+            logging.debug("%d of %d frames deduplicated.", nbDuplicates, len(fullBatch))
+
         annotations = []
+        duration = 0
         if len(currentBatch) > 0:
             logging.debug("Submitting %d annotations...", len(currentBatch))
             self.lastProgressCall = time.time()
@@ -172,14 +258,25 @@ class BaseAnnotator(object):
             self.stop()
             raise Exception('Missed %d annotation responses in current batch. Aborting.' % (len(currentBatch) - len(annotations)))
 
-        return [
-            self.resultCache[imagePath]['data']
-            if 'data' in self.resultCache[imagePath] else
-            self._cache(imagePath, self._extendAnnotation(
-                annotations[self.resultCache[imagePath]['index']],
-                imagePath, duration), self.resultCache[imagePath]['frame'])
-            for imagePath in fullBatch
-        ]
+        # frames are resolved in order so that a deduplicated frame can always
+        # copy the annotation of the frame right before it
+        results = []
+        for imagePath in fullBatch:
+            entry = self.resultCache[imagePath]
+            if 'data' in entry:
+                result = entry['data']
+            elif 'duplicate' in entry:
+                result = self._cache(imagePath, self._duplicateAnnotation(
+                    self._previousResult, imagePath), entry['frame'])
+                if self.supportReportingProgress and self.progress is not None:
+                    self.progress(entry['frame'], result)
+            else:
+                result = self._cache(imagePath, self._extendAnnotation(
+                    annotations[entry['index']], imagePath, duration), entry['frame'])
+            self._previousResult = result
+            results.append(result)
+
+        return results
 
     def __call__(self):
         """
@@ -206,6 +303,10 @@ class BaseAnnotator(object):
             except Exception as e:
                 logging.error("Error during batch #%d. Skipping.", batchNb)
                 logging.exception(e)
+                # the frames of the failed batch have no annotation to copy:
+                # the first frame of the next batch can't be deduplicated
+                self._previousFrame = None
+                self._previousResult = None
                 if batchNb > nbImages:
                     logging.error(
                         "Processed more batches than images - something must be wrong here.")
@@ -18,8 +18,9 @@ class DFLAnnotator(BaseAnnotator):
     Save a cache of the result of the analysis on disk, so that we never submit
     a request for the same image twice.
     """
-    def __init__(self, name, imgPaths, progress, detector):
-        super(DFLAnnotator, self).__init__(name, BATCH_SIZE, imgPaths, progress)
+    def __init__(self, name, imgPaths, progress, detector, dedupThreshold=None):
+        super(DFLAnnotator, self).__init__(
+            name, BATCH_SIZE, imgPaths, progress, dedupThreshold=dedupThreshold)
 
         self.progress = progress
         self.detector = detector
@@ -96,9 +97,11 @@ class DFLAnnotator(BaseAnnotator):
         ]
 
 class MTDFLAnnotator(DFLAnnotator):
-    def __init__(self, imgPaths, progress):
-        super(MTDFLAnnotator, self).__init__('dfl-mt', imgPaths, progress, 'mt')
+    def __init__(self, imgPaths, progress, dedupThreshold=None):
+        super(MTDFLAnnotator, self).__init__(
+            'dfl-mt', imgPaths, progress, 'mt', dedupThreshold=dedupThreshold)
 
 class DLIBDFLAnnotator(DFLAnnotator):
-    def __init__(self, imgPaths, progress):
-        super(DLIBDFLAnnotator, self).__init__('dfl-dlib', imgPaths, progress, 'dlib')
+    def __init__(self, imgPaths, progress, dedupThreshold=None):
+        super(DLIBDFLAnnotator, self).__init__(
+            'dfl-dlib', imgPaths, progress, 'dlib', dedupThreshold=dedupThreshold)
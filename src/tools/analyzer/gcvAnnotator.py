@@ -160,8 +160,9 @@ class GCVAnnotator(BaseAnnotator):
     Save a cache of the result of the analysis on disk, so that we never submit
     a request for the same image twice.
     """
-    def __init__(self, imgPaths, progress):
-        super(GCVAnnotator, self).__init__('gcv', 2, imgPaths, progress)
+    def __init__(self, imgPaths, progress, dedupThreshold=None):
+        super(GCVAnnotator, self).__init__(
+            'gcv', 2, imgPaths, progress, dedupThreshold=dedupThreshold)
 
         self.client = vision.ImageAnnotatorClient()
 
@@ -0,0 +1,176 @@
+# -*- coding: utf8 -*-
+
+from __future__ import unicode_literals
+
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from threading import Lock
+
+from PIL import Image
+
+from conf import Conf
+from tools.utils import sizeFormat, getFolderSize
+
+"""
+Generation and disk caching of resized variants of album pictures.
+Each variant is stored in the cache folder under a name computed from the identity
+of the source picture (path, size and modification time) and the requested width,
+which is also used as a strong ETag to serve the variant.
+"""
+
+
+class ImageVariantCache(object):
+    """
+    Generates resized variants of pictures on a pool of worker threads and keeps
+    them on disk, evicting the least recently used variants when the cache grows
+    larger than its configured maximum size.
+    """
+    def __init__(self, path, widths, maxSize, quality=85, workers=None):
+        """
+        * `path`: folder where variants are stored
+        * `widths`: list of widths (in pixels) variants can be generated for.
+            Requested widths are rounded up to the closest available one.
+        * `maxSize`: maximum size of the cache folder, in bytes
+        * `quality`: JPEG quality of the generated variants
+        * `workers`: number of resizing threads (defaults to the number of CPUs)
+        """
+        super(ImageVariantCache, self).__init__()
+        self._path = path
+        self._widths = sorted(widths)
+        self._maxSize = maxSize
+        self._quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1)
+        self._lock = Lock()
+        # {key: [lock, number of threads using the lock]}, so that concurrent requests
+        # for the same variant only generate it once
+        self._keyLocks = {}
+        if not os.path.exists(self._path):
+            os.makedirs(self._path)
+        self._size = getFolderSize(self._path)
+        logging.info("Image variants cache: %s in %s", sizeFormat(self._size), self._path)
+
+    def variantWidth(self, width):
+        """
+        Returns the width of the variant that should be served for the requested width,
+        or None if the original picture should be served instead.
+        """
+        for available in self._widths:
+            if available >= width:
+                return available
+        return None
+
+    @staticmethod
+    def etag(picPath, width=None):
+        """
+        Compute a strong ETag for the given picture (or its variant of the given width)
+        from the path, size and modification time of the source picture, without reading it.
+        Raises `OSError` if the picture doesn't exist.
+        """
+        stat = os.stat(picPath)
+        key = '%s|%d|%d|%s' % (os.path.abspath(picPath), stat.st_size, stat.st_mtime_ns, width)
+        return hashlib.sha1(key.encode('utf8')).hexdigest()
+
+    def _variantPath(self, key):
+        return os.path.join(self._path, key[:2], key + '.jpg')
+
+    def _generate(self, picPath, width, variantPath):
+        with Image.open(picPath) as image:
+            if image.size[0] <= width:
+                return False
+            height = max(1, int(round(image.size[1] * width / float(image.size[0]))))
+            resized = image.convert('RGB').resize((width, height), Image.ANTIALIAS)
+        if not os.path.exists(os.path.dirname(variantPath)):
+            os.makedirs(os.path.dirname(variantPath))
+        # write to a temporary file first so that a concurrent reader never sees a partial variant
+        tmpPath = variantPath + '.tmp'
+        resized.save(tmpPath, 'JPEG', quality=self._quality)
+        os.replace(tmpPath, variantPath)
+        with self._lock:
+            self._size += os.path.getsize(variantPath)
+        return True
+
+    def _getVariant(self, picPath, width, key):
+        variantPath = self._variantPath(key)
+        with self._lock:
+            keyLock = self._keyLocks.setdefault(key, [Lock(), 0])
+            keyLock[1] += 1
+        try:
+            with keyLock[0]:
+                if os.path.exists(variantPath):
+                    # mark as recently used for the eviction
+                    os.utime(variantPath, None)
+                elif not self._generate(picPath, width, variantPath):
+                    # the picture is smaller than the requested variant
+                    return None
+                # variants whose key is locked are never evicted
+                with open(variantPath, 'rb') as f:
+                    buf = f.read()
+        finally:
+            with self._lock:
+                keyLock[1] -= 1
+                if keyLock[1] == 0:
+                    del self._keyLocks[key]
+        if self._size > self._maxSize:
+            self._evict()
+        return buf
+
+    def getVariant(self, picPath, width, key):
+        """
+        Returns a future resolved with the content of the JPEG variant of the given picture,
+        or with None if the original picture is not larger than the requested width.
+        `key` is the ETag of the variant (see `etag`).
+        """
+        return self._executor.submit(self._getVariant, picPath, width, key)
+
+    def _evict(self):
+        """
+        Remove the least recently used variants until the cache is back below 90% of its maximum size.
+        """
+        with self._lock:
+            if self._size <= self._maxSize:
+                return
+            entries = []
+            for dirpath, dirnames, filenames in os.walk(self._path):
+                for filename in filenames:
+                    if filename.split('.')[0] in self._keyLocks:
+                        continue  # being generated or read
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, filename)))
+            entries.sort()
+            target = self._maxSize * 0.9
+            removed = 0
+            for mtime, size, path in entries:
+                if self._size <= target:
+                    break
+                try:
+                    os.remove(path)
+                    self._size -= size
+                    removed += 1
+                except OSError:
+                    pass
+            logging.info("Evicted %d image variants from cache (%s remaining)",
+                         removed, sizeFormat(self._size))
+
+
+# this module is a singleton
+_instance = None
+
+_lock = Lock()
+
+def getInstance():
+    global _instance
+    global _lock
+    if _instance is None:
+        with _lock:
+            # re-test the _instance value, avoiding the case where another
+            # thread did the initialization between the previous test and the
+            # lock
+            if _instance is None:
+                _instance = ImageVariantCache(
+                    Conf['data']['albums']['variants']['path'],
+                    Conf['data']['albums']['variants']['widths'],
+                    Conf['data']['albums']['variants']['maxSize'] * 1024 ** 2,
+                    quality=Conf['data']['albums']['variants']['quality'])
+    return _instance
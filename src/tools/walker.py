@@ -7,6 +7,7 @@ import subprocess
 import time
 import logging
 from threading import Thread, Event
+from queue import Queue, Empty
 from tqdm import tqdm
 import re
 
@@ -15,7 +16,7 @@ from PIL import Image
 
 from tools.utils import extends, timeFormat
 from tools.analyzer.analyzers import AlbumAnalyzer
-from server import model
+from server import model, faceStore
 from conf import Conf
 
 
@@ -26,6 +27,60 @@ FFMPEG_CMDS = {
     'extractDimensions': '{ffprobe} -i "{videoPath}" -v 0 -of csv=p=0 -select_streams 0 -show_entries stream=width,height'
 }
 
+class PictureAnalysisDispatcher(Thread):
+    """
+    Consumes analyzed pictures from a work queue and saves their face annotations in the face store
+    and their analyzer version in the database in bulk, so that the annotator never waits for writes.
+    """
+    BULK_SIZE = 500
+    # maximum delay (in seconds) before pending pictures are saved
+    FLUSH_DELAY = 5
+
+    def __init__(self, version):
+        super(PictureAnalysisDispatcher, self).__init__()
+        self._version = version
+        self._queue = Queue()
+        self._stop_event = Event()
+        self.nbSaved = 0
+
+    def push(self, picture, annotation):
+        self._queue.put((picture, annotation))
+
+    def stop(self):
+        """
+        Request the dispatcher to stop once all queued pictures have been saved.
+        """
+        self._stop_event.set()
+
+    def _flush(self, pending):
+        if len(pending) == 0:
+            return
+        try:
+            faceStore.put(
+                [(picture['path'], annotation['faces']) for picture, annotation in pending],
+                version=self._version)
+            model.getService('album').setPicturesAnalysis(
+                [picture for picture, _ in pending], self._version)
+            self.nbSaved += len(pending)
+        except Exception as e:
+            logging.error("Unable to save analysis of %d pictures", len(pending))
+            logging.exception(e)
+
+    def run(self):
+        pending = []
+        lastFlush = time.time()
+        while not (self._stop_event.is_set() and self._queue.empty()):
+            try:
+                pending.append(self._queue.get(timeout=0.5))
+            except Empty:
+                pass
+            if len(pending) >= self.BULK_SIZE or time.time() - lastFlush > self.FLUSH_DELAY:
+                self._flush(pending)
+                pending = []
+                lastFlush = time.time()
+        self._flush(pending)
+
+
 class Walker(Thread):
     """
     This object is dedicated to walk through all the files
@@ -165,7 +220,7 @@ class Walker(Thread):
 
         if found is None:
             data = extends(data, album_exist=False, picture_exist=False, album_id=None)
-        elif any(os.path.basename(imgPath) == pic['filename'] for pic in found['picturesDetails']):
+        elif model.getService('album').hasPicture(found['_id'], os.path.basename(imgPath)):
             data = extends(data, album_exist=True, picture_exist=True, album_id=found['_id'])
         else:
             data = extends(data, album_exist=True, picture_exist=False, album_id=found['_id'])
@@ -298,7 +353,8 @@ class Walker(Thread):
             if album['fullPath'] in ['starred', 'random']:
                 continue
 
-            for picIdx, pic in enumerate(tqdm(album['picturesDetails'], desc="[Pictures")):
+            pictures = model.getService('album').getById(album['_id'], fields=['picturesDetails'])['picturesDetails']
+            for picIdx, pic in enumerate(tqdm(pictures, desc="[Pictures")):
                 c += 1
                 imgPath = Conf['data']['albums']['rootFolder'] + album['fullPath'] + pic['filename']
                 try:
@@ -314,89 +370,103 @@ class Walker(Thread):
 
 
     def __albums_analysis(self):
-        albums = model.getService('album').getUnanalyzedAlbums(AlbumAnalyzer.__version__)
-        logging.info("Preparing dataset for face detection (%d albums to process)", len(albums))
+        """
+        Performs the face detection of all pictures that haven't been analyzed with the current
+        version of the analyzer yet.
+        Pictures of all albums are submitted to a single annotator instance, so that batches
+        span over multiple albums and the detector is initialized once per run.
+        The analyzer version of analyzed pictures is saved in bulk by a `PictureAnalysisDispatcher`.
+        """
+        retainedPictures = []
+        nbAlbums = 0
+        for album in model.getService('album').getUnanalyzedAlbums(AlbumAnalyzer.__version__):
+            nbAlbums += 1
+            retainedPictures += album['picturesDetails']
+        imgPaths = [Conf['data']['albums']['rootFolder'] + pic['path'] for pic in retainedPictures]
+        # annotations are matched to their picture by path: the annotator doesn't yield
+        # an annotation for each image (duplicated paths, failed batches...)
+        picturesByPath = {
+            self.__annotationPath(imgPath): pic for imgPath, pic in zip(imgPaths, retainedPictures)}
+        logging.info("Preparing dataset for face detection (%d pictures in %d albums to process)",
+                     len(retainedPictures), nbAlbums)
+        if len(retainedPictures) == 0:
+            return
+
         start_t = time.time()
         self._progress['step'] = 'Missing Album Face Detection'
         self._progress['file'] = Conf['data']['albums']['rootFolder']
         self._send_progress()
         totalFaces = 0
-        progressBar = tqdm(total=len(albums), desc='[Albums Analysis')
-        for album in albums:
-            progressBar.set_description('[Analysing album %s' % album['name'])
-            progressBar.update()
-
-            pictures = album['picturesDetails']
-            # filter the list of pictures down to only the ones we manage to open with opencv
-            # (these would fail during analysis anyway so better filter them out now)
-            imgPaths = []
-            retainedPictures = []
-            for pic in tqdm(pictures, desc="[Pre-Filtering "):
-                filename = Conf['data']['albums']['rootFolder'] + pic['path']
-                try:
-                    # image = cv2.imread(filename)
-                    # if image is None:
-                    #     raise IOError('Unable to read image: %s' % filename)
-                    retainedPictures.append(pic)
-                    imgPaths.append(filename)
-                except Exception as e:
-                    logging.error("Unable to open image `%s' with opencv2." % (pic['path']))
-                    logging.exception(e)
-                    # model.getService('album').removePicture(pic['albumId'], pic['pictureIdx'])
-
-            # called whenever an image is processed
-            def progress(idx, annotation, render=False):
-                filepath = imgPaths[idx]
-                self._progress['file'] = filepath
-                if not render:
-                    return
-
-                COLORS = [
-                    (0, 255, 0),
-                    (0, 0, 255),
-                    (255, 0, 0),
-                    (255, 255, 0),
-                    (255, 0, 255),
-                    (0, 255, 255),
-                    (0, 0, 0),
-                    (255, 255, 255)
-                ]
-                title = retainedPictures[idx]['path']
-                image = cv2.imread(filepath)
-                for fidx, face in enumerate(annotation['faces']):
-                    x = face['boundaries'][0]['x']
-                    y = face['boundaries'][0]['y']
-                    x2 = face['boundaries'][1]['x']
-                    y2 = face['boundaries'][1]['y']
-                    cv2.rectangle(image, (x, y), (x2, y2), COLORS[fidx % len(COLORS)], 5)
-
-                    for landmark in face.get('landmarks', []):
-                        x = landmark['x']
-                        y = landmark['y']
-
-                        cv2.circle(image, (x, y), 5, COLORS[fidx % len(COLORS)], 5)
-
-                small = cv2.resize(image, (0,0), fx=0.2, fy=0.2)
-                cv2.imshow(title, small)
-                cv2.waitKey(0)
-
-            # perform the analysis
-            logging.debug("Performing missing face detection for %d pictures", len(retainedPictures))
-            analyzer = AlbumAnalyzer(
-                imgPaths=imgPaths, annotator=Conf['data']['albums']['annotator'], progress=progress)
-            res = analyzer()
-            albumsResults = []
-            for idx, annotation in enumerate(res):
-                albumsResults.append(res)
+
+        # called whenever an image is processed
+        def progress(idx, annotation, render=False):
+            picture = picturesByPath[annotation['path']]
+            filepath = Conf['data']['albums']['rootFolder'] + picture['path']
+            self._progress['file'] = filepath
+            if not render:
+                return
+
+            COLORS = [
+                (0, 255, 0),
+                (0, 0, 255),
+                (255, 0, 0),
+                (255, 255, 0),
+                (255, 0, 255),
+                (0, 255, 255),
+                (0, 0, 0),
+                (255, 255, 255)
+            ]
+            title = picture['path']
+            image = cv2.imread(filepath)
+            for fidx, face in enumerate(annotation['faces']):
+                x = face['boundaries'][0]['x']
+                y = face['boundaries'][0]['y']
+                x2 = face['boundaries'][1]['x']
+                y2 = face['boundaries'][1]['y']
+                cv2.rectangle(image, (x, y), (x2, y2), COLORS[fidx % len(COLORS)], 5)
+
+                for landmark in face.get('landmarks', []):
+                    x = landmark['x']
+                    y = landmark['y']
+
+                    cv2.circle(image, (x, y), 5, COLORS[fidx % len(COLORS)], 5)
+
+            small = cv2.resize(image, (0,0), fx=0.2, fy=0.2)
+            cv2.imshow(title, small)
+            cv2.waitKey(0)
+
+        dispatcher = PictureAnalysisDispatcher(AlbumAnalyzer.__version__)
+        dispatcher.start()
+
+        # perform the analysis
+        logging.debug("Performing missing face detection for %d pictures", len(retainedPictures))
+        analyzer = AlbumAnalyzer(
+            imgPaths=imgPaths, annotator=Conf['data']['albums']['annotator'], progress=progress)
+        progressBar = tqdm(total=len(retainedPictures), desc='[Albums Analysis')
+        try:
+            for idx, annotation in enumerate(analyzer()):
+                if self._stopped():
+                    analyzer.stop()
+                    break
+                picture = picturesByPath[annotation['path']]
+                progressBar.set_description('[Analysing album %s' % picture['albumName'])
+                progressBar.update()
                 totalFaces += len(annotation['faces'])
                 progress(idx, annotation)
+                dispatcher.push(picture, annotation)
+        finally:
+            progressBar.close()
+            dispatcher.stop()
+            dispatcher.join()
 
-                model.getService('album').setPictureAnalysis(
-                    retainedPictures[idx]['albumId'], retainedPictures[idx]['pictureIdx'],
-                    AlbumAnalyzer.__version__)
+        logging.info("Saved %d detected faces (%d pictures) in %s!",
+                     totalFaces, dispatcher.nbSaved, timeFormat(time.time() - start_t))
 
-        progressBar.close()
-        logging.info("Saved %d detected faces in %s!", totalFaces, timeFormat(time.time() - start_t))
+    def __annotationPath(self, imgPath):
+        """
+        Returns the path given by the annotators to the annotation of the given image.
+        """
+        return imgPath.replace(Conf['data']['videos']['rootFolder'], '')
 
     def __vid_exists(self, videoPath, data):
         """
@@ -26,9 +26,9 @@ def genVids():
         yield vid
     print ("Processed %d videos." % c)
 
-def updateSize(vid):
+def updateSize(vid, bulk):
     try:
-        model.getService('video').set(vid['_id'], 'fileSize', os.path.getsize(vid['path']))
+        bulk.set(vid['_id'], 'fileSize', os.path.getsize(vid['path']))
     except Exception as e:
         print ("ERROR: file `%s': %s" % (vid['path'], repr(e)))
 
@@ -42,12 +42,16 @@ def cleanUp(vid):
 
 def main():
     ns = parse_args()
-    for vid in genVids():
-        for action in ns.actions:
-            if action == 'clean':
-                cleanUp(vid)
-            if action == 'filesize':
-                updateSize(vid)
+    # sizes are written in batches
+    with model.getService('video').bulk() as bulk:
+        for vid in genVids():
+            for action in ns.actions:
+                if action == 'clean':
+                    cleanUp(vid)
+                if action == 'filesize':
+                    updateSize(vid, bulk)
+    for error in bulk.errors:
+        print ("ERROR: %s: %s" % (error['op'], error['errmsg']))
 
 if __name__ == '__main__':
     main()